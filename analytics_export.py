@@ -0,0 +1,196 @@
+"""
+Columnar export of the complete experiment graph for analytics and model training. sessions, experiments,
+experiment_objects, objects and containers are flattened into one wide table with one row per object of an experiment
+(experiments without objects get one row with empty object columns) and written as partitioned Parquet.
+Rows are streamed from SQLite into Arrow record batches, the database is never loaded into memory as a whole.
+
+Exports are incremental: the version of every changed session is tracked in the session_changes table (see migration
+3 in db_builder), only sessions changed since the last export are rewritten. Requires pyarrow.
+"""
+import glob
+import json
+import os
+import shutil
+import time
+
+from typing import Iterator, List
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+
+import db_builder
+
+db = './data/biocycle_tracking.db'
+
+MANIFEST = '_export.json'
+
+
+def _text(column: str) -> str:
+    return f'CAST({column} AS TEXT)'
+
+
+def _number(column: str) -> str:
+    return f"CASE WHEN typeof({column}) IN ('integer', 'real') THEN {column} END"
+
+
+def _integer(column: str) -> str:
+    return f"CASE WHEN typeof({column}) = 'integer' THEN {column} END"
+
+
+# (name, SQL expression, arrow type) of every column of the export. Values that do not match the type of the column
+# (e.g. text in a REAL column) are exported as null.
+EXPORT_COLUMNS = [
+    ('session_id', _text('experiments.session_id'), pa.string()),
+    ('session_note', _text('sessions.note'), pa.string()),
+    ('n_experiments', _integer('sessions.n_experiments'), pa.int64()),
+    ('responsible', _text('sessions.responsible'), pa.string()),
+    ('start_date', _text('sessions.start_date'), pa.string()),
+    ('end_date', _text('sessions.end_date'), pa.string()),
+    ('experiment_id', _text('experiments.experiment_id'), pa.string()),
+    ('container_id', _text('experiments.container_id'), pa.string()),
+    ('n_objects', _integer('experiments.n_objects'), pa.int64()),
+    ('file_path', _text('experiments.file_path'), pa.string()),
+    ('object_id', _text('experiment_objects.object_id'), pa.string()),
+    ('polymer_type', _text('objects.polymer_type'), pa.string()),
+    ('length', _number('objects.length'), pa.float64()),
+    ('texture', _text('objects.texture'), pa.string()),
+    ('stiffness', _number('objects.stiffness'), pa.float64()),
+    ('color', _text('objects.color'), pa.string()),
+    ('contamination', _text('objects.contamination'), pa.string()),
+    ('form', _text('objects.form'), pa.string()),
+    ('object_note', _text('objects.note'), pa.string()),
+    ('reference_image', _text('objects.reference_image'), pa.string()),
+    ('material_type', _text('containers.material_type'), pa.string()),
+    ('company', _text('containers.company'), pa.string()),
+    ('location', _text('containers.location'), pa.string()),
+    ('container_date', _text('containers.date'), pa.string()),
+    ('container_note', _text('containers.note'), pa.string()),
+]
+
+SCHEMA = pa.schema([(name, arrow_type) for name, _, arrow_type in EXPORT_COLUMNS])
+
+SESSION_QUERY = f'''
+    SELECT {', '.join(expression for _, expression, _ in EXPORT_COLUMNS)}
+    FROM experiments
+    LEFT JOIN sessions ON sessions.session_id = experiments.session_id
+    LEFT JOIN experiment_objects ON experiment_objects.experiment_id = experiments.experiment_id
+    LEFT JOIN objects ON objects.object_id = experiment_objects.object_id
+    LEFT JOIN containers ON containers.container_id = experiments.container_id
+        WHERE experiments.session_id = ?
+    ORDER BY experiments.experiment_id, experiment_objects.object_id;
+    '''
+
+
+def _partitioning(partition_by: str) -> ds.Partitioning:
+    return ds.partitioning(pa.schema([SCHEMA.field(partition_by)]), flavor='hive')
+
+
+def _session_batches(con, session_id: str, batch_size: int) -> Iterator[pa.RecordBatch]:
+    cursor = con.execute(SESSION_QUERY, (session_id,))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        columns = zip(*rows)
+        yield pa.RecordBatch.from_arrays([pa.array(values, type=arrow_type) for values, (_, _, arrow_type)
+                                          in zip(columns, EXPORT_COLUMNS)], schema=SCHEMA)
+
+
+def _read_manifest(out_dir: str) -> dict:
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def export_graph(out_dir: str = './data/export',
+                 partition_by: str = 'session_id',
+                 incremental: bool = True,
+                 batch_size: int = 65536,
+                 db_path: str = db) -> dict:
+    """
+    Export the flattened experiment graph to out_dir as Parquet, partitioned by partition_by (hive style, e.g.
+    out_dir/polymer_type=pe/S0001-0.parquet). Every file holds the rows of one session, so a changed session is
+    replaced without touching the others. With incremental=True only sessions changed since the last export to
+    out_dir are rewritten, a full export is done if there is no previous export or it used another partition column.
+    All sessions are read from one consistent snapshot of the database.
+    :param out_dir: str (optional), folder of the export
+    :param partition_by: str (optional), column to partition by, e.g. 'session_id' or 'polymer_type'
+    :param incremental: bool (optional), if False, everything is exported again
+    :param batch_size: int (optional), number of rows per Arrow record batch
+    :param db_path: str (optional), name of the database
+    :return: dict, {'sessions', 'rows', 'full', 'version', 'seconds', 'rows_per_s'}
+    """
+    if partition_by not in SCHEMA.names:
+        raise ValueError(f'unknown partition column {partition_by}, use one of {SCHEMA.names}')
+    start = time.perf_counter()
+    manifest = _read_manifest(out_dir)
+    full = not incremental or manifest is None or manifest['partition_by'] != partition_by
+    if full:
+        for column in {partition_by, manifest['partition_by'] if manifest else partition_by}:
+            for folder in glob.glob(os.path.join(glob.escape(out_dir), f'{column}=*')):
+                shutil.rmtree(folder)
+    os.makedirs(out_dir, exist_ok=True)
+
+    version = db_builder.start_change_version(db_path)
+    with db_builder.connections.snapshot(db_path) as con:
+        query = 'SELECT session_id FROM session_changes'
+        params = () if full else (manifest['version'],)
+        session_ids = [row[0] for row in con.execute(query if full else query + ' WHERE version > ?;', params)]
+        n_rows = 0
+        for session_id in session_ids:
+            for path in glob.glob(os.path.join(glob.escape(out_dir), f'{partition_by}=*',
+                                               f'{glob.escape(session_id)}-*.parquet')):
+                os.remove(path)
+
+            def counted(batches):
+                nonlocal n_rows
+                for batch in batches:
+                    n_rows += batch.num_rows
+                    yield batch
+
+            ds.write_dataset(counted(_session_batches(con, session_id, batch_size)), out_dir, schema=SCHEMA,
+                             format='parquet', partitioning=_partitioning(partition_by),
+                             basename_template=f'{session_id}-{{i}}.parquet',
+                             existing_data_behavior='overwrite_or_ignore')
+
+    with open(os.path.join(out_dir, MANIFEST + '.tmp'), 'w') as f:
+        json.dump({'partition_by': partition_by, 'version': version}, f)
+    os.replace(os.path.join(out_dir, MANIFEST + '.tmp'), os.path.join(out_dir, MANIFEST))
+
+    seconds = time.perf_counter() - start
+    return {'sessions': len(session_ids),
+            'rows': n_rows,
+            'full': full,
+            'version': version,
+            'seconds': seconds,
+            'rows_per_s': n_rows / seconds}
+
+
+def open_export(out_dir: str = './data/export') -> ds.Dataset:
+    """
+    Open an export as a pyarrow dataset. Files are memory-mapped, scans only read the columns and partitions they
+    need, e.g. open_export().to_table(columns=['object_id', 'length'], filter=ds.field('polymer_type') == 'pe').
+    :param out_dir: str (optional), folder of the export
+    :return: pyarrow.dataset.Dataset
+    """
+    manifest = _read_manifest(out_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'no export found in {out_dir}')
+    return ds.dataset(os.path.abspath(out_dir), schema=SCHEMA, format='parquet',
+                      partitioning=_partitioning(manifest['partition_by']),
+                      filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def read_export(out_dir: str = './data/export', columns: List[str] = None, filter: ds.Expression = None) -> pa.Table:
+    """
+    Read the columns and rows of an export that match filter into an Arrow table, see open_export.
+    Use .to_pandas() on the result to get a dataframe.
+    :param out_dir: str (optional), folder of the export
+    :param columns: List[str] (optional), columns to read, all if None
+    :param filter: pyarrow.dataset.Expression (optional), e.g. ds.field('session_id') == 'S0001'
+    :return: pyarrow.Table
+    """
+    return open_export(out_dir).to_table(columns=columns, filter=filter)
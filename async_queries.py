@@ -0,0 +1,152 @@
+"""
+asyncio wrappers around the most used functions of db_queries, for callers that run an event loop (e.g. the capture
+software polling for pending experiments). The blocking queries run on a bounded pool of reader threads and a single
+writer thread, each thread with its own long-lived connection, so the event loop is never stalled. Reads are not
+faster than the blocking functions of db_queries, the gain is a responsive event loop and writes that are not
+starved by readers (see bench_async_queries in benchmarks.py).
+"""
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import db_builder
+import db_queries
+
+db = './data/biocycle_tracking.db'
+
+
+class AsyncQueries:
+    """
+    Async query API bound to one database.
+
+    Reads run on up to max_workers threads. Concurrent get_experiment and get_complete_session calls are batched:
+    ids requested while all reader threads are busy are collected and fetched together with get_experiments /
+    get_complete_sessions as soon as a thread is free, so the batches grow with the load. Writes run one at a time on
+    a separate thread, so they never wait on each other for the write lock and readers keep running (WAL) while a
+    write is in progress.
+
+    Use it as an async context manager or call close() when done:
+
+        async with AsyncQueries() as queries:
+            experiments = await queries.get_complete_session('S0001')
+    """
+
+    def __init__(self, db_path: str = db, max_workers: int = 4, batching: bool = True):
+        self.db_path = db_path
+        self.batching = batching
+        self._threads = set()
+        self._readers = ThreadPoolExecutor(max_workers, thread_name_prefix='biocycle_read',
+                                           initializer=self._register_thread)
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='biocycle_write', initializer=self._register_thread)
+        self._batches = {}
+        self._flushes = set()  # pending flush tasks, the event loop only keeps weak references to tasks
+        self._free_readers = asyncio.Semaphore(max_workers)
+
+    def _register_thread(self) -> None:
+        self._threads.add(threading.get_ident())
+
+    async def _read(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, func, *args)
+
+    async def _write(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    async def _batched(self, kind: tuple, key: str, load: Callable):
+        """
+        Add key to the open batch of its kind and wait for the result. The first request of a batch schedules the
+        flush, all requests made before the flush gets a reader thread join the batch.
+        """
+        batch = self._batches.get(kind)
+        if batch is None:
+            batch = self._batches[kind] = {}
+            task = asyncio.get_running_loop().create_task(self._flush(kind, load))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        future = batch.get(key)
+        if future is None:
+            future = batch[key] = asyncio.get_running_loop().create_future()
+        return await asyncio.shield(future)
+
+    async def _flush(self, kind: tuple, load: Callable) -> None:
+        async with self._free_readers:
+            batch = self._batches.pop(kind)
+            try:
+                result = await self._read(load, list(batch))
+            except Exception as e:
+                for future in batch.values():
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(result.get(key, []))
+
+    async def get_experiment(self, experiment_id: str) -> list:
+        """
+        Async version of db_queries.get_experiment.
+        :param experiment_id: str, experiment_id of the experiment
+        :return: list, [experiment row] or [] if it does not exist
+        """
+        if not self.batching:
+            return await self._read(db_queries.get_experiment, experiment_id, self.db_path)
+
+        def load(experiment_ids):
+            return {experiment_id: [row] for experiment_id, row in
+                    db_queries.get_experiments(experiment_ids, self.db_path).items()}
+
+        return await self._batched(('experiment',), experiment_id, load)
+
+    async def get_complete_session(self, session_id: str, include_objects: bool = False) -> List[tuple]:
+        """
+        Async version of db_queries.get_complete_session.
+        :param session_id: str, session_id of the session
+        :param include_objects: bool (optional), if True, object_list holds dicts with all columns of the objects
+        :return: List[tuple], [(session_id, experiment_id, container_id, [object_list]), ...]
+        """
+        if not self.batching:
+            return await self._read(db_queries.get_complete_session, session_id, self.db_path, include_objects)
+
+        def load(session_ids):
+            return db_queries.get_complete_sessions(session_ids, self.db_path, include_objects)
+
+        return await self._batched(('complete_session', include_objects), session_id, load)
+
+    async def put_experiment(self, experiment_id: str = None, session_id: str = None, container_id: str = None,
+                             n_objects: int = None) -> None:
+        """
+        Async version of db_queries.put_experiment.
+        :return: None
+        """
+        return await self._write(db_queries.put_experiment, experiment_id, session_id, container_id, n_objects,
+                                 self.db_path)
+
+    async def link_experiment_objects(self, experiment_id: str, objects: List[str]) -> None:
+        """
+        Async version of db_queries.link_experiment_objects.
+        :return: None
+        """
+        return await self._write(db_queries.link_experiment_objects, experiment_id, objects, self.db_path)
+
+    async def close(self) -> None:
+        """
+        Wait for running queries, stop the worker threads and close their connections.
+        :return: None
+        """
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._readers.shutdown)
+        await loop.run_in_executor(None, self._writer.shutdown)
+        for thread_id in self._threads:
+            db_builder.connections.close_thread(thread_id)
+        self._threads.clear()
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+        return False
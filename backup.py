@@ -0,0 +1,205 @@
+"""
+Online backups of the database with the sqlite3 backup API. The database is copied BACKUP_PAGES pages per step with a
+pause of BACKUP_SLEEP seconds between the steps, so writers like the capture station keep committing while a backup
+runs. In WAL mode the copy is taken from one read snapshot, commits made during the backup are not copied and do not
+restart it. Every copy is written to a temporary file, checked with PRAGMA integrity_check and only then moved to its
+final name, so a backup or replica file is never torn.
+"""
+import collections
+import datetime
+import os
+import sqlite3 as sql
+import threading
+import time
+
+import db_builder
+
+db = './data/biocycle_tracking.db'
+BACKUP_DIR = './data/backups'
+REPLICA = './data/biocycle_tracking_replica.db'
+BACKUP_PAGES = 256
+BACKUP_SLEEP = 0.005
+
+
+def _copy(db_path: str, target: str, pages: int, sleep: float, verify: bool) -> dict:
+    start = time.perf_counter()
+    tmp = f'{target}.tmp'
+    for path in (tmp, f'{tmp}-journal'):
+        if os.path.exists(path):
+            os.remove(path)
+    steps = []
+    source = sql.connect(db_builder.read_only_uri(db_path), uri=True, isolation_level=None)
+    dest = None
+    try:
+        dest = sql.connect(tmp, isolation_level=None)
+        wal = source.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal'
+        if wal:
+            # pin one snapshot, otherwise every commit of another connection restarts the backup from the first page
+            source.execute('BEGIN;')
+            source.execute('SELECT count(*) FROM sqlite_schema;').fetchone()
+        source.backup(dest, pages=pages, progress=lambda status, remaining, total: steps.append(total), sleep=sleep)
+        if wal:
+            source.execute('COMMIT;')
+        # a single file that can be opened read-only without -wal and -shm files
+        dest.execute('PRAGMA journal_mode = DELETE;')
+        integrity = dest.execute('PRAGMA integrity_check;').fetchall() if verify else [('not checked',)]
+    except BaseException:
+        if dest is not None:
+            dest.close()
+            os.remove(tmp)
+        raise
+    finally:
+        source.close()
+    dest.close()
+    if verify and integrity != [('ok',)]:
+        os.remove(tmp)
+        raise sql.DatabaseError(f'copy of {db_path} failed the integrity check: '
+                                f'{"; ".join(row[0] for row in integrity[:10])}')
+    os.replace(tmp, target)
+    return {'path': target,
+            'pages': steps[-1] if steps else 0,
+            'steps': len(steps),
+            'bytes': os.path.getsize(target),
+            'integrity': integrity[0][0],
+            'seconds': time.perf_counter() - start}
+
+
+def backup(db_path: str = db, backup_dir: str = BACKUP_DIR, target: str = None, pages: int = BACKUP_PAGES,
+           sleep: float = BACKUP_SLEEP, verify: bool = True) -> dict:
+    """
+    Copy the database while it is in use. The backup is written to backup_dir as <name>-<timestamp>.db unless a
+    target is given. Larger pages and a smaller sleep make the backup faster, smaller pages and a longer sleep leave
+    more room for writers.
+    :param db_path: str (optional), name of the database
+    :param backup_dir: str (optional), folder of the timestamped backups
+    :param target: str (optional), file name of the backup, overwritten if it exists
+    :param pages: int (optional), pages copied per step, -1 copies the whole database in one step
+    :param sleep: float (optional), seconds to wait between two steps
+    :param verify: bool (optional), run PRAGMA integrity_check on the copy, raises sqlite3.DatabaseError if it fails
+    :return: dict, {'path', 'pages', 'steps', 'bytes', 'integrity', 'seconds'}
+    """
+    if target is None:
+        os.makedirs(backup_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(db_path))[0]
+        target = os.path.join(backup_dir, f'{name}-{datetime.datetime.now():%Y%m%d-%H%M%S-%f}.db')
+    return _copy(db_path, target, pages, sleep, verify)
+
+
+def list_backups(backup_dir: str = BACKUP_DIR, db_path: str = db) -> list:
+    """
+    Return the timestamped backups of a database in backup_dir, oldest first.
+    :param backup_dir: str (optional), folder of the backups
+    :param db_path: str (optional), name of the database
+    :return: list, paths of the backup files
+    """
+    if not os.path.isdir(backup_dir):
+        return []
+    prefix = os.path.splitext(os.path.basename(db_path))[0] + '-'
+    return [os.path.join(backup_dir, name) for name in sorted(os.listdir(backup_dir))
+            if name.startswith(prefix) and name.endswith('.db')]
+
+
+def rotate_backups(keep: int = 7, backup_dir: str = BACKUP_DIR, db_path: str = db) -> list:
+    """
+    Delete all but the keep newest backups of a database.
+    :param keep: int (optional), number of backups to keep
+    :param backup_dir: str (optional), folder of the backups
+    :param db_path: str (optional), name of the database
+    :return: list, paths of the deleted files
+    """
+    backups = list_backups(backup_dir, db_path)
+    removed = backups[:max(len(backups) - keep, 0)]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def refresh_replica(db_path: str = db, replica_path: str = REPLICA, pages: int = BACKUP_PAGES,
+                    sleep: float = BACKUP_SLEEP, verify: bool = True) -> dict:
+    """
+    Replace the replica file with a fresh verified copy of the database, for analytics notebooks that should not
+    touch the live file. The replica uses the rollback journal, so it can be opened read-only without -wal and -shm
+    files. The file is swapped in one step: connections that are already open keep reading the old copy until they
+    are reopened, e.g. with db_builder.connections.close(replica_path).
+    :param db_path: str (optional), name of the database
+    :param replica_path: str (optional), file name of the replica
+    :param pages: int (optional), pages copied per step
+    :param sleep: float (optional), seconds to wait between two steps
+    :param verify: bool (optional), run PRAGMA integrity_check on the copy before it replaces the replica
+    :return: dict, {'path', 'pages', 'steps', 'bytes', 'integrity', 'seconds'}
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(replica_path)), exist_ok=True)
+    return _copy(db_path, replica_path, pages, sleep, verify)
+
+
+class BackupScheduler:
+    """
+    Background thread that backs up the database every interval seconds and keeps the keep newest backups, and
+    refreshes the replica every replica_interval seconds if one is given. Used as a context manager the thread is
+    started on enter and stopped on exit. The last 100 results and errors of the runs are kept in results and
+    errors, an error does not stop the schedule.
+
+        with BackupScheduler(interval=3600, keep=24, replica_interval=300):
+            ...
+    """
+
+    def __init__(self, interval: float = 86400, keep: int = 7, replica_interval: float = None, db_path: str = db,
+                 backup_dir: str = BACKUP_DIR, replica_path: str = REPLICA, pages: int = BACKUP_PAGES,
+                 sleep: float = BACKUP_SLEEP):
+        self.interval = interval
+        self.keep = keep
+        self.replica_interval = replica_interval
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.replica_path = replica_path
+        self.pages = pages
+        self.sleep = sleep
+        self.results = collections.deque(maxlen=100)
+        self.errors = collections.deque(maxlen=100)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_backup(self) -> dict:
+        result = backup(self.db_path, self.backup_dir, pages=self.pages, sleep=self.sleep)
+        result['removed'] = rotate_backups(self.keep, self.backup_dir, self.db_path)
+        return result
+
+    def run_replica(self) -> dict:
+        return refresh_replica(self.db_path, self.replica_path, self.pages, self.sleep)
+
+    def _run(self) -> None:
+        jobs = [[self.run_backup, self.interval, 0.0]]
+        if self.replica_interval is not None:
+            jobs.append([self.run_replica, self.replica_interval, 0.0])
+        while not self._stop.is_set():
+            for job in jobs:
+                func, interval, due = job
+                if time.monotonic() < due:
+                    continue
+                try:
+                    self.results.append((func.__name__, func()))
+                except (OSError, sql.Error) as e:
+                    self.errors.append((func.__name__, f'{type(e).__name__}: {e}'))
+                job[2] = time.monotonic() + interval
+            self._stop.wait(max(min(due for _, _, due in jobs) - time.monotonic(), 0))
+        return None
+
+    def start(self) -> 'BackupScheduler':
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return None
+
+    def __enter__(self) -> 'BackupScheduler':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
@@ -0,0 +1,250 @@
+"""
+Benchmark suite of the public db_queries calls on synthetic databases at several scales (see synthetic_data). Every
+call is timed repeat times on a working copy of the generated database, the results are saved as JSON and can be
+compared with an earlier run to find regressions:
+
+    python benchmark_suite.py --scales 1k 100k --out results.json
+    python benchmark_suite.py --scales 1k 100k --out new.json --compare results.json
+
+Generated databases are kept in data_dir and reused by later runs with the same scale and seed.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+import db_builder
+import db_queries
+import synthetic_data
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'biocycle_synthetic')
+
+# number of rows written per call by the put_multiple_* cases
+BATCH_SIZE = 100
+
+RUN_QUERY = '''
+    SELECT objects.polymer_type, COUNT(*) AS n_objects FROM experiments
+    JOIN experiment_objects ON experiment_objects.experiment_id = experiments.experiment_id
+    JOIN objects ON objects.object_id = experiment_objects.object_id
+        WHERE experiments.session_id = ?
+    GROUP BY 1;
+    '''
+
+
+def dataset(scale, seed: int = 42, data_dir: str = DATA_DIR) -> str:
+    """
+    Return the path of the synthetic database of a scale, generating it if it does not exist yet.
+    :param scale: str (key of synthetic_data.SCALES) or int, number of experiments
+    :param seed: int (optional), seed of the generator
+    :param data_dir: str (optional), folder of the generated databases
+    :return: str, path to the database
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'synthetic_{scale}_{seed}.db')
+    if not os.path.exists(path):
+        partial = path + '.partial'
+        for leftover in (partial, partial + '-wal', partial + '-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        synthetic_data.generate_database(partial, synthetic_data.scale_size(scale), seed=seed)
+        os.replace(partial, path)
+    return path
+
+
+def _cases(db_path: str, repeat: int, rng: random.Random) -> Dict[str, Callable[[int], object]]:
+    """Set up the working copy for repeat calls of every case and return {name: call(i)}."""
+    con = db_builder.connections.get(db_path)
+    session_ids = [row[0] for row in con.execute('SELECT session_id FROM sessions;')]
+    object_ids = [row[0] for row in con.execute('SELECT object_id FROM objects;')]
+    container_ids = [row[0] for row in con.execute('SELECT container_id FROM containers;')]
+    experiments_per_session = con.execute('SELECT MAX(n_experiments) FROM stats_session_experiments;').fetchone()[0]
+
+    # sessions of the usual size to delete and experiments without objects to link, one per call
+    for i in range(repeat):
+        plan = pd.DataFrame({'session_id': f'D{i:05}',
+                             'experiment_id': [f'D{i:05}_{j:04}' for j in range(experiments_per_session)],
+                             'container_id': rng.choice(container_ids),
+                             'objects': [rng.sample(object_ids, 3) for _ in range(experiments_per_session)]})
+        db_queries.ingest_session_plan(plan, db_path=db_path)
+    db_queries.put_session('L0000', db_path=db_path)
+    db_queries.put_multiple_experiments(pd.DataFrame({'session_id': 'L0000',
+                                                      'experiment_id': [f'L{i:06}' for i in range(repeat)],
+                                                      'container_id': container_ids[0],
+                                                      'n_objects': 3}), db_path)
+
+    objects = synthetic_data.generate_objects(BATCH_SIZE, np.random.default_rng(0))
+    containers = synthetic_data.generate_containers(BATCH_SIZE, np.random.default_rng(0))
+
+    def batch(i: int) -> List[str]:
+        return [f'B{i:05}_{j:04}' for j in range(BATCH_SIZE)]
+
+    return {
+        'put_multiple_sessions': lambda i: db_queries.put_multiple_sessions(
+            pd.DataFrame({'session_id': batch(i), 'n_experiments': 10, 'note': None, 'responsible': 'benchmark',
+                          'start_date': None, 'end_date': None}), db_path),
+        'put_multiple_objects': lambda i: db_queries.put_multiple_objects(objects.assign(object_id=batch(i)),
+                                                                          db_path),
+        'put_multiple_containers': lambda i: db_queries.put_multiple_containers(
+            containers.assign(container_id=batch(i)), db_path),
+        'put_multiple_experiments': lambda i: db_queries.put_multiple_experiments(
+            pd.DataFrame({'session_id': rng.choice(session_ids), 'experiment_id': batch(i),
+                          'container_id': rng.choice(container_ids), 'n_objects': 3}), db_path),
+        'link_experiment_objects': lambda i: db_queries.link_experiment_objects(f'L{i:06}', rng.sample(object_ids, 3),
+                                                                                db_path),
+        'get_complete_session': lambda i: db_queries.get_complete_session(rng.choice(session_ids), db_path),
+        'get_object': lambda i: db_queries.get_object(rng.choice(object_ids), db_path),
+        'delete_session': lambda i: db_queries.delete_session(f'D{i:05}', db_path),
+        'run_query': lambda i: db_queries.run_query(RUN_QUERY, db_path, params=(rng.choice(session_ids),)),
+    }
+
+
+def _summary(seconds: List[float]) -> dict:
+    seconds = np.array(seconds) * 1e3
+    return {'calls': len(seconds),
+            'min_ms': float(seconds.min()),
+            'median_ms': float(np.median(seconds)),
+            'mean_ms': float(seconds.mean()),
+            'p95_ms': float(np.percentile(seconds, 95)),
+            'max_ms': float(seconds.max()),
+            'ops_per_s': float(1e3 / seconds.mean())}
+
+
+def run_scale(scale, repeat: int = 50, seed: int = 42, data_dir: str = DATA_DIR, cases: List[str] = None) -> dict:
+    """
+    Time every case repeat times on a working copy of the synthetic database of a scale.
+    :param scale: str (key of synthetic_data.SCALES) or int, number of experiments
+    :param repeat: int (optional), number of timed calls per case
+    :param seed: int (optional), seed of the generator and of the random arguments of the calls
+    :param data_dir: str (optional), folder of the generated databases
+    :param cases: List[str] (optional), names of the cases to run, all if None
+    :return: dict, {'dataset': {table: rows}, 'cases': {name: {'calls', 'min_ms', 'median_ms', 'mean_ms', 'p95_ms',
+    'max_ms', 'ops_per_s'}}}
+    """
+    source = dataset(scale, seed, data_dir)
+    work_dir = tempfile.mkdtemp(prefix='biocycle_suite_')
+    db_path = os.path.join(work_dir, os.path.basename(source))
+    shutil.copyfile(source, db_path)
+    try:
+        con = db_builder.connections.get(db_path)
+        sizes = {table: con.execute(f'SELECT COUNT(*) FROM {table};').fetchone()[0]
+                 for table in ('sessions', 'experiments', 'objects', 'containers', 'experiment_objects')}
+        calls = _cases(db_path, repeat, random.Random(seed))
+        result = {}
+        for name, call in calls.items():
+            if cases is not None and name not in cases:
+                continue
+            seconds = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                call(i)
+                seconds.append(time.perf_counter() - start)
+            result[name] = _summary(seconds)
+    finally:
+        db_builder.connections.close(db_path)
+        shutil.rmtree(work_dir)
+    return {'dataset': sizes, 'cases': result}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(scales: List = ('1k', '100k'), repeat: int = 50, seed: int = 42, data_dir: str = DATA_DIR,
+              cases: List[str] = None, out_path: str = None) -> dict:
+    """
+    Run the suite on all scales and save the results as JSON.
+    :param scales: List (optional), scales to run, keys of synthetic_data.SCALES or numbers of experiments
+    :param repeat: int (optional), number of timed calls per case
+    :param seed: int (optional), seed of the generator and of the random arguments of the calls
+    :param data_dir: str (optional), folder of the generated databases
+    :param cases: List[str] (optional), names of the cases to run, all if None
+    :param out_path: str (optional), JSON file the results are written to
+    :return: dict, {'meta': {...}, 'scales': {scale: run_scale(scale)}}
+    """
+    results = {'meta': {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                        'commit': _git_commit(),
+                        'python': platform.python_version(),
+                        'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count(),
+                        'repeat': repeat,
+                        'seed': seed},
+               'scales': {str(scale): run_scale(scale, repeat, seed, data_dir, cases) for scale in scales}}
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.2, stat: str = 'median_ms') -> List[dict]:
+    """
+    Return the cases whose stat got slower by more than threshold compared to a baseline run. min_ms is the least
+    noisy stat on a busy machine.
+    :param baseline: dict, results of run_suite or the path to their JSON file
+    :param current: dict, results of run_suite or the path to their JSON file
+    :param threshold: float (optional), relative slowdown that counts as regression, 0.2 = 20 %
+    :param stat: str (optional), compared value of the summaries, e.g. 'median_ms', 'min_ms' or 'p95_ms'
+    :return: List[dict], [{'scale', 'case', 'baseline_ms', 'current_ms', 'change'}, ...], slowest first
+    """
+    runs = []
+    for run in (baseline, current):
+        if isinstance(run, str):
+            with open(run) as f:
+                run = json.load(f)
+        runs.append(run)
+    baseline, current = runs
+
+    regressions = []
+    for scale, result in current['scales'].items():
+        for case, summary in result['cases'].items():
+            before = baseline['scales'].get(scale, {}).get('cases', {}).get(case)
+            if before is None:
+                continue
+            change = summary[stat] / before[stat] - 1
+            if change > threshold:
+                regressions.append({'scale': scale, 'case': case, 'baseline_ms': before[stat],
+                                    'current_ms': summary[stat], 'change': change})
+    return sorted(regressions, key=lambda regression: -regression['change'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scales', nargs='+', default=['1k', '100k'])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--cases', nargs='+')
+    parser.add_argument('--out', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON file of an earlier run, exit code 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--stat', default='median_ms', help='compared value, e.g. median_ms, min_ms or p95_ms')
+    args = parser.parse_args()
+
+    results = run_suite(args.scales, args.repeat, args.seed, args.data_dir, args.cases, args.out)
+    for scale, result in results['scales'].items():
+        print(f'{scale}: {result["dataset"]}')
+        for case, summary in result['cases'].items():
+            print(f'  {case:<26} median {summary["median_ms"]:9.3f} ms   p95 {summary["p95_ms"]:9.3f} ms')
+    if args.compare:
+        regressions = compare(args.compare, results, args.threshold, args.stat)
+        for regression in regressions:
+            print(f'regression {regression["scale"]} {regression["case"]}: {regression["baseline_ms"]:.3f} ms -> '
+                  f'{regression["current_ms"]:.3f} ms ({regression["change"]:+.0%})')
+        sys.exit(1 if regressions else 0)
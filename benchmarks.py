@@ -0,0 +1,1046 @@
+"""
+Micro-benchmarks for the tracker. Every benchmark builds its own temporary database, the live database in ./data is
+never touched. Run all benchmarks with `python benchmarks.py` or selected ones with `python benchmarks.py <name> ...`.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sqlite3 as sql
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import analytics_export
+import async_queries
+import backup
+import capture_jsons
+import capture_sync
+import catalog_import
+import create_experiments_helpers as helpers
+import db_builder
+import db_queries
+import instrumentation
+import stats
+
+
+def _temp_db(name: str = 'bench.db') -> str:
+    """
+    Create an empty database with the tracker schema in a fresh temporary folder.
+    :param name: str (optional), file name of the database
+    :return: str, path to the database
+    """
+    db_path = os.path.join(tempfile.mkdtemp(prefix='biocycle_bench_'), name)
+    db_builder.create_database_file(db_path)
+    db_builder.create_schema(db_path)
+    return db_path
+
+
+def _fill_objects(db_path: str, n_objects: int) -> list:
+    """Insert n_objects synthetic objects and return their ids."""
+    object_ids = [f'{i // 100}_{i % 100}' for i in range(n_objects)]
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.executemany('INSERT INTO objects (object_id, polymer_type, length) VALUES (?, ?, ?);',
+                        [(object_id, 'pe', 10.0) for object_id in object_ids])
+    return object_ids
+
+
+def _per_call(func, n_calls: int) -> float:
+    """Return the mean wall time in microseconds of n_calls calls of func(i)."""
+    start = time.perf_counter()
+    for i in range(n_calls):
+        func(i)
+    return (time.perf_counter() - start) / n_calls * 1e6
+
+
+def bench_connection_reuse(n_objects: int = 1000, n_calls: int = 5000) -> dict:
+    """
+    Per-call latency of get_object with a fresh connection per call (previous behaviour) and with the shared
+    connection manager.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, n_objects)
+
+    def connect_per_call(i):
+        con = sql.connect(db_path)
+        con.execute(f"SELECT * FROM objects WHERE object_id = '{object_ids[i % n_objects]}';").fetchall()
+        con.close()
+
+    def shared_connection(i):
+        db_queries.get_object(object_ids[i % n_objects], db_path)
+
+    result = {'connect_per_call_us': _per_call(connect_per_call, n_calls),
+              'shared_connection_us': _per_call(shared_connection, n_calls)}
+    db_builder.connections.close(db_path)
+    return result
+
+
+def _session_plan(object_ids: list, n_experiments: int, n_objects: int, session_id: str = 'S0000') -> pd.DataFrame:
+    """Build a session plan frame (session_id, experiment_id, container_id, objects) with a fixed number of objects."""
+    return pd.DataFrame({
+        'session_id': [session_id] * n_experiments,
+        'experiment_id': [f'E{i:04}' for i in range(n_experiments)],
+        'container_id': ['CO-01'] * n_experiments,
+        'objects': [[object_ids[(i * n_objects + j) % len(object_ids)] for j in range(n_objects)]
+                    for i in range(n_experiments)],
+    })
+
+
+def bench_ingest_session_plan(n_experiments: int = 1000, n_objects: int = 3) -> dict:
+    """
+    Rows per second written by put_session, put_multiple_experiments and one link_experiment_objects call per
+    experiment (previous notebook flow) compared to a single ingest_session_plan call.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 1000)
+    plan = _session_plan(object_ids, n_experiments, n_objects)
+    n_rows = 1 + n_experiments * (1 + n_objects)
+
+    start = time.perf_counter()
+    db_queries.put_session('S0000', n_experiments, db_path=db_path)
+    experiments = plan[['session_id', 'experiment_id', 'container_id']].assign(n_objects=n_objects)
+    db_queries.put_multiple_experiments(experiments, db_path)
+    for _, row in plan.iterrows():
+        db_queries.link_experiment_objects(row['experiment_id'], row['objects'], db_path)
+    per_call = time.perf_counter() - start
+
+    db_queries.delete_session('S0000', db_path)
+    start = time.perf_counter()
+    db_queries.ingest_session_plan(plan, db_path=db_path)
+    single_transaction = time.perf_counter() - start
+
+    db_builder.connections.close(db_path)
+    return {'rows': n_rows,
+            'per_call_rows_per_s': n_rows / per_call,
+            'single_transaction_rows_per_s': n_rows / single_transaction}
+
+
+def bench_secondary_indexes(n_experiments: int = 20000, n_objects: int = 3, n_calls: int = 200) -> dict:
+    """
+    Per-call latency of the db_builder.INDEXED_QUERIES on a database without secondary indexes (schema version 0)
+    and after db_builder.migrate. Sessions hold 10 experiments, there are 50 containers and 20 polymer types.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 5000)
+    plan = _session_plan(object_ids, n_experiments, n_objects)
+    plan['session_id'] = [f'S{i // 10:04}' for i in range(n_experiments)]
+    plan['container_id'] = [f'CO-{i % 50:02}' for i in range(n_experiments)]
+    db_queries.ingest_session_plan(plan, db_path=db_path)
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.execute("UPDATE objects SET polymer_type = 'p' || (rowid % 20);")
+    for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%';").fetchall():
+        con.execute(f'DROP INDEX {name};')
+    con.execute('DROP TABLE schema_version;')
+
+    queries = db_builder.INDEXED_QUERIES
+
+    def run_indexed_queries(i):
+        con.execute(queries['session_experiments'][0], (f'S{i % 2000:04}',)).fetchall()
+        con.execute(queries['object_history'][0], (object_ids[i],)).fetchall()
+        con.execute(queries['objects_by_polymer_type'][0], (f'p{i % 20}',)).fetchall()
+        con.execute(queries['container_experiments'][0], (f'CO-{i % 50:02}',)).fetchall()
+
+    result = {'full_scans_before': len(db_builder.check_query_plans(db_path)),
+              'without_indexes_us': _per_call(run_indexed_queries, n_calls)}
+    db_builder.migrate(db_path)
+    result.update({'full_scans_after': len(db_builder.check_query_plans(db_path)),
+                   'with_indexes_us': _per_call(run_indexed_queries, n_calls)})
+    db_builder.connections.close(db_path)
+    return result
+
+
+def bench_generate_session_plan(n_experiments: int = 100000, n_objects: int = 200, n_loop: int = 500) -> dict:
+    """
+    Wall time of generate_session_plan for n_experiments, uniform and stratified, compared to the previous
+    per-experiment sampling loop of create_experiments.ipynb (timed on n_loop experiments, it is quadratic).
+    """
+    objects = pd.DataFrame({'object_id': [f'{i // 10}_{i % 10}' for i in range(n_objects)],
+                            'polymer_type': [f'p{i % 8}' for i in range(n_objects)]})
+    containers = ['CO-06', 'DI-07', 'DI-05', 'DI-11', 'CO-03', 'CO-04']
+    experiment_ids = [f'E{i:04}' for i in range(n_experiments)]
+    distribution = helpers.load_scipy_distribution_by_name('alpha', {'a': 4})
+
+    start = time.perf_counter()
+    lengths = helpers.get_experiment_lengths(distribution, n_loop, 2, 5)
+    loop_plan = pd.DataFrame(columns=['session_id', 'experiment_id', 'container_id', 'objects', 'n_objects'])
+    for i, n in enumerate(lengths):
+        ids = objects.sample(n=n, replace=False, random_state=i)['object_id'].values.tolist()
+        loop_plan.loc[len(loop_plan)] = {'session_id': 'S0000', 'experiment_id': experiment_ids[i],
+                                         'container_id': containers[i % len(containers)], 'objects': ids,
+                                         'n_objects': len(ids)}
+    loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    helpers.generate_session_plan('S0000', experiment_ids, objects, containers, 2, 5, distribution=distribution)
+    uniform = time.perf_counter() - start
+
+    start = time.perf_counter()
+    helpers.generate_session_plan('S0000', experiment_ids, objects, containers, 2, 5, distribution=distribution,
+                                  stratify_column='polymer_type')
+    stratified = time.perf_counter() - start
+
+    return {'loop_us_per_experiment': loop / n_loop * 1e6,
+            'vectorized_us_per_experiment': uniform / n_experiments * 1e6,
+            'vectorized_s': uniform,
+            'stratified_s': stratified}
+
+
+def bench_export_session_jsons(n_experiments: int = 1000, n_objects: int = 3) -> dict:
+    """
+    Files per second written by export_session_jsons with one and with eight writer threads, and of a re-export
+    where no file changed.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 1000)
+    db_queries.ingest_session_plan(_session_plan(object_ids, n_experiments, n_objects), db_path=db_path)
+    out_dir = os.path.dirname(db_path)
+
+    single = capture_jsons.export_session_jsons('S0000', os.path.join(out_dir, 'single'), 1, db_path)
+    parallel = capture_jsons.export_session_jsons('S0000', os.path.join(out_dir, 'parallel'), 8, db_path)
+    unchanged = capture_jsons.export_session_jsons('S0000', os.path.join(out_dir, 'parallel'), 8, db_path)
+
+    db_builder.connections.close(db_path)
+    return {'files': single['files'],
+            'one_worker_files_per_s': single['files_per_s'],
+            'eight_workers_files_per_s': parallel['files_per_s'],
+            'unchanged_files_per_s': unchanged['files_per_s']}
+
+
+def _peak_rss_mb(code: str) -> float:
+    """
+    Run code in a fresh interpreter in this folder and return its peak resident set size in MB (Linux only). VmHWM is
+    used instead of ru_maxrss, which also includes the peak RSS of this process when the child is spawned.
+    """
+    code += "\nprint([line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM')][0])"
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return int(output.split()[-1]) / 1024
+
+
+def bench_streaming_queries(row_counts: tuple = (100000, 1000000), chunksize: int = 10000) -> dict:
+    """
+    Peak RSS of reading all of experiment_objects with run_query compared to iter_query and iter_experiment_objects,
+    for growing table sizes. The baseline is the peak RSS of the interpreter after the imports. mmap is switched off,
+    mapped pages of the database file would otherwise count towards the RSS of every variant.
+    """
+    imports = "import db_builder, db_queries; db_builder.PRAGMAS['mmap_size'] = 0"
+    result = {'baseline_mb': _peak_rss_mb(imports)}
+    for n_rows in row_counts:
+        db_path = _temp_db()
+        con = db_builder.connections.get(db_path)
+        with con:
+            con.executemany('INSERT INTO experiments (experiment_id) VALUES (?);',
+                            ((f'E{i:07}',) for i in range((n_rows + 3) // 4)))
+            con.executemany('INSERT INTO experiment_objects (experiment_id, object_id) VALUES (?, ?);',
+                            ((f'E{i // 4:07}', f'{i % 4}_{i % 1000}') for i in range(n_rows)))
+        db_builder.connections.close(db_path)
+        query = "'SELECT * FROM experiment_objects'"
+        result[n_rows] = {
+            'run_query_mb': _peak_rss_mb(f'{imports}; db_queries.run_query({query}, {db_path!r})'),
+            'iter_query_mb': _peak_rss_mb(f'{imports}\n'
+                                          f'for chunk in db_queries.iter_query({query}, chunksize={chunksize}, '
+                                          f'db_path={db_path!r}): pass'),
+            'iter_rows_mb': _peak_rss_mb(f'{imports}\n'
+                                         f'for rows in db_queries.iter_experiment_objects({chunksize}, {db_path!r}): '
+                                         f'pass'),
+        }
+    return result
+
+
+def bench_bound_parameters(n_objects: int = 1000, n_calls: int = 5000) -> dict:
+    """
+    Per-call latency of get_object and put_object with values interpolated into the SQL text (previous behaviour,
+    every call parses a new statement) and with bound parameters served from the statement cache.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, n_objects)
+    con = db_builder.connections.get(db_path)
+
+    def get_interpolated(i):
+        con.execute(f"SELECT * FROM objects WHERE object_id = '{object_ids[i % n_objects]}';").fetchall()
+
+    def get_bound(i):
+        db_queries.get_object(object_ids[i % n_objects], db_path)
+
+    def put_interpolated(i):
+        with con:
+            con.execute(f"INSERT INTO objects (object_id, polymer_type, length) VALUES ('f{i}', 'pe', {i});")
+
+    def put_bound(i):
+        db_queries.put_object(f'b{i}', 'pe', i, db_path=db_path)
+
+    result = {'get_interpolated_us': _per_call(get_interpolated, n_calls),
+              'get_bound_us': _per_call(get_bound, n_calls),
+              'put_interpolated_us': _per_call(put_interpolated, n_calls),
+              'put_bound_us': _per_call(put_bound, n_calls)}
+    db_builder.connections.close(db_path)
+    return result
+
+
+def bench_batch_fetch(n_objects: int = 10000, n_sessions: int = 100) -> dict:
+    """
+    Wall time of fetching n_objects objects with one get_object call per id compared to one get_objects call, and of
+    n_sessions sessions with get_complete_session per id compared to get_complete_sessions.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, n_objects)
+    plan = _session_plan(object_ids, n_sessions * 10, 3)
+    plan['session_id'] = [f'S{i // 10:04}' for i in range(len(plan))]
+    db_queries.ingest_session_plan(plan, db_path=db_path)
+    session_ids = [f'S{i:04}' for i in range(n_sessions)]
+
+    start = time.perf_counter()
+    per_id = {object_id: db_queries.get_object(object_id, db_path) for object_id in object_ids}
+    objects_per_id = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = db_queries.get_objects(object_ids, db_path)
+    objects_batch = time.perf_counter() - start
+    assert len(per_id) == len(batch)
+
+    start = time.perf_counter()
+    for session_id in session_ids:
+        db_queries.get_complete_session(session_id, db_path)
+    sessions_per_id = time.perf_counter() - start
+    start = time.perf_counter()
+    db_queries.get_complete_sessions(session_ids, db_path)
+    sessions_batch = time.perf_counter() - start
+
+    db_builder.connections.close(db_path)
+    return {'objects_per_id_ms': objects_per_id * 1e3, 'objects_batch_ms': objects_batch * 1e3,
+            'sessions_per_id_ms': sessions_per_id * 1e3, 'sessions_batch_ms': sessions_batch * 1e3}
+
+
+def bench_complete_session(n_experiments: int = 10000, n_objects: int = 3, n_repeats: int = 25) -> dict:
+    """
+    Best of n_repeats wall times of loading a session of n_experiments with the previous GROUP_CONCAT query plus
+    splitting in Python (and get_objects for the attributes, assembled into the same lists of dicts) compared to
+    get_complete_session with and without include_objects.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 5000)
+    db_queries.ingest_session_plan(_session_plan(object_ids, n_experiments, n_objects), db_path=db_path)
+    con = db_builder.connections.get(db_path)
+    group_concat = '''
+        SELECT sessions.session_id, experiments.experiment_id, experiments.container_id,
+               GROUP_CONCAT(experiment_objects.object_id) AS object_list
+            FROM sessions
+        JOIN experiments ON sessions.session_id = experiments.session_id
+        JOIN experiment_objects ON experiments.experiment_id = experiment_objects.experiment_id
+            WHERE sessions.session_id = ?
+            GROUP BY experiments.experiment_id;
+        '''
+
+    def split():
+        return [(*row[:3], row[3].split(',')) for row in con.execute(group_concat, ('S0000',)).fetchall()]
+
+    def split_and_lookup():
+        rows = split()
+        objects = db_queries.get_objects([object_id for row in rows for object_id in row[3]], db_path)
+        return [(*row[:3], [dict(zip(db_queries.ObjectRow._fields, objects[object_id])) for object_id in row[3]])
+                for row in rows]
+
+    timings = {name: min(_per_call(lambda i: func(), 1) for _ in range(n_repeats)) / 1e3 for name, func in [
+        ('group_concat_split_ms', split),
+        ('group_concat_split_lookup_ms', split_and_lookup),
+        ('get_complete_session_ms', lambda: db_queries.get_complete_session('S0000', db_path)),
+        ('get_complete_session_include_objects_ms',
+         lambda: db_queries.get_complete_session('S0000', db_path, include_objects=True)),
+    ]}
+
+    db_builder.connections.close(db_path)
+    return timings
+
+
+def bench_entity_cache(n_objects: int = 50000) -> dict:
+    """
+    Per-call latency of get_object over all n_objects ids with the cache disabled (maxsize 0), on a cold cache and
+    on a warm cache, with data_version read on every lookup and at most every 100 ms, plus the cache statistics.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, n_objects)
+    cache = db_queries.cache
+    maxsize, version_interval = cache.maxsize, cache.version_interval
+
+    def get(i):
+        db_queries.get_object(object_ids[i], db_path)
+
+    cache.clear()
+    cache.maxsize = 0
+    result = {'disabled_us': _per_call(get, n_objects)}
+    cache.maxsize = max(maxsize, n_objects)
+    for interval in (0.0, 0.1):
+        cache.clear()
+        cache.version_interval = interval
+        result[f'interval_{interval}'] = {'cold_us': _per_call(get, n_objects), 'warm_us': _per_call(get, n_objects),
+                                          **cache.stats()}
+
+    cache.maxsize, cache.version_interval = maxsize, version_interval
+    cache.clear()
+    db_builder.connections.close(db_path)
+    return result
+
+
+def bench_async_queries(n_sessions: int = 200, n_experiments: int = 10, n_readers: int = 32,
+                        seconds: float = 2.0) -> dict:
+    """
+    Load test: n_readers coroutines call get_complete_session on random sessions while one coroutine keeps adding
+    experiments with put_experiment and link_experiment_objects. Compares blocking db_queries calls inside the
+    coroutines with AsyncQueries without and with request batching. Reports reads and writes per second and the
+    99th percentile of the event loop lag seen by a 1 ms ticker. Blocking calls read the most per second, AsyncQueries
+    wins on writes and loop lag, see the README.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 1000)
+    plan = pd.concat([_session_plan(object_ids, n_experiments, 3, f'S{s:04}') for s in range(n_sessions)],
+                     ignore_index=True)
+    plan['experiment_id'] = [f'E{i:06}' for i in range(len(plan))]
+    db_queries.ingest_session_plan(plan, db_path=db_path)
+    db_queries.put_session('S9999', db_path=db_path)
+    session_ids = [f'S{s:04}' for s in range(n_sessions)]
+
+    async def run(queries) -> dict:
+        counts = {'reads': 0, 'writes': 0}
+        lags = []
+        end = time.perf_counter() + seconds
+
+        async def reader(rng):
+            while time.perf_counter() < end:
+                session_id = rng.choice(session_ids)
+                if queries is None:
+                    db_queries.get_complete_session(session_id, db_path)
+                else:
+                    await queries.get_complete_session(session_id)
+                counts['reads'] += 1
+                await asyncio.sleep(0)
+
+        async def writer():
+            while time.perf_counter() < end:
+                experiment_id = f'W{counts["writes"]:06}'
+                if queries is None:
+                    db_queries.put_experiment(experiment_id, 'S9999', 'CO-01', 3, db_path)
+                    db_queries.link_experiment_objects(experiment_id, object_ids[:3], db_path)
+                else:
+                    await queries.put_experiment(experiment_id, 'S9999', 'CO-01', 3)
+                    await queries.link_experiment_objects(experiment_id, object_ids[:3])
+                counts['writes'] += 1
+                await asyncio.sleep(0)
+
+        async def ticker():
+            while time.perf_counter() < end:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - start - 0.001)
+
+        start = time.perf_counter()
+        await asyncio.gather(writer(), ticker(), *(reader(random.Random(i)) for i in range(n_readers)))
+        elapsed = time.perf_counter() - start
+        if queries is not None:
+            await queries.close()
+        con = db_builder.connections.get(db_path)
+        with con:
+            con.execute("DELETE FROM experiment_objects WHERE experiment_id GLOB 'W*';")
+            con.execute("DELETE FROM experiments WHERE experiment_id GLOB 'W*';")
+        return {'reads_per_s': counts['reads'] / elapsed,
+                'writes_per_s': counts['writes'] / elapsed,
+                'p99_loop_lag_ms': sorted(lags)[int(len(lags) * 0.99)] * 1000}
+
+    result = {'blocking': asyncio.run(run(None)),
+              'async': asyncio.run(run(async_queries.AsyncQueries(db_path, batching=False))),
+              'async_batched': asyncio.run(run(async_queries.AsyncQueries(db_path)))}
+    db_builder.connections.close(db_path)
+    return result
+
+
+def bench_catalog_import(row_counts: tuple = (100000, 1000000), chunksize: int = 10000) -> dict:
+    """
+    Rows per second of import_objects for a CSV catalog into an empty database (all inserts) and of a second import
+    of the same file with every tenth length changed (updates and unchanged rows), plus the peak RSS of the first
+    import in a fresh interpreter (mmap switched off, see bench_streaming_queries), for growing catalogs.
+    """
+    result = {'baseline_mb': _peak_rss_mb('import catalog_import')}
+    for n_rows in row_counts:
+        db_path = _temp_db()
+        csv_path = os.path.join(os.path.dirname(db_path), 'catalog.csv')
+        catalog = pd.DataFrame({'Locator': [f'{i // 100}_{i % 100}' for i in range(n_rows)],
+                                'Type': 'pe', 'Length': 10.0, 'Color': 'red', 'Note': 'synthetic'})
+        catalog.to_csv(csv_path, index=False)
+        rss = _peak_rss_mb(f"import db_builder; db_builder.PRAGMAS['mmap_size'] = 0\n"
+                           f'import catalog_import; catalog_import.import_objects({csv_path!r}, {chunksize}, '
+                           f'db_path={db_path!r})')
+        with db_builder.connections.get(db_path) as con:
+            con.execute('DELETE FROM objects;')
+        first = catalog_import.import_objects(csv_path, chunksize, db_path=db_path)
+        catalog.loc[::10, 'Length'] = 11.0
+        catalog.to_csv(csv_path, index=False)
+        second = catalog_import.import_objects(csv_path, chunksize, db_path=db_path)
+        db_builder.connections.close(db_path)
+        result[n_rows] = {'insert_rows_per_s': first['rows_per_s'],
+                          'merge_rows_per_s': second['rows_per_s'],
+                          'updated': second['updated'],
+                          'unchanged': second['unchanged'],
+                          'peak_rss_mb': rss}
+    return result
+
+
+def bench_analytics_export(n_sessions: int = 200, n_experiments: int = 100, n_objects: int = 5) -> dict:
+    """
+    Rows per second of a full export_graph, time of an incremental export after one session changed, and time to
+    get length by polymer type from the memory-mapped Parquet export compared to a run_query join over the database.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 10000)
+    for s in range(n_sessions):
+        plan = _session_plan(object_ids[s * 50:], n_experiments, n_objects, f'S{s:04}')
+        plan['experiment_id'] = [f'E{s:04}_{i:03}' for i in range(n_experiments)]
+        db_queries.ingest_session_plan(plan, db_path=db_path)
+    out_dir = os.path.join(os.path.dirname(db_path), 'export')
+
+    full = analytics_export.export_graph(out_dir, db_path=db_path)
+    db_queries.put_experiment('E9999', 'S0000', 'CO-01', 0, db_path)
+    incremental = analytics_export.export_graph(out_dir, db_path=db_path)
+
+    start = time.perf_counter()
+    db_queries.run_query('''
+        SELECT objects.polymer_type, objects.length FROM experiments
+        JOIN experiment_objects ON experiment_objects.experiment_id = experiments.experiment_id
+        JOIN objects ON objects.object_id = experiment_objects.object_id;
+        ''', db_path).groupby('polymer_type')['length'].mean()
+    run_query_s = time.perf_counter() - start
+    start = time.perf_counter()
+    table = analytics_export.read_export(out_dir, ['polymer_type', 'length'])
+    table.to_pandas().groupby('polymer_type')['length'].mean()
+    parquet_s = time.perf_counter() - start
+
+    db_builder.connections.close(db_path)
+    return {'rows': full['rows'],
+            'full_rows_per_s': full['rows_per_s'],
+            'full_s': full['seconds'],
+            'incremental_s': incremental['seconds'],
+            'incremental_sessions': incremental['sessions'],
+            'scan_run_query_s': run_query_s,
+            'scan_parquet_s': parquet_s}
+
+
+def bench_stats(n_sessions: int = 200, n_experiments: int = 100, n_objects: int = 5, n_calls: int = 200) -> dict:
+    """
+    Per-call latency of the dashboard questions answered from the summary tables of the stats module compared to
+    the same answers computed by joins over experiment_objects.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 10000)
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.executemany('UPDATE objects SET polymer_type = ? WHERE object_id = ?;',
+                        [(('pe', 'pp', 'ps', 'pet')[i % 4], object_id) for i, object_id in enumerate(object_ids)])
+        con.executemany('INSERT INTO containers (container_id, material_type) VALUES (?, ?);',
+                        [(f'CO-{i:02}', ('compost', 'digestive')[i % 2]) for i in range(20)])
+    for s in range(n_sessions):
+        plan = _session_plan(object_ids[s * 50:], n_experiments, n_objects, f'S{s:04}')
+        plan['experiment_id'] = [f'E{s:04}_{i:03}' for i in range(n_experiments)]
+        plan['container_id'] = [f'CO-{i % 20:02}' for i in range(n_experiments)]
+        db_queries.ingest_session_plan(plan, responsible=('Alice', 'Bob')[s % 2], db_path=db_path)
+
+    joins = {
+        'object_usage': ('SELECT COUNT(*) FROM experiment_objects WHERE object_id = ?;', (object_ids[7],)),
+        'session_polymers': ('''SELECT objects.polymer_type, COUNT(*) FROM experiments
+            JOIN experiment_objects ON experiment_objects.experiment_id = experiments.experiment_id
+            JOIN objects ON objects.object_id = experiment_objects.object_id
+            WHERE experiments.session_id = ? GROUP BY 1;''', ('S0007',)),
+        'polymer_mix_by_material_type': ('''SELECT containers.material_type, objects.polymer_type, COUNT(*)
+            FROM experiment_objects
+            JOIN experiments ON experiments.experiment_id = experiment_objects.experiment_id
+            JOIN objects ON objects.object_id = experiment_objects.object_id
+            JOIN containers ON containers.container_id = experiments.container_id GROUP BY 1, 2;''', ()),
+        'experiments_by_responsible': ('''SELECT sessions.responsible, COUNT(DISTINCT sessions.session_id), COUNT(*)
+            FROM sessions JOIN experiments ON experiments.session_id = sessions.session_id GROUP BY 1;''', ()),
+    }
+    summaries = {
+        'object_usage': lambda: stats.object_usage(object_ids[7], db_path),
+        'session_polymers': lambda: stats.session_polymer_histogram('S0007', db_path),
+        'polymer_mix_by_material_type': lambda: stats.polymer_mix_by_material_type(db_path),
+        'experiments_by_responsible': lambda: stats.experiments_by_responsible(db_path),
+    }
+    result = {}
+    for name, (query, params) in joins.items():
+        n = n_calls if name in ('object_usage', 'session_polymers') else n_calls // 20
+        result[name] = {'join_us': _per_call(lambda _: con.execute(query, params).fetchall(), n),
+                        'summary_us': _per_call(lambda _: summaries[name](), n)}
+    result['check'] = stats.check_summaries(db_path)
+    db_builder.connections.close(db_path)
+    return result
+
+
+def bench_balanced_sampler(n_objects: int = 100000, n_experiments: int = 10000, n_pool: int = 1000,
+                           n_sessions: int = 20) -> dict:
+    """
+    Wall time of generate_session_plan with balance_usage for n_experiments over n_objects, usage read from the
+    database after a uniform session. Balance is measured on a pool of n_pool objects over n_sessions sessions:
+    spread (max - min) of the usage per object within a polymer type with the balanced and the uniform sampler,
+    largest deviation of the polymer shares from the quotas and number of objects used twice in one experiment.
+    """
+    types = ('pe', 'pp', 'ps', 'pet')
+    quotas = {'pe': 4, 'pp': 3, 'ps': 2, 'pet': 1}
+    containers = ['CO-06', 'DI-07', 'DI-05', 'DI-11', 'CO-03', 'CO-04']
+
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, n_objects)
+    objects = pd.DataFrame({'object_id': object_ids, 'polymer_type': [types[i % 4] for i in range(n_objects)]})
+    experiment_ids = [f'E0_{i}' for i in range(n_experiments)]
+    plan = helpers.generate_session_plan('S0000', experiment_ids, objects, containers, 2, 5)
+    db_queries.ingest_session_plan(plan, db_path=db_path)
+    start = time.perf_counter()
+    helpers.generate_session_plan('S0001', [f'E1_{i}' for i in range(n_experiments)], objects, containers, 2, 5,
+                                  balance_usage=True, quotas=quotas, db_path=db_path)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    stats.usage_counts(db_path)
+    usage_seconds = time.perf_counter() - start
+    db_builder.connections.close(db_path)
+
+    pool = objects.iloc[:n_pool]
+    result = {'seconds': seconds, 'usage_query_s': usage_seconds}
+    for balanced in (False, True):
+        usage = dict.fromkeys(pool['object_id'], 0)
+        n_duplicates = 0
+        for s in range(n_sessions):
+            plan = helpers.generate_session_plan(f'S{s:04}', [f'E{s}_{i}' for i in range(n_pool // 4)], pool,
+                                                 containers, 2, 5, random_state=s, balance_usage=balanced,
+                                                 usage=usage, quotas=quotas if balanced else None)
+            for ids in plan['objects']:
+                n_duplicates += len(ids) - len(set(ids))
+                for object_id in ids:
+                    usage[object_id] += 1
+        name = 'balanced' if balanced else 'uniform'
+        used = pd.Series(usage).groupby(pool.set_index('object_id')['polymer_type'])
+        result[f'{name}_spread'] = int((used.max() - used.min()).max())
+        shares = used.sum() / sum(usage.values())
+        result[f'{name}_quota_error'] = max(float(abs(shares[key] - weight / sum(quotas.values())))
+                                            for key, weight in quotas.items())
+        result[f'{name}_duplicates'] = n_duplicates
+    return result
+
+
+def bench_delete_experiments(n_experiments: int = 10000, n_objects: int = 3, n_loop: int = 1000) -> dict:
+    """
+    Experiments per second deleted by delete_experiments in one transaction compared to the previous
+    delete_experiment, which checked that the experiment exists and committed one DELETE per table (timed on n_loop
+    experiments).
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 1000)
+    plan = _session_plan(object_ids, n_experiments, n_objects)
+    db_queries.ingest_session_plan(plan, db_path=db_path)
+    experiment_ids = plan['experiment_id'].tolist()
+    con = db_builder.connections.get(db_path)
+
+    start = time.perf_counter()
+    for experiment_id in experiment_ids[:n_loop]:
+        assert db_queries.get_experiment(experiment_id, db_path) != []
+        with con:
+            con.execute('DELETE FROM experiment_objects WHERE experiment_id = ?;', (experiment_id,))
+        with con:
+            con.execute('DELETE FROM experiments WHERE experiment_id = ?;', (experiment_id,))
+    loop = time.perf_counter() - start
+
+    with con:
+        con.executemany('INSERT INTO experiments (session_id, experiment_id, container_id) VALUES (?, ?, ?);',
+                        plan[['session_id', 'experiment_id', 'container_id']][:n_loop].itertuples(index=False))
+        con.executemany('INSERT INTO experiment_objects (experiment_id, object_id) VALUES (?, ?);',
+                        [(row.experiment_id, object_id) for row in plan[:n_loop].itertuples()
+                         for object_id in row.objects])
+    start = time.perf_counter()
+    counts = db_queries.delete_experiments(experiment_ids, db_path)
+    bulk = time.perf_counter() - start
+    orphans = con.execute('SELECT COUNT(*) FROM experiment_objects;').fetchone()[0]
+
+    db_builder.connections.close(db_path)
+    return {'per_call_experiments_per_s': n_loop / loop,
+            'bulk_experiments_per_s': n_experiments / bulk,
+            'bulk_s': bulk,
+            'deleted': counts,
+            'orphaned_links': orphans}
+
+
+def bench_instrumentation(n_sessions: int = 20, n_experiments: int = 100, n_calls: int = 5000) -> dict:
+    """
+    Per-call latency of get_experiment and get_complete_session before instrumentation.enable(), while enabled and
+    after disable(), and the number of calls in the slow-query log with a threshold of 0 ms.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 1000)
+    for s in range(n_sessions):
+        plan = _session_plan(object_ids, n_experiments, 3, f'S{s:04}')
+        plan['experiment_id'] = [f'E{s:04}_{i:03}' for i in range(n_experiments)]
+        db_queries.ingest_session_plan(plan, db_path=db_path)
+
+    def get_experiment(i):
+        db_queries.get_experiment(f'E{i % n_sessions:04}_{i % n_experiments:03}', db_path)
+
+    def get_complete_session(i):
+        db_queries.get_complete_session(f'S{i % n_sessions:04}', db_path)
+
+    result = {}
+    for name, func, n in [('get_experiment', get_experiment, n_calls),
+                          ('get_complete_session', get_complete_session, n_calls // 20)]:
+        before = _per_call(func, n)
+        instrumentation.enable(slow_ms=1e9)
+        enabled = _per_call(func, n)
+        instrumentation.disable()
+        result[name] = {'before_us': before, 'enabled_us': enabled, 'disabled_us': _per_call(func, n)}
+    result['histograms'] = {name: {key: summary[key] for key in ('calls', 'p50_ms', 'p99_ms', 'rows_returned')}
+                            for name, summary in instrumentation.registry.snapshot().items()}
+
+    instrumentation.registry.reset()
+    slow_log_path = os.path.join(os.path.dirname(db_path), 'slow_queries.jsonl')
+    instrumentation.enable(slow_ms=0, slow_log_path=slow_log_path)
+    for i in range(10):
+        get_complete_session(i)
+    instrumentation.disable()
+    with open(slow_log_path) as f:
+        result['slow_log_lines'] = sum(1 for _ in f)
+    result['slow_log_plan'] = instrumentation.registry.slow_calls[0]['sql'][0]['plan']
+    instrumentation.registry.reset()
+    db_builder.connections.close(db_path)
+    return result
+
+
+def _contention_worker(role: str, db_path: str, journal_mode: str, read_only: bool, n_sessions: int, seconds: float,
+                       barrier, results) -> None:
+    """Reader or writer process of bench_contention, puts (role, operations, p99 latency in ms, errors) on results."""
+    db_builder.connections = db_builder.ConnectionManager({**db_builder.PRAGMAS, 'journal_mode': journal_mode},
+                                                          read_only=read_only and role == 'reader')
+    rng = random.Random(os.getpid())
+    latencies, errors = [], 0
+    barrier.wait()
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            if role == 'reader':
+                db_queries.get_complete_session(f'S{rng.randrange(n_sessions):04}', db_path)
+            else:
+                experiment_id = f'W{len(latencies):06}'
+                db_queries.put_experiment(experiment_id, 'S0000', 'CO-01', 3, db_path)
+                db_queries.link_experiment_objects(experiment_id, ['0_1', '0_2', '0_3'], db_path)
+        except sql.OperationalError:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    results.put((role, len(latencies), latencies[int(len(latencies) * 0.99)] * 1e3 if latencies else 0.0, errors))
+    db_builder.connections.close_all()
+    return None
+
+
+def bench_contention(n_readers: int = 4, n_sessions: int = 20, n_experiments: int = 100, seconds: float = 3.0) -> dict:
+    """
+    n_readers reader processes calling get_complete_session and one writer process adding experiments, all on the
+    same database file, with the rollback journal and with WAL, and with WAL and read-only reader connections.
+    Reports reads and writes per second, their 99th percentile latency and the calls that failed with a lock error.
+    """
+    context = multiprocessing.get_context('spawn')
+    result = {}
+    for journal_mode, read_only in [('DELETE', False), ('WAL', False), ('WAL', True)]:
+        db_path = _temp_db()
+        object_ids = _fill_objects(db_path, 1000)
+        for s in range(n_sessions):
+            plan = _session_plan(object_ids, n_experiments, 3, f'S{s:04}')
+            plan['experiment_id'] = [f'E{s:04}_{i:03}' for i in range(n_experiments)]
+            db_queries.ingest_session_plan(plan, db_path=db_path)
+        con = db_builder.connections.get(db_path)
+        con.execute(f'PRAGMA journal_mode = {journal_mode};')
+        db_builder.connections.close(db_path)
+
+        barrier = context.Barrier(n_readers + 1)
+        results = context.Queue()
+        processes = [context.Process(target=_contention_worker, args=(role, db_path, journal_mode, read_only,
+                                                                      n_sessions, seconds, barrier, results))
+                     for role in ['writer'] + ['reader'] * n_readers]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        reads = [outcome for outcome in outcomes if outcome[0] == 'reader']
+        write = next(outcome for outcome in outcomes if outcome[0] == 'writer')
+        result[f'{journal_mode.lower()}{"_read_only" if read_only else ""}'] = {
+            'reads_per_s': sum(outcome[1] for outcome in reads) / seconds,
+            'read_p99_ms': max(outcome[2] for outcome in reads),
+            'read_errors': sum(outcome[3] for outcome in reads),
+            'writes_per_s': write[1] / seconds,
+            'write_p99_ms': write[2],
+            'write_errors': write[3],
+        }
+    return result
+
+
+def bench_capture_sync(n_sessions: int = 100, n_experiments: int = 100, n_changed: int = 10) -> dict:
+    """
+    Time of sync_status over the exported folders of n_sessions sessions: the first sync that parses every data.json,
+    a re-sync without changes, which only compares modification times and sizes, and a re-sync after the capture
+    software changed n_changed files.
+    """
+    db_path = _temp_db()
+    object_ids = _fill_objects(db_path, 1000)
+    out_dir = os.path.join(os.path.dirname(db_path), 'export')
+    for s in range(n_sessions):
+        plan = _session_plan(object_ids, n_experiments, 3, f'S{s:04}')
+        plan['experiment_id'] = [f'E{s:04}_{i:03}' for i in range(n_experiments)]
+        db_queries.ingest_session_plan(plan, db_path=db_path)
+        capture_jsons.export_session_jsons(f'S{s:04}', out_dir, 8, db_path)
+
+    first = capture_sync.sync_status(out_dir, db_path=db_path)
+    unchanged = capture_sync.sync_status(out_dir, db_path=db_path)
+    for i in range(n_changed):
+        path = os.path.join(out_dir, f'S{i:04}', f'E{i:04}_000', 'data.json')
+        with open(path) as f:
+            data = json.load(f)
+        data.update(status='done', aligned=True)
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=4)
+    changed = capture_sync.sync_status(out_dir, db_path=db_path)
+
+    db_builder.connections.close(db_path)
+    return {'files': first['files'],
+            'first_sync_s': first['seconds'],
+            'unchanged_sync_ms': unchanged['seconds'] * 1e3,
+            'changed_sync_ms': changed['seconds'] * 1e3,
+            'changed': changed['changed']}
+
+
+def _startup(args: list) -> tuple:
+    """
+    Run python -X importtime with args in this folder and return the wall time in ms, the import time in ms summed
+    over the top-level imports and the names of the heavy packages (pandas, numpy, scipy) that were imported.
+    """
+    start = time.perf_counter()
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stderr
+    wall_ms = (time.perf_counter() - start) * 1e3
+    # lines look like 'import time:  self [us] | cumulative | name', nested imports are indented below their parent
+    modules = [line.split('|') for line in stderr.splitlines()
+               if line.startswith('import time:') and '[us]' not in line]
+    import_ms = sum(int(cumulative) for _, cumulative, name in modules if not name[1:].startswith(' ')) / 1e3
+    heavy = sorted({name.strip() for _, _, name in modules if name.strip() in ('pandas', 'numpy', 'scipy')})
+    return wall_ms, import_ms, heavy
+
+
+def bench_cli_startup(n_runs: int = 5) -> dict:
+    """
+    Startup of biocycle.py commands measured with -X importtime: median wall time of a run and time spent in imports,
+    and which heavy packages each command loads. 'eager_imports' imports db_queries and create_experiments_helpers
+    with pandas and scipy, as every helper did before the imports were made lazy, 'python' is the bare interpreter.
+    """
+    db_path = _temp_db()
+    db_builder.connections.close(db_path)
+    commands = {
+        'python': ['-c', 'pass'],
+        'eager_imports': ['-c', 'import db_queries, create_experiments_helpers, pandas, scipy.stats'],
+        'next_id': ['biocycle.py', '--db', db_path, 'next-id', 'session'],
+        'delete': ['biocycle.py', '--db', db_path, 'delete', 'experiment', 'E9999'],
+        'query': ['biocycle.py', '--db', db_path, 'query', 'SELECT COUNT(*) FROM experiments'],
+    }
+    result = {}
+    for name, args in commands.items():
+        runs = [_startup(args) for _ in range(n_runs)]
+        wall_ms = sorted(run[0] for run in runs)[n_runs // 2]
+        import_ms = sorted(run[1] for run in runs)[n_runs // 2]
+        result[name] = {'wall_ms': wall_ms, 'import_ms': import_ms, 'heavy_imports': runs[0][2]}
+    return result
+
+
+def bench_find_objects(n_objects: int = 50000, page_size: int = 1000) -> dict:
+    """
+    Object searches with find_objects against loading the whole catalog into pandas and filtering there: time of the
+    first page and of all pages of the usual sample query, a length range and a full text search on the notes.
+    """
+    db_path = _temp_db()
+    rng = random.Random(0)
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.executemany('INSERT INTO objects (object_id, polymer_type, length, color, reference_image, note) '
+                        'VALUES (?, ?, ?, ?, ?, ?);',
+                        [(f'{i // 100}_{i % 100}', rng.choice(['pe', 'pe-hd', 'pp', 'pet']), rng.uniform(1, 80),
+                          rng.choice(['gray', 'white', 'blue']), rng.choice(['1', '1', '0']),
+                          rng.choice([None, None, 'printed label', 'torn foil', 'red cap'])) for i in range(n_objects)])
+    searches = {
+        'sample_query': ({'reference_image': True, 'polymer_type': 'pe'},
+                         lambda df: df[(df['reference_image'] == '1') & (df['polymer_type'] == 'pe')]),
+        'length_range': ({'polymer_type': 'pp', 'min_length': 10, 'max_length': 20},
+                         lambda df: df[(df['polymer_type'] == 'pp') & df['length'].between(10, 20)]),
+        'note_text': ({'text': 'label'}, lambda df: df[df['note'].str.contains('label', case=False, na=False)]),
+    }
+    result = {}
+    for name, (filters, pandas_filter) in searches.items():
+        start = time.perf_counter()
+        matches = len(pandas_filter(db_queries.run_query('SELECT * FROM objects;', db_path)))
+        pandas_ms = (time.perf_counter() - start) * 1e3
+
+        start = time.perf_counter()
+        page, after = db_queries.find_objects(**filters, limit=page_size, db_path=db_path)
+        first_page_ms = (time.perf_counter() - start) * 1e3
+        found = len(page)
+        while after is not None:
+            page, after = db_queries.find_objects(**filters, after=after, limit=page_size, db_path=db_path)
+            found += len(page)
+        result[name] = {'matches': matches, 'found': found, 'pandas_ms': pandas_ms, 'first_page_ms': first_page_ms,
+                        'all_pages_ms': (time.perf_counter() - start) * 1e3}
+    db_builder.connections.close(db_path)
+    return result
+
+
+def bench_session_plan(n_links: int = 1000000, n_objects: int = 100000, length: int = 4) -> dict:
+    """
+    Memory of a session plan with n_links links as DataFrame with lists of object ids and as SessionPlan: size of
+    the data and peak RSS of a fresh process that generates it (the RSS of the imports is subtracted), time of
+    generate_session_plan for both, of the conversions and of saving and memory-mapping the plan.
+    """
+    n_experiments = n_links // length
+    setup = (f'import numpy as np, pandas as pd, create_experiments_helpers as helpers\n'
+             f'objects = pd.DataFrame({{"object_id": [f"{{i // 100}}_{{i % 100}}" for i in range({n_objects})]}})\n'
+             f'experiment_ids = [f"E{{i:07}}" for i in range({n_experiments})]\n')
+    generate = f'helpers.generate_session_plan("S0000", experiment_ids, objects, ["CO-01"], {length}, {length}'
+
+    objects = pd.DataFrame({'object_id': [f'{i // 100}_{i % 100}' for i in range(n_objects)]})
+    experiment_ids = [f'E{i:07}' for i in range(n_experiments)]
+    start = time.perf_counter()
+    frame = helpers.generate_session_plan('S0000', experiment_ids, objects, ['CO-01'], length, length)
+    frame_s = time.perf_counter() - start
+    start = time.perf_counter()
+    plan = helpers.generate_session_plan('S0000', experiment_ids, objects, ['CO-01'], length, length, as_plan=True)
+    plan_s = time.perf_counter() - start
+    start = time.perf_counter()
+    converted = helpers.SessionPlan.from_frame(frame)
+    from_frame_s = time.perf_counter() - start
+    start = time.perf_counter()
+    converted.to_frame()
+    to_frame_s = time.perf_counter() - start
+
+    path = os.path.join(tempfile.mkdtemp(prefix='biocycle_bench_'), 'plan.bin')
+    start = time.perf_counter()
+    plan.save(path)
+    save_s = time.perf_counter() - start
+    start = time.perf_counter()
+    loaded = helpers.SessionPlan.load(path)
+    load_ms = (time.perf_counter() - start) * 1e3
+    assert loaded.objects(n_experiments - 1) == frame['objects'].iloc[-1]
+
+    baseline = _peak_rss_mb(setup)
+    return {'links': plan.n_links,
+            'frame_mb': float(frame.memory_usage(deep=True).sum()) / 2 ** 20,
+            'plan_mb': plan.nbytes / 2 ** 20,
+            'file_mb': os.path.getsize(path) / 2 ** 20,
+            'frame_peak_rss_mb': _peak_rss_mb(f'{setup}plan = {generate})') - baseline,
+            'plan_peak_rss_mb': _peak_rss_mb(f'{setup}plan = {generate}, as_plan=True)') - baseline,
+            'frame_generate_s': frame_s,
+            'plan_generate_s': plan_s,
+            'from_frame_s': from_frame_s,
+            'to_frame_s': to_frame_s,
+            'save_s': save_s,
+            'mmap_load_ms': load_ms}
+
+
+def _backup_writer(db_path: str, journal_mode: str, prefix: str, barrier, stop, results) -> None:
+    """Writer process of bench_backup, adds experiments until stop is set and puts the latencies in ms on results."""
+    db_builder.connections = db_builder.ConnectionManager({**db_builder.PRAGMAS, 'journal_mode': journal_mode})
+    latencies, errors = [], 0
+    barrier.wait()
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            experiment_id = f'{prefix}{len(latencies):06}'
+            db_queries.put_experiment(experiment_id, 'S0000', 'CO-01', 3, db_path)
+            db_queries.link_experiment_objects(experiment_id, ['0_1', '0_2', '0_3'], db_path)
+        except sql.OperationalError:
+            errors += 1
+        latencies.append((time.perf_counter() - start) * 1e3)
+    results.put((latencies, errors))
+    db_builder.connections.close_all()
+    return None
+
+
+def bench_backup(n_objects: int = 300000, seconds: float = 1.0) -> dict:
+    """
+    Latency of a writer process adding experiments while the main process backs up the database: without a backup,
+    with a backup in one step and with a backup in steps of BACKUP_PAGES pages, in WAL mode, and with a backup in one
+    step with the rollback journal, where the backup holds the read lock for the whole copy. The writer runs for
+    seconds before and after the backup. Reports the writer's 50th and 99th percentile and maximum latency, its lock
+    errors and the duration of the backup.
+    """
+    context = multiprocessing.get_context('spawn')
+    db_path = _temp_db()
+    _fill_objects(db_path, n_objects)
+    db_queries.put_session('S0000', db_path=db_path)
+    db_builder.connections.close(db_path)
+    size_mb = os.path.getsize(db_path) / 2 ** 20
+
+    result = {'database_mb': size_mb}
+    cases = [('none', 'WAL', None), ('wal_one_step', 'WAL', -1), ('wal_steps', 'WAL', backup.BACKUP_PAGES),
+             ('delete_one_step', 'DELETE', -1)]
+    for i, (case, journal_mode, pages) in enumerate(cases):
+        con = db_builder.connections.get(db_path)
+        con.execute(f'PRAGMA journal_mode = {journal_mode};')
+        db_builder.connections.close(db_path)
+
+        barrier, stop, results = context.Barrier(2), context.Event(), context.Queue()
+        writer = context.Process(target=_backup_writer,
+                                 args=(db_path, journal_mode, f'W{i}_', barrier, stop, results))
+        writer.start()
+        barrier.wait()
+        time.sleep(seconds)
+        copy = None
+        if pages is not None:
+            copy = backup.backup(db_path, target=os.path.join(os.path.dirname(db_path), f'{case}.db'), pages=pages,
+                                 sleep=backup.BACKUP_SLEEP, verify=False)
+            time.sleep(seconds)
+        stop.set()
+        latencies, errors = results.get()
+        writer.join()
+
+        latencies.sort()
+        result[case] = {'writes': len(latencies),
+                        'write_p50_ms': latencies[len(latencies) // 2],
+                        'write_p99_ms': latencies[int(len(latencies) * 0.99)],
+                        'write_max_ms': latencies[-1],
+                        'write_errors': errors,
+                        'backup_s': copy['seconds'] if copy else 0.0,
+                        'backup_steps': copy['steps'] if copy else 0}
+    return result
+
+
+BENCHMARKS = {
+    'connection_reuse': bench_connection_reuse,
+    'ingest_session_plan': bench_ingest_session_plan,
+    'secondary_indexes': bench_secondary_indexes,
+    'generate_session_plan': bench_generate_session_plan,
+    'export_session_jsons': bench_export_session_jsons,
+    'streaming_queries': bench_streaming_queries,
+    'bound_parameters': bench_bound_parameters,
+    'batch_fetch': bench_batch_fetch,
+    'complete_session': bench_complete_session,
+    'entity_cache': bench_entity_cache,
+    'async_queries': bench_async_queries,
+    'catalog_import': bench_catalog_import,
+    'analytics_export': bench_analytics_export,
+    'stats': bench_stats,
+    'balanced_sampler': bench_balanced_sampler,
+    'delete_experiments': bench_delete_experiments,
+    'instrumentation': bench_instrumentation,
+    'contention': bench_contention,
+    'capture_sync': bench_capture_sync,
+    'cli_startup': bench_cli_startup,
+    'find_objects': bench_find_objects,
+    'session_plan': bench_session_plan,
+    'backup': bench_backup,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(name, BENCHMARKS[name]())
@@ -0,0 +1,185 @@
+"""
+Command line interface of the tracker. Modules are imported by the commands that need them, so commands that only
+touch SQLite (create-schema, next-id, export-jsons, delete, backup) start without loading pandas or scipy:
+
+    python biocycle.py next-id session
+    python biocycle.py create-session-plan --n-experiments 50 --out plan.json
+    python biocycle.py ingest plan.json --responsible "Silvan Rehm"
+    python biocycle.py query "SELECT * FROM experiments WHERE session_id = ?" S0040
+    python biocycle.py backup --keep 14
+"""
+import argparse
+import json
+import sys
+
+db = './data/biocycle_tracking.db'
+
+
+def create_schema(args) -> None:
+    import db_builder
+
+    db_builder.create_database_file(args.db)
+    db_builder.create_schema(args.db)
+    print(db_builder.get_schema_version(args.db))
+
+
+def next_id(args) -> None:
+    import db_builder
+
+    if args.reserve:
+        reserve = db_builder.reserve_session_ids if args.kind == 'session' else db_builder.reserve_experiment_ids
+        print('\n'.join(reserve(args.reserve, args.db)))
+    elif args.kind == 'session':
+        print(db_builder.get_next_session_id(args.db))
+    else:
+        print(db_builder.get_next_experiment_id(args.db))
+
+
+def create_session_plan(args) -> None:
+    import db_builder
+    import db_queries
+    import create_experiments_helpers as helpers
+
+    objects = db_queries.run_query('SELECT object_id, polymer_type FROM objects WHERE reference_image == True;',
+                                   args.db)
+    objects['object_id'] = objects['object_id'].astype(str).str.replace('.', '_')
+    objects = objects[~objects['polymer_type'].isin(args.exclude_types)]
+    if args.include_types:
+        objects = objects[objects['polymer_type'].isin(args.include_types)]
+    containers = args.containers or db_queries.run_query('SELECT container_id FROM containers;',
+                                                         args.db)['container_id'].tolist()
+    distribution = None
+    if args.distribution:
+        distribution = helpers.load_scipy_distribution_by_name(args.distribution, json.loads(args.distribution_params))
+
+    session_id = args.session_id or db_builder.reserve_session_ids(1, args.db)[0]
+    experiment_ids = helpers.get_experiment_ids(n_experiments=args.n_experiments, db_path=args.db)
+    plan = helpers.generate_session_plan(session_id, experiment_ids, objects, containers, args.min_length,
+                                         args.max_length, distribution=distribution,
+                                         stratify_column=args.stratify_column, random_state=args.seed,
+                                         balance_usage=args.balance_usage, db_path=args.db)
+    plan.to_json(args.out or sys.stdout, orient='records', indent=2)
+
+
+def ingest(args) -> None:
+    import pandas as pd
+    import db_queries
+
+    with open(args.plan) as f:
+        plan = pd.DataFrame(json.load(f))
+    db_queries.ingest_session_plan(plan, note=args.note, responsible=args.responsible, start_date=args.start_date,
+                                   end_date=args.end_date, db_path=args.db)
+    print(json.dumps({'sessions': plan['session_id'].nunique(), 'experiments': len(plan)}))
+
+
+def export_jsons(args) -> None:
+    import capture_jsons
+
+    for session_id in args.session_ids:
+        print(json.dumps({'session_id': session_id,
+                          **capture_jsons.export_session_jsons(session_id, args.out_dir, args.workers, args.db)}))
+
+
+def query(args) -> None:
+    import db_queries
+
+    result = db_queries.run_query(args.query, args.db, tuple(args.params), read_only=not args.write)
+    if isinstance(result, int):
+        print(result)
+    else:
+        result.to_csv(sys.stdout, index=False)
+
+
+def delete(args) -> None:
+    import db_queries
+
+    if args.kind == 'session':
+        print(json.dumps(db_queries.delete_sessions(args.ids, args.db)))
+    else:
+        print(json.dumps(db_queries.delete_experiments(args.ids, args.db)))
+
+
+def backup(args) -> None:
+    import backup
+
+    if args.replica:
+        print(json.dumps(backup.refresh_replica(args.db, args.replica, args.pages, args.sleep)))
+    else:
+        result = backup.backup(args.db, args.dir, pages=args.pages, sleep=args.sleep)
+        if args.keep is not None:
+            result['removed'] = backup.rotate_backups(args.keep, args.dir, args.db)
+        print(json.dumps(result))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='biocycle', description='Experiment tracker of the BioCycle project.')
+    parser.add_argument('--db', default=db, help=f'path to the database (default: {db})')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('create-schema', help='create the database or migrate it to the latest schema')
+    command.set_defaults(func=create_schema)
+
+    command = commands.add_parser('next-id', help='print the next free session or experiment id')
+    command.add_argument('kind', choices=['session', 'experiment'])
+    command.add_argument('--reserve', type=int, metavar='N', help='reserve and print N ids instead')
+    command.set_defaults(func=next_id)
+
+    command = commands.add_parser('create-session-plan', help='draw a session plan and write it as JSON')
+    command.add_argument('session_id', nargs='?', help='session id, a new id is reserved if not given')
+    command.add_argument('--n-experiments', type=int, required=True)
+    command.add_argument('--min-length', type=int, default=2)
+    command.add_argument('--max-length', type=int, default=5)
+    command.add_argument('--containers', nargs='+', help='container ids to draw from (default: all)')
+    command.add_argument('--exclude-types', nargs='*', default=['no sample', 'unclear'])
+    command.add_argument('--include-types', nargs='+')
+    command.add_argument('--distribution', help='scipy.stats distribution of the experiment lengths, e.g. alpha')
+    command.add_argument('--distribution-params', default='{}', help='JSON parameters, e.g. \'{"a": 4}\'')
+    command.add_argument('--stratify-column')
+    command.add_argument('--balance-usage', action='store_true')
+    command.add_argument('--seed', type=int, default=42)
+    command.add_argument('--out', help='JSON file of the plan (default: stdout)')
+    command.set_defaults(func=create_session_plan)
+
+    command = commands.add_parser('ingest', help='write a session plan JSON to the database in one transaction')
+    command.add_argument('plan')
+    command.add_argument('--note')
+    command.add_argument('--responsible')
+    command.add_argument('--start-date')
+    command.add_argument('--end-date')
+    command.set_defaults(func=ingest)
+
+    command = commands.add_parser('export-jsons', help='write the folders of sessions for the capture software')
+    command.add_argument('session_ids', nargs='+')
+    command.add_argument('--out-dir', default='./data')
+    command.add_argument('--workers', type=int, default=8)
+    command.set_defaults(func=export_jsons)
+
+    command = commands.add_parser('query', help='run a query and print the result as CSV')
+    command.add_argument('query')
+    command.add_argument('params', nargs='*', help='values of the ? placeholders')
+    command.add_argument('--write', action='store_true', help='allow the query to change the database')
+    command.set_defaults(func=query)
+
+    command = commands.add_parser('delete', help='delete sessions or experiments with their links')
+    command.add_argument('kind', choices=['session', 'experiment'])
+    command.add_argument('ids', nargs='+')
+    command.set_defaults(func=delete)
+
+    command = commands.add_parser('backup', help='copy the database while it is in use and verify the copy')
+    command.add_argument('--dir', default='./data/backups', help='folder of the timestamped backups')
+    command.add_argument('--keep', type=int, metavar='N', help='delete all but the N newest backups afterwards')
+    command.add_argument('--replica', metavar='PATH', help='refresh this read-only replica instead of a backup')
+    command.add_argument('--pages', type=int, default=256, help='pages copied per step')
+    command.add_argument('--sleep', type=float, default=0.005, help='seconds between two steps')
+    command.set_defaults(func=backup)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = build_parser().parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
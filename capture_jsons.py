@@ -0,0 +1,197 @@
+import json
+import os
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import db_builder
+import db_queries
+
+db = './data/biocycle_tracking.db'
+
+# folders written in front of and after the experiments of every session: (experiment_id, type, instruction files)
+FRAME_FOLDERS = [
+    ('A0000_calibration', 'calibration', {'instructions_calibration.txt': 'instructions calibration'}),
+    ('A0001_empty_tray', 'empty_tray', {'instructions_empty_tray.txt': 'instructions empty tray'}),
+    ('Z9999_calibration', 'calibration', {'instructions_calibration.txt': 'instructions calibration'}),
+]
+
+EXPERIMENT_INSTRUCTIONS = {
+    'instructions_impurities.txt': 'instructions impurities',
+    'instructions_mixed.txt': 'instructions mixed',
+    'instructions_clean.txt': 'instructions clean',
+}
+
+# fields of data.json the capture software updates, a re-export keeps their values
+CAPTURE_FIELDS = ('status', 'aligned')
+
+
+def build_json(session_id: str, experiment_id: str, container_id: str, objects: List[str],
+               experiment_type: str = 'sample', status: str = 'pending', aligned: bool = False) -> dict:
+    """
+    Build the data.json content the capture software expects for one experiment.
+    :param session_id: str, session_id of the session
+    :param experiment_id: str, experiment_id of the experiment
+    :param container_id: str, container_id of the container
+    :param objects: List[str], object_ids of the experiment
+    :param experiment_type: str (optional), 'sample', 'calibration' or 'empty_tray'
+    :param status: str (optional), capture status, 'pending' until the capture software changes it
+    :param aligned: bool (optional), set by the capture software
+    :return: dict
+    """
+    return {
+        'type': experiment_type,
+        'session_id': session_id.strip(),
+        'experiment_id': experiment_id.strip(),
+        'container_id': container_id.strip(),
+        'status': status,
+        'n_objects': len(objects),
+        'aligned': aligned,
+        'annotations': [{'object': item.strip()} for item in objects]
+    }
+
+
+def write_if_changed(path: str, content: bytes) -> bool:
+    """
+    Atomically write content to path: the data goes to a temporary file in the same folder, which is then renamed,
+    so readers never see a half-written file. Nothing is written if the file already has the same content. A replaced
+    file keeps its permissions, new files get the default permissions of the process.
+    :param path: str, path of the file
+    :param content: bytes, new content
+    :return: bool, True if the file was written, False if it was unchanged
+    """
+    if os.path.exists(path) and os.path.getsize(path) == len(content):
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = None
+    # created like open(path, 'wb') would, i.e. 0666 minus the umask, not with the 0600 of tempfile.mkstemp
+    tmp_path = os.path.join(os.path.dirname(path), f'.tmp_{uuid.uuid4().hex}')
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def write_data_json(path: str, content: bytes) -> bool:
+    """
+    Like write_if_changed for a data.json, but the CAPTURE_FIELDS of an existing file are kept, so a re-export does
+    not reset experiments the capture software has already worked on.
+    :param path: str, path of the file
+    :param content: bytes, new content, built by build_json
+    :return: bool, True if the file was written, False if it was unchanged
+    """
+    try:
+        with open(path, 'rb') as f:
+            existing = json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        existing = None
+    if isinstance(existing, dict):
+        data = json.loads(content)
+        kept = {key: existing[key] for key in CAPTURE_FIELDS if key in existing and existing[key] != data.get(key)}
+        if kept:
+            content = json.dumps({**data, **kept}, indent=4).encode('utf-8')
+    return write_if_changed(path, content)
+
+
+def capture_status(session_id: str, db_path: str = db) -> dict:
+    """
+    Return the status and alignment synced back from the capture software (see capture_sync) for a session.
+    :param session_id: str, session_id of the session
+    :param db_path: str (optional), name of the database
+    :return: dict, {experiment_id: (status, aligned)}, aligned is a bool or None
+    """
+    con = db_builder.connections.get(db_path)
+    rows = con.execute('SELECT experiment_id, status, aligned FROM capture_status WHERE session_id = ?;',
+                       (session_id,))
+    return {experiment_id: (status, None if aligned is None else bool(aligned))
+            for experiment_id, status, aligned in rows}
+
+
+def _build_json(session_id: str, experiment_id: str, container_id: str, objects: List[str], experiment_type: str,
+                status: dict) -> dict:
+    data = build_json(session_id, experiment_id, container_id, objects, experiment_type)
+    synced = dict(zip(CAPTURE_FIELDS, status.get(experiment_id.strip(), ())))
+    data.update({key: value for key, value in synced.items() if value is not None})
+    return data
+
+
+def session_files(session_id: str, db_path: str = db, plan=None, status: dict = None) -> dict:
+    """
+    Return all files of the export of a session.
+    :param session_id: str, session_id of the session
+    :param db_path: str (optional), name of the database
+    :param plan: create_experiments_helpers.SessionPlan (optional), read the experiments from the plan instead of
+    the database
+    :param status: dict (optional), {experiment_id: (status, aligned)} written instead of the defaults of
+    build_json, e.g. from capture_status
+    :return: dict, {relative path: content}
+    """
+    status = {} if status is None else status
+    experiments = [(experiment_id, _build_json(session_id, experiment_id, 'N/A', [], experiment_type, status),
+                    instructions)
+                   for experiment_id, experiment_type, instructions in FRAME_FOLDERS]
+    rows = db_queries.get_complete_session(session_id, db_path) if plan is None else plan.rows(session_id)
+    for _, experiment_id, container_id, object_list in rows:
+        experiments.append((experiment_id.strip(),
+                            _build_json(session_id, experiment_id, container_id, object_list, 'sample', status),
+                            EXPERIMENT_INSTRUCTIONS))
+
+    files = {}
+    for experiment_id, data, instructions in experiments:
+        files[os.path.join(experiment_id, 'data.json')] = json.dumps(data, indent=4).encode('utf-8')
+        for name, text in instructions.items():
+            files[os.path.join(experiment_id, name)] = text.encode('utf-8')
+    return files
+
+
+def export_session_jsons(session_id: str, out_dir: str = './data', workers: int = 8, db_path: str = db,
+                         plan=None) -> dict:
+    """
+    Write the folders of a session for the capture software to out_dir/session_id: the calibration and empty tray
+    folders and one folder per experiment with its data.json and instruction files. Files are written in parallel
+    and atomically, files whose content did not change are skipped, so a session can be re-exported at any time.
+    The status and alignment of existing data.json files are kept, for missing files they are taken from the
+    capture_status table (see capture_sync).
+    :param session_id: str, session_id of the session
+    :param out_dir: str (optional), folder the session folder is created in
+    :param workers: int (optional), number of writer threads
+    :param db_path: str (optional), name of the database
+    :param plan: create_experiments_helpers.SessionPlan (optional), export the experiments of the plan instead of
+    the ones in the database, e.g. before the plan is ingested
+    :return: dict, {'files', 'written', 'skipped', 'seconds', 'files_per_s'}
+    """
+    start = time.perf_counter()
+    session_dir = os.path.join(out_dir, session_id)
+    files = session_files(session_id, db_path, plan, capture_status(session_id, db_path))
+    for folder in {os.path.dirname(path) for path in files}:
+        os.makedirs(os.path.join(session_dir, folder), exist_ok=True)
+
+    def write(item) -> bool:
+        path, content = os.path.join(session_dir, item[0]), item[1]
+        if os.path.basename(path) == 'data.json':
+            return write_data_json(path, content)
+        return write_if_changed(path, content)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        written = sum(pool.map(write, files.items()))
+
+    seconds = time.perf_counter() - start
+    return {'files': len(files),
+            'written': written,
+            'skipped': len(files) - written,
+            'seconds': seconds,
+            'files_per_s': len(files) / seconds}
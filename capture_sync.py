@@ -0,0 +1,162 @@
+"""
+Sync of the status the capture software writes into the exported data.json files (see capture_jsons) back into the
+capture_status table (migration 6 in db_builder). The modification time and size of every file are kept in the
+table, a sync only stats the files and parses the ones that changed since the last sync, in a pool of worker threads.
+"""
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pandas as pd
+
+import db_builder
+
+db = './data/biocycle_tracking.db'
+
+UPSERT = '''
+    INSERT INTO capture_status (session_id, experiment_id, status, aligned, mtime_ns, size)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (session_id, experiment_id) DO UPDATE SET
+        updated = CASE WHEN status IS excluded.status AND aligned IS excluded.aligned THEN updated
+                       ELSE CURRENT_TIMESTAMP END,
+        status = excluded.status,
+        aligned = excluded.aligned,
+        mtime_ns = excluded.mtime_ns,
+        size = excluded.size;
+    '''
+
+
+def _scan_session(root: str, session_id: str) -> list:
+    files = []
+    try:
+        experiments = [entry for entry in os.scandir(os.path.join(root, session_id)) if entry.is_dir()]
+    except FileNotFoundError:
+        return files
+    for entry in experiments:
+        try:
+            stat = os.stat(f'{entry.path}{os.sep}data.json')
+        except FileNotFoundError:
+            continue
+        files.append(((session_id, entry.name), (stat.st_mtime_ns, stat.st_size)))
+    return files
+
+
+def scan_files(root: str = './data', sessions: List[str] = None, workers: int = 8) -> dict:
+    """
+    Return the modification time and size of the data.json of every experiment folder below root. Session folders
+    are scanned in parallel, which pays off on network shares.
+    :param root: str (optional), folder the sessions were exported to
+    :param sessions: List[str] (optional), session_ids of the session folders to scan, all folders if None
+    :param workers: int (optional), number of scanner threads
+    :return: dict, {(session_id, experiment_id): (mtime_ns, size)}
+    """
+    if sessions is None:
+        sessions = [entry.name for entry in os.scandir(root) if entry.is_dir()]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(item for files in pool.map(lambda session_id: _scan_session(root, session_id), sessions)
+                    for item in files)
+
+
+def read_status(path: str) -> tuple:
+    """
+    Read status and aligned from a data.json.
+    :param path: str, path of the file
+    :return: tuple, (status, aligned)
+    """
+    with open(path, 'rb') as f:
+        data = json.loads(f.read())
+    aligned = data.get('aligned')
+    return data.get('status'), None if aligned is None else int(bool(aligned))
+
+
+def sync_status(root: str = './data', sessions: List[str] = None, workers: int = 8, batch_size: int = 1000,
+                db_path: str = db) -> dict:
+    """
+    Update capture_status from the data.json files below root. Files whose modification time and size match the last
+    sync are skipped, the others are parsed in parallel and written batch_size rows per transaction. Rows of files that
+    no longer exist are deleted. Files that cannot be read or parsed, e.g. because the capture software is writing
+    them, are left out and tried again by the next sync.
+    :param root: str (optional), folder the sessions were exported to
+    :param sessions: List[str] (optional), session_ids of the sessions to sync, all session folders if None
+    :param workers: int (optional), number of parser threads
+    :param batch_size: int (optional), number of rows written per transaction
+    :param db_path: str (optional), name of the database
+    :return: dict, {'files', 'unchanged', 'parsed', 'changed', 'removed', 'errors', 'seconds'}, errors is a list of
+    (path, message)
+    """
+    start = time.perf_counter()
+    con = db_builder.connections.get(db_path)
+    query = 'SELECT session_id, experiment_id, mtime_ns, size FROM capture_status'
+    if sessions is None:
+        rows = con.execute(f'{query};').fetchall()
+    else:
+        rows = [row for session_id in sessions
+                for row in con.execute(f'{query} WHERE session_id = ?;', (session_id,))]
+    index = {(session_id, experiment_id): (mtime_ns, size) for session_id, experiment_id, mtime_ns, size in rows}
+
+    files = scan_files(root, sessions, workers)
+    modified = [(key, stat) for key, stat in files.items() if index.get(key) != stat]
+    removed = [key for key in index if key not in files]
+
+    def parse(item):
+        (session_id, experiment_id), stat = item
+        try:
+            return read_status(os.path.join(root, session_id, experiment_id, 'data.json')), None
+        except (OSError, ValueError, AttributeError) as e:
+            return None, f'{type(e).__name__}: {e}'
+
+    rows, errors, changed = [], [], 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for ((session_id, experiment_id), stat), (status, error) in zip(modified, pool.map(parse, modified)):
+            if error is not None:
+                errors.append((os.path.join(root, session_id, experiment_id, 'data.json'), error))
+                continue
+            if (session_id, experiment_id) in index:
+                changed += con.execute('SELECT status, aligned FROM capture_status '
+                                       'WHERE session_id = ? AND experiment_id = ?;',
+                                       (session_id, experiment_id)).fetchone() != status
+            else:
+                changed += 1
+            rows.append((session_id, experiment_id, *status, *stat))
+
+    for first in range(0, max(len(rows), len(removed)), batch_size):
+        con.execute('BEGIN IMMEDIATE;')
+        try:
+            con.executemany(UPSERT, rows[first:first + batch_size])
+            con.executemany('DELETE FROM capture_status WHERE session_id = ? AND experiment_id = ?;',
+                            removed[first:first + batch_size])
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+
+    return {'files': len(files),
+            'unchanged': len(files) - len(modified),
+            'parsed': len(rows),
+            'changed': changed,
+            'removed': len(removed),
+            'errors': errors,
+            'seconds': time.perf_counter() - start}
+
+
+def get_capture_status(session_id: str = None, status: str = None, db_path: str = db) -> pd.DataFrame:
+    """
+    Return the synced status of the experiments, see sync_status.
+    :param session_id: str (optional), only the experiments of this session
+    :param status: str (optional), only the experiments with this status, e.g. 'pending'
+    :param db_path: str (optional), name of the database
+    :return: pd.DataFrame, columns: session_id, experiment_id, status, aligned, updated
+    """
+    conditions = {'session_id': session_id, 'status': status}
+    conditions = {column: value for column, value in conditions.items() if value is not None}
+    where = f'WHERE {" AND ".join(f"{column} = ?" for column in conditions)}' if conditions else ''
+    query = f'''
+        SELECT session_id, experiment_id, status, aligned, updated FROM capture_status
+        {where}
+        ORDER BY session_id, experiment_id;
+        '''
+    return pd.read_sql_query(query, db_builder.connections.get(db_path, read_only=True),
+                             params=tuple(conditions.values()))
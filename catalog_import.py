@@ -0,0 +1,212 @@
+"""
+Import of the object catalog (the sample spreadsheet) from CSV or Excel files of any size. Files are read in chunks,
+column names and types are normalized, and every chunk is written to a temporary staging table and merged into
+objects with INSERT ... ON CONFLICT DO UPDATE, so objects that already exist are updated instead of failing the import.
+"""
+import os
+import time
+
+from typing import Iterator, Tuple
+
+import pandas as pd
+
+import db_builder
+import db_queries
+
+db = './data/biocycle_tracking.db'
+
+OBJECT_COLUMNS = list(db_queries.ObjectRow._fields)
+NUMERIC_COLUMNS = ['length', 'stiffness']
+BOOLEAN_COLUMNS = ['reference_image']
+
+# spellings of booleans in spreadsheets (Excel cells are read as 'True'/'False'), stored as '1'/'0' like put_object does
+BOOLEAN_VALUES = {
+    '1': '1', '1.0': '1', 'true': '1', 'yes': '1', 'y': '1', 'x': '1',
+    '0': '0', '0.0': '0', 'false': '0', 'no': '0', 'n': '0',
+}
+
+# column names used in the sample spreadsheet, after normalization
+COLUMN_ALIASES = {
+    'locator': 'object_id',
+    'type': 'polymer_type',
+}
+
+
+def normalize_column_name(name) -> str:
+    """
+    Lower-case a column name, replace spaces and dashes with underscores and map known aliases to object columns.
+    :param name: column name of the file
+    :return: str
+    """
+    name = '_'.join(str(name).strip().lower().replace('-', ' ').split())
+    return COLUMN_ALIASES.get(name, name)
+
+
+def read_catalog(path: str, chunksize: int = 10000, sheet_name=0, sep: str = ',') -> Iterator[pd.DataFrame]:
+    """
+    Read a CSV or Excel (.xlsx) file in chunks of chunksize rows. All values are read as strings, types are set by
+    normalize_objects. Excel files are streamed row by row with openpyxl in read-only mode.
+    :param path: str, path of the file
+    :param chunksize: int (optional), number of rows per chunk
+    :param sheet_name: str or int (optional), name or index of the sheet of Excel files
+    :param sep: str (optional), separator of CSV files
+    :return: Iterator[pd.DataFrame]
+    """
+    if os.path.splitext(path)[1].lower() not in ('.xlsx', '.xlsm'):
+        yield from pd.read_csv(path, dtype=str, chunksize=chunksize, sep=sep)
+        return
+
+    try:
+        import openpyxl
+    except ImportError as e:
+        raise ImportError('reading Excel files requires openpyxl, install it with `pip install openpyxl`') from e
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if isinstance(sheet_name, str) else workbook.worksheets[sheet_name]
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        chunk = []
+        for row in rows:
+            chunk.append([None if value is None else str(value) for value in row])
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=header, dtype=object)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header, dtype=object)
+    finally:
+        workbook.close()
+
+
+def normalize_objects(chunk: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Normalize a chunk of the catalog: rename columns to the columns of objects (unknown columns are dropped), strip
+    text, turn empty strings into NULL, convert length and stiffness to numbers and reference_image to '1' or '0'.
+    Rows without object_id, with a value that is not a number in a numeric column or that is not a boolean in a
+    boolean column are rejected.
+    :param chunk: pd.DataFrame, chunk as read by read_catalog
+    :return: (valid rows with the object columns found in the file, rejected rows with a 'reason' column)
+    """
+    chunk = chunk.rename(columns=normalize_column_name)
+    chunk = chunk.loc[:, ~chunk.columns.duplicated()]
+    columns = [column for column in OBJECT_COLUMNS if column in chunk.columns]
+    if 'object_id' not in columns:
+        raise ValueError(f'catalog has no object_id column, found {chunk.columns.tolist()}')
+
+    objects = pd.DataFrame(index=chunk.index)
+    for column in columns:
+        values = chunk[column].astype('string').str.strip()
+        objects[column] = values.mask(values == '')
+
+    reason = pd.Series(None, index=chunk.index, dtype=object)
+    reason[objects['object_id'].isna()] = 'missing object_id'
+    for column in NUMERIC_COLUMNS:
+        if column in columns:
+            numbers = pd.to_numeric(objects[column], errors='coerce')
+            reason[reason.isna() & objects[column].notna() & numbers.isna()] = f'{column} is not a number'
+            objects[column] = numbers
+    for column in BOOLEAN_COLUMNS:
+        if column in columns:
+            flags = objects[column].str.lower().map(BOOLEAN_VALUES)
+            reason[reason.isna() & objects[column].notna() & flags.isna()] = f'{column} is not a boolean'
+            objects[column] = flags
+
+    rejected = reason.notna()
+    return objects[~rejected], chunk[rejected].assign(reason=reason[rejected])
+
+
+def _new_value(column: str, new: str, overwrite_blank: bool) -> str:
+    """Value a column of objects gets from new (a table name or 'excluded'), blanks keep the stored value."""
+    return f'{new}.{column}' if overwrite_blank else f'COALESCE({new}.{column}, objects.{column})'
+
+
+def _differs(columns: list, new: str, overwrite_blank: bool = False) -> str:
+    """Condition that is true if the values of new (a table name or 'excluded') differ from the row of objects."""
+    updated = [column for column in columns if column != 'object_id']
+    if not updated:
+        return 'false'
+    return f'''({', '.join(f'objects.{column}' for column in updated)})
+                   IS NOT ({', '.join(_new_value(column, new, overwrite_blank) for column in updated)})'''
+
+
+def _merge_query(columns: list, overwrite_blank: bool = False) -> str:
+    updated = [column for column in columns if column != 'object_id']
+    names = ', '.join(columns)
+    if not updated:
+        conflict = 'DO NOTHING'
+    else:
+        values = ', '.join(f'{column} = {_new_value(column, "excluded", overwrite_blank)}' for column in updated)
+        conflict = f'''DO UPDATE SET {values}
+                WHERE {_differs(columns, 'excluded', overwrite_blank)}'''
+    return f'''
+        INSERT INTO objects ({names})
+            SELECT {names} FROM temp.objects_staging WHERE true
+            ON CONFLICT (object_id) {conflict};
+        '''
+
+
+def import_objects(path: str,
+                   chunksize: int = 10000,
+                   sheet_name=0,
+                   sep: str = ',',
+                   rejects_path: str = None,
+                   overwrite_blank: bool = False,
+                   db_path: str = db) -> dict:
+    """
+    Import an object catalog from a CSV or Excel file. Objects that do not exist yet are inserted, existing objects
+    get the values of the file for all columns the file has, other columns and blank cells leave the stored values
+    as they are, so a partial sheet never erases attributes. Every chunk is merged in its own transaction, memory use
+    depends on chunksize only.
+    If an object_id appears more than once in a chunk, the last row wins and the others count as duplicates.
+    :param path: str, path of the CSV or Excel file
+    :param chunksize: int (optional), number of rows read, staged and merged at once
+    :param sheet_name: str or int (optional), name or index of the sheet of Excel files
+    :param sep: str (optional), separator of CSV files
+    :param rejects_path: str (optional), CSV file the rejected rows are written to, with the reason
+    :param overwrite_blank: bool (optional), if True, blank cells set the attribute of existing objects to NULL
+    :param db_path: str (optional), name of the database
+    :return: dict, {'rows', 'inserted', 'updated', 'unchanged', 'duplicates', 'rejected', 'seconds', 'rows_per_s'}
+    """
+    start = time.perf_counter()
+    counts = dict.fromkeys(['rows', 'inserted', 'updated', 'unchanged', 'duplicates', 'rejected'], 0)
+    con = db_builder.connections.get(db_path)
+    con.execute(f'''
+        CREATE TEMP TABLE IF NOT EXISTS objects_staging (
+            object_id TEXT PRIMARY KEY,
+            {', '.join(OBJECT_COLUMNS[1:])});
+        ''')
+    if rejects_path is not None and os.path.exists(rejects_path):
+        os.remove(rejects_path)
+
+    for chunk in read_catalog(path, chunksize, sheet_name, sep):
+        counts['rows'] += len(chunk)
+        objects, rejected = normalize_objects(chunk)
+        counts['rejected'] += len(rejected)
+        if rejects_path is not None and len(rejected):
+            rejected.to_csv(rejects_path, mode='a', index=False, header=not os.path.exists(rejects_path))
+
+        unique = objects.drop_duplicates('object_id', keep='last')
+        counts['duplicates'] += len(objects) - len(unique)
+        columns = unique.columns.tolist()
+
+        with db_queries.cache.write(con, db_path, 'objects'), con:
+            con.execute('DELETE FROM temp.objects_staging;')
+            con.executemany(f'INSERT INTO temp.objects_staging ({", ".join(columns)}) '
+                            f'VALUES ({", ".join("?" * len(columns))});',
+                            unique.astype(object).where(unique.notna(), None).itertuples(index=False, name=None))
+            # counted on the staging table before the merge, total_changes would include the writes of triggers
+            existing, changed = con.execute(f'''
+                SELECT COUNT(*), IFNULL(SUM({_differs(columns, 'objects_staging', overwrite_blank)}), 0)
+                    FROM temp.objects_staging JOIN objects ON objects.object_id = objects_staging.object_id;
+                ''').fetchone()
+            con.execute(_merge_query(columns, overwrite_blank))
+            con.execute('DELETE FROM temp.objects_staging;')
+
+        counts['inserted'] += len(unique) - existing
+        counts['updated'] += changed
+        counts['unchanged'] += existing - changed
+
+    seconds = time.perf_counter() - start
+    return {**counts, 'seconds': seconds, 'rows_per_s': counts['rows'] / seconds if seconds else 0.0}
@@ -1,12 +1,16 @@
+import heapq
+import json
 import random
 import uuid
 
-from typing import List
+from typing import Callable, Iterator, List, Sequence
 
-import scipy.stats
 import pandas as pd
 import numpy as np
 
+import db_builder
+import stats
+
 
 def load_scipy_distribution_by_name(distribution_name: str, distribution_params: dict) -> object:
     """
@@ -15,6 +19,9 @@ def load_scipy_distribution_by_name(distribution_name: str, distribution_params:
     :param distribution_params: Parameters of the distribution to load.
     :return: The distribution.
     """
+    # scipy.stats takes about a second to import and is only needed for length distributions
+    import scipy.stats
+
     distribution = getattr(scipy.stats, distribution_name)
     return distribution(**distribution_params)
 
@@ -28,8 +35,8 @@ def stratified_sampler(df: pd.DataFrame, target_column: str, n_samples: int, ran
     :param random_state: int, random state to use.
     :return: pd.DataFrame, sampled dataframe.
     """
-    return df.groupby(target_column, group_keys=False).apply(lambda x: x.sample(min(len(x), n_samples),
-                                                                                random_state=random_state))
+    shuffled = df.sample(frac=1, random_state=random_state)
+    return shuffled.groupby(target_column, sort=True).head(n_samples).sort_values(target_column, kind='stable')
 
 
 def get_experiment_lengths(distribution: object, n_samples: int, min_length: int, max_length: int) -> List[int]:
@@ -58,13 +65,371 @@ def get_n_uuids(n: int, random_state: int = 42) -> List[str]:
     return [uuid.UUID(int=rd.getrandbits(random_state), version=4).hex[-8:] for _ in range(n)]
 
 
-def get_experiment_ids(start_id: str, n_experiments: int, prefix: str = 'E') -> List[str]:
+def get_experiment_ids(start_id: str = None, n_experiments: int = 1, prefix: str = 'E',
+                       db_path: str = db_builder.db) -> List[str]:
     """
-    Get a list of experiment ids starting at start_id.
-    :param start_id: Starting id. Formatted as "{prefix}0000"
+    Get a list of experiment ids starting at start_id. If no start_id is given, the ids are reserved in the database
+    with db_builder.reserve_experiment_ids, so they are unique even if several processes create experiments at once.
+    :param start_id: Starting id (optional). Formatted as "{prefix}0000"
     :param n_experiments: Number of experiments to get ids for.
     :param prefix: Prefix of the experiment id.
+    :param db_path: Path to the database to reserve ids in (optional).
     :return: List of experiment ids.
     """
-    start_id = int(start_id[1:])
+    if start_id is None:
+        return db_builder.reserve_experiment_ids(n_experiments, db_path)
+    start_id = int(start_id[len(prefix):])
     return [f'{prefix}{i:04}' for i in range(start_id, start_id + n_experiments)]
+
+
+def _draw_without_replacement(rng: np.random.Generator, lengths: np.ndarray, max_length: int,
+                              draw: Callable[[int], np.ndarray]) -> np.ndarray:
+    """
+    Draw lengths[i] distinct indices for every row i at once. Duplicates within a row are redrawn until none are left.
+    :param rng: numpy Generator to draw with.
+    :param lengths: Number of indices per row.
+    :param max_length: Number of columns of the result, at least lengths.max().
+    :param draw: Function returning n candidate indices for a given n.
+    :return: np.ndarray of shape (len(lengths), max_length), entries beyond lengths[i] are -1.
+    """
+    n_rows = len(lengths)
+    indices = np.full((n_rows, max_length), -1, dtype=np.int64)
+    for column in range(max_length):
+        rows = np.flatnonzero(lengths > column)
+        while len(rows):
+            candidates = draw(len(rows))
+            duplicate = (indices[rows, :column] == candidates[:, None]).any(axis=1)
+            indices[rows[~duplicate], column] = candidates[~duplicate]
+            rows = rows[duplicate]
+    return indices
+
+
+def _balanced_assignment(rng: np.random.Generator, lengths: np.ndarray, classes: np.ndarray, usage: np.ndarray,
+                         quotas: dict) -> np.ndarray:
+    """
+    Assign objects to experiments so that the least used objects are used first and the share of every class
+    follows quotas. Every class keeps a heap of its objects ordered by (usage, random tie breaker). The slots of an
+    experiment are split between the classes by smooth weighted round robin on the quotas, then the objects are
+    popped from the heaps and pushed back with usage + 1 after the experiment, so no object is used twice in an
+    experiment.
+    :param rng: numpy Generator for the tie breakers.
+    :param lengths: Number of objects per experiment.
+    :param classes: Class of every object.
+    :param usage: Previous usage of every object.
+    :param quotas: {class: weight}, classes without weight are not used.
+    :return: np.ndarray, object indices of all experiments concatenated.
+    :raises ValueError: if a class has no objects or an experiment is longer than the classes have objects.
+    """
+    names = list(quotas)
+    weights = np.array([quotas[name] for name in names], dtype=float)
+    weights = (weights / weights.sum()).tolist()
+    tie_breakers = rng.permutation(len(classes))
+    heaps = []
+    for name in names:
+        members = np.flatnonzero(classes == name)
+        heap = list(zip(usage[members].tolist(), tie_breakers[members].tolist(), members.tolist()))
+        heapq.heapify(heap)
+        heaps.append(heap)
+    sizes = [len(heap) for heap in heaps]
+    if not all(sizes):
+        raise ValueError(f'no objects for the quota classes {[name for name, size in zip(names, sizes) if not size]}')
+    if len(lengths) and lengths.max() > sum(sizes):
+        raise ValueError(f'experiments with {lengths.max()} objects need at least as many objects in the quota classes '
+                         f'{names}, found {sum(sizes)}')
+
+    n_classes = range(len(names))
+    assigned_per_class = [0] * len(names)
+    total = 0
+    result = np.empty(int(lengths.sum()), dtype=np.int64)
+    position = 0
+    for length in lengths.tolist():
+        counts = [0] * len(names)
+        for _ in range(length):
+            total += 1
+            best = max((c for c in n_classes if counts[c] < sizes[c]),
+                       key=lambda c: weights[c] * total - assigned_per_class[c])
+            counts[best] += 1
+            assigned_per_class[best] += 1
+        for c in n_classes:
+            if counts[c]:
+                heap = heaps[c]
+                popped = [heapq.heappop(heap) for _ in range(counts[c])]
+                for used, tie_breaker, index in popped:
+                    result[position] = index
+                    position += 1
+                    heapq.heappush(heap, (used + 1, tie_breaker, index))
+    return result
+
+
+class SessionPlan:
+    """
+    Session plan in compressed sparse row layout: the objects of experiment i are
+    object_ids[indices[offsets[i]:offsets[i + 1]]]. object_ids is the table of the distinct object ids, so a link
+    costs 4 bytes instead of a Python string in a list. All ids are stored as fixed width numpy strings, so a plan
+    can be saved to one binary file and memory-mapped by load().
+    """
+
+    # first bytes of a saved plan, followed by the length of the JSON header and the header
+    MAGIC = b'BIOCYCLE-PLAN-1\n'
+    ARRAYS = ('session_ids', 'experiment_ids', 'container_ids', 'offsets', 'indices', 'object_ids')
+
+    def __init__(self, session_ids, experiment_ids, container_ids, offsets, indices, object_ids):
+        """
+        :param session_ids: Session id of every experiment.
+        :param experiment_ids: Experiment ids.
+        :param container_ids: Container id of every experiment.
+        :param offsets: int64, position of the first link of every experiment in indices, plus the number of links.
+        :param indices: int32, index into object_ids of every link.
+        :param object_ids: Distinct object ids.
+        """
+        self.session_ids = _strings(session_ids)
+        self.experiment_ids = _strings(experiment_ids)
+        self.container_ids = _strings(container_ids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.object_ids = _strings(object_ids)
+        assert len(self.session_ids) == len(self.experiment_ids) == len(self.container_ids) == len(self.offsets) - 1
+        assert self.offsets[-1] == len(self.indices)
+
+    def __len__(self) -> int:
+        return len(self.experiment_ids)
+
+    def __repr__(self) -> str:
+        return f'SessionPlan({len(self)} experiments, {self.n_links} links, {len(self.object_ids)} objects)'
+
+    @property
+    def n_links(self) -> int:
+        return len(self.indices)
+
+    @property
+    def n_objects(self) -> np.ndarray:
+        """Number of objects of every experiment."""
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the arrays in bytes."""
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def objects(self, i: int) -> List[str]:
+        """Object ids of experiment i."""
+        return self.object_ids[self.indices[self.offsets[i]:self.offsets[i + 1]]].tolist()
+
+    @classmethod
+    def from_frame(cls, plan: pd.DataFrame) -> 'SessionPlan':
+        """
+        Convert a session plan DataFrame (columns: session_id, experiment_id, container_id, objects as lists of
+        object ids), e.g. parsed from a CSV. Ids are stripped like in db_queries.ingest_session_plan.
+        :param plan: pd.DataFrame
+        :return: SessionPlan
+        """
+        lengths = plan['objects'].map(len).to_numpy(dtype=np.int64)
+        links = [str(object_id).strip() for object_ids in plan['objects'] for object_id in object_ids]
+        indices, object_ids = pd.factorize(pd.Series(links, dtype=object), sort=True)
+        return cls(plan['session_id'].str.strip(), plan['experiment_id'].str.strip(), plan['container_id'].str.strip(),
+                   np.concatenate([[0], np.cumsum(lengths)]), indices, object_ids)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: pd.DataFrame, columns: session_id, experiment_id, container_id, objects, n_objects, the format of
+        generate_session_plan
+        """
+        n_objects = self.n_objects
+        links = self.object_ids[self.indices].astype(object)
+        # np.split returns one (empty) part for a plan without experiments
+        objects = [ids.tolist() for ids in np.split(links, self.offsets[1:-1])] if len(self) else []
+        return pd.DataFrame({
+            'session_id': self.session_ids.astype(object),
+            'experiment_id': self.experiment_ids.astype(object),
+            'container_id': self.container_ids.astype(object),
+            'objects': objects,
+            'n_objects': n_objects,
+        })
+
+    @classmethod
+    def concat(cls, plans: Sequence['SessionPlan']) -> 'SessionPlan':
+        """
+        Join several plans, e.g. the plans of several sessions. Plans that share their object table keep it,
+        otherwise the tables are merged.
+        :param plans: SessionPlans
+        :return: SessionPlan
+        """
+        tables = [plan.object_ids for plan in plans]
+        if all(table is tables[0] or np.array_equal(table, tables[0]) for table in tables):
+            object_ids, indices = tables[0], np.concatenate([plan.indices for plan in plans])
+        else:
+            starts = np.cumsum([0] + [len(table) for table in tables[:-1]])
+            object_ids, inverse = np.unique(np.concatenate(tables), return_inverse=True)
+            indices = np.concatenate([inverse[start + plan.indices] for start, plan in zip(starts, plans)])
+        starts = np.cumsum([0] + [plan.n_links for plan in plans[:-1]])
+        offsets = np.concatenate([[0]] + [start + plan.offsets[1:] for start, plan in zip(starts, plans)])
+        return cls(np.concatenate([plan.session_ids for plan in plans]),
+                   np.concatenate([plan.experiment_ids for plan in plans]),
+                   np.concatenate([plan.container_ids for plan in plans]), offsets, indices, object_ids)
+
+    def rows(self, session_id: str = None) -> Iterator[tuple]:
+        """
+        Yield (session_id, experiment_id, container_id, object_ids) per experiment, sorted like the rows of
+        db_queries.get_complete_session, e.g. for capture_jsons.export_session_jsons(..., plan=plan).
+        :param session_id: str (optional), only the experiments of this session
+        """
+        selected = np.arange(len(self)) if session_id is None else np.flatnonzero(self.session_ids == session_id)
+        selected = selected[np.argsort(self.experiment_ids[selected], kind='stable')]
+        for i in selected.tolist():
+            yield (str(self.session_ids[i]), str(self.experiment_ids[i]), str(self.container_ids[i]),
+                   sorted(self.objects(i)))
+
+    def session_counts(self) -> List[tuple]:
+        """:return: List[tuple], [(session_id, number of experiments), ...] in the order of the plan"""
+        session_ids, first, counts = np.unique(self.session_ids, return_index=True, return_counts=True)
+        order = np.argsort(first)
+        return list(zip(session_ids[order].tolist(), counts[order].tolist()))
+
+    def experiment_rows(self) -> List[tuple]:
+        """:return: List[tuple], [(session_id, experiment_id, container_id, n_objects), ...]"""
+        return list(zip(self.session_ids.tolist(), self.experiment_ids.tolist(), self.container_ids.tolist(),
+                        self.n_objects.tolist()))
+
+    def link_rows(self) -> List[tuple]:
+        """:return: List[tuple], [(experiment_id, object_id), ...]"""
+        return list(zip(np.repeat(self.experiment_ids, self.n_objects).tolist(),
+                        self.object_ids[self.indices].tolist()))
+
+    def save(self, path: str) -> None:
+        """
+        Write the plan to one binary file: MAGIC, the length of a JSON header with dtype, shape and position of
+        every array, the header and the raw arrays, each aligned to 64 bytes.
+        :param path: str, path of the file
+        :return: None
+        """
+        arrays = [(name, np.ascontiguousarray(getattr(self, name))) for name in self.ARRAYS]
+        header, positions, end = {}, [], 0
+        for name, array in arrays:
+            header[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'position': end}
+            positions.append(end)
+            end += -(-array.nbytes // 64) * 64
+        header = json.dumps(header).encode('utf-8')
+        start = -(-(len(self.MAGIC) + 8 + len(header)) // 64) * 64
+        with open(path, 'wb') as f:
+            f.write(self.MAGIC + len(header).to_bytes(8, 'little') + header)
+            for (_, array), position in zip(arrays, positions):
+                f.seek(start + position)
+                f.write(array.tobytes())
+            f.truncate(start + end)
+        return None
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'SessionPlan':
+        """
+        Read a plan written by save().
+        :param path: str, path of the file
+        :param mmap: bool (optional), memory-map the arrays read-only instead of reading them into memory
+        :return: SessionPlan
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f'{path} is not a saved SessionPlan')
+            size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(size))
+        start = -(-(len(cls.MAGIC) + 8 + size) // 64) * 64
+        arrays = {}
+        for name, spec in header.items():
+            dtype, shape, offset = np.dtype(spec['dtype']), tuple(spec['shape']), start + spec['position']
+            if mmap and np.prod(shape):
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+            else:
+                arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        return cls(**arrays)
+
+
+def _strings(values) -> np.ndarray:
+    """Fixed width numpy string array of values, arrays that already are one are not copied."""
+    values = values if isinstance(values, np.ndarray) else np.asarray(list(values), dtype=object)
+    return values if values.dtype.kind == 'U' else values.astype(str)
+
+
+def generate_session_plan(session_id: str,
+                          experiment_ids: Sequence[str],
+                          objects: pd.DataFrame,
+                          containers: Sequence[str],
+                          min_length: int,
+                          max_length: int,
+                          distribution: object = None,
+                          stratify_column: str = None,
+                          random_state: int = 42,
+                          balance_usage: bool = False,
+                          usage: dict = None,
+                          quotas: dict = None,
+                          quota_column: str = 'polymer_type',
+                          object_ids: np.ndarray = None,
+                          db_path: str = db_builder.db,
+                          as_plan: bool = False):
+    """
+    Create a session plan in one batch: experiment lengths, containers and object assignments are drawn with a
+    single numpy Generator, so the plan is reproducible from random_state.
+    :param session_id: Session id of all experiments.
+    :param experiment_ids: Experiment ids, one experiment is created per id.
+    :param objects: pd.DataFrame of objects to sample from, must contain object_id (and stratify_column if given).
+    :param containers: Container ids to sample from (with replacement).
+    :param min_length: Minimum number of objects per experiment.
+    :param max_length: Maximum number of objects per experiment, at most the number of objects.
+    :param distribution: scipy distribution of the experiment lengths (optional), uniform if not given.
+    :param stratify_column: Column of objects to stratify on (optional). If given, every object slot first draws a
+    class uniformly and then an object of that class, otherwise objects are drawn uniformly.
+    :param random_state: Seed of the Generator.
+    :param balance_usage: If True, the least used objects are assigned first instead of drawing objects at random,
+    counting the experiments of earlier sessions (see _balanced_assignment). stratify_column is ignored.
+    :param usage: {object_id: number of experiments} (optional), read from the database if not given.
+    :param quotas: {value of quota_column: weight} (optional), share of the objects of each value, e.g.
+    {'pe': 2, 'pp': 1}. Only used with balance_usage, if not given all objects are balanced as one group.
+    :param quota_column: Column of objects the quotas refer to.
+    :param object_ids: objects['object_id'].to_numpy(dtype=str) (optional). Converting the ids to numpy strings takes
+    about 0.1 s per 500k objects, callers that draw many plans from the same objects convert them once and pass them.
+    :param db_path: Database to read the usage from (optional).
+    :param as_plan: If True, return a SessionPlan, which is built from the drawn arrays without Python lists.
+    :return: pd.DataFrame, columns: session_id, experiment_id, container_id, objects, n_objects, or SessionPlan
+    """
+    n_experiments = len(experiment_ids)
+    assert max_length <= len(objects), 'max_length must not exceed the number of objects'
+    rng = np.random.default_rng(random_state)
+
+    if distribution is None or n_experiments == 0:
+        lengths = rng.integers(min_length, max_length + 1, size=n_experiments)
+    else:
+        samples = distribution.rvs(size=n_experiments, random_state=rng)
+        lengths = np.interp(samples, (samples.min(), samples.max()), (min_length, max_length)).astype(np.int64)
+
+    container_ids = rng.choice(np.asarray(containers, dtype=object), size=n_experiments)
+    if object_ids is None:
+        object_ids = objects['object_id'].to_numpy(dtype=str)
+    assert len(object_ids) == len(objects), 'object_ids must have one id per row of objects'
+
+    if balance_usage:
+        if usage is None:
+            usage = stats.usage_counts(db_path)
+        previous = objects['object_id'].map(usage).fillna(0).to_numpy(dtype=np.int64)
+        if quotas is None:
+            classes, quotas = np.zeros(len(objects), dtype=np.int64), {0: 1}
+        else:
+            classes = objects[quota_column].to_numpy(dtype=object)
+        links = _balanced_assignment(rng, lengths, classes, previous, quotas)
+    else:
+        if stratify_column is None:
+            def draw(n):
+                return rng.integers(0, len(object_ids), size=n)
+        else:
+            # positions of the objects sorted by class, so object_ids keeps the order of objects
+            strata = objects[stratify_column].to_numpy()
+            order = np.argsort(strata, kind='stable')
+            _, starts, sizes = np.unique(strata[order], return_index=True, return_counts=True)
+
+            def draw(n):
+                classes = rng.integers(0, len(sizes), size=n)
+                return order[starts[classes] + (rng.random(n) * sizes[classes]).astype(np.int64)]
+
+        indices = _draw_without_replacement(rng, lengths, max_length, draw)
+        links = indices[indices >= 0]
+
+    plan = SessionPlan(np.full(n_experiments, session_id), list(experiment_ids), container_ids,
+                       np.concatenate([[0], np.cumsum(lengths)]), links, object_ids)
+    return plan if as_plan else plan.to_frame()
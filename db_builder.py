@@ -1,7 +1,27 @@
+import os
 import sqlite3 as sql
+import threading
+import urllib.parse
+
+from contextlib import contextmanager
+from typing import List
 
 db = './data/biocycle_tracking.db'
 
+# applied once to every connection handed out by the connection manager
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # negative values are KiB, i.e. 64 MB
+    'mmap_size': 268435456,  # 256 MB
+    'foreign_keys': 'ON',  # enforces the references of migration 5, deleting a session cascades to its experiments
+    'recursive_triggers': 'ON',  # INSERT OR REPLACE fires the delete triggers of the replaced row, see migration 4
+}
+
+# number of prepared statements each connection keeps, all queries in db_queries use bound parameters, so their
+# statements are parsed once per connection and then reused from this cache
+STATEMENT_CACHE_SIZE = 256
+
 
 def create_database_file(db_name: str = db) -> None:
     """
@@ -18,15 +38,242 @@ def create_database_file(db_name: str = db) -> None:
     return None
 
 
-def get_db_connection(db_name: str = db) -> sql.connect:
+def get_db_connection(db_name: str = db, read_only: bool = False) -> sql.connect:
     conn = None
     try:
-        conn = sql.connect(db_name)
+        if read_only:
+            conn = sql.connect(read_only_uri(db_name), uri=True)
+            apply_pragmas(conn, {'query_only': 'ON'})
+        else:
+            conn = sql.connect(db_name)
     except sql.Error as e:
         print(e)
     return conn
 
 
+def apply_pragmas(conn: sql.Connection, pragmas: dict = None) -> None:
+    """
+    Apply the given pragmas (default: PRAGMAS) to an open connection.
+    :param conn: open sqlite connection
+    :param pragmas: dict (optional), pragma name -> value
+    :return: None
+    """
+    for name, value in (PRAGMAS if pragmas is None else pragmas).items():
+        conn.execute(f'PRAGMA {name} = {value};')
+    return None
+
+
+def read_only_uri(db_name: str) -> str:
+    """
+    Return a 'file:' URI that opens db_name read-only (mode=ro). A read-only connection can never take the write lock,
+    so it never blocks the writer, and fails instead of changing the database.
+    :param db_name: name of the database file or a 'file:' URI
+    :return: str
+    """
+    if db_name == ':memory:':
+        raise ValueError('an in-memory database cannot be opened read-only')
+    if not db_name.startswith('file:'):
+        db_name = 'file:' + urllib.parse.quote(os.path.abspath(db_name))
+    return db_name + ('&' if '?' in db_name else '?') + 'mode=ro'
+
+
+def setup_wal(db_name: str = db) -> str:
+    """
+    Switch a database file to write-ahead logging. The mode is stored in the file, every later connection of any
+    process uses it: readers read from a consistent snapshot while one writer appends to the log, so a writer never
+    blocks readers and readers never block the writer. Connections of the connection manager do this on open.
+    :param db_name: name of the database file
+    :return: str, journal mode of the file after the call, 'wal' unless the file system does not support it
+    """
+    con = connections.get(db_name)
+    return con.execute('PRAGMA journal_mode = WAL;').fetchone()[0]
+
+
+def normalize_db_path(db_name: str) -> str:
+    """
+    Return an absolute path for database files, so different spellings of the same path refer to the same database.
+    :param db_name: name of the database file, ':memory:' or a 'file:' URI
+    :return: str
+    """
+    if db_name != ':memory:' and not db_name.startswith('file:'):
+        db_name = os.path.abspath(db_name)
+    return db_name
+
+
+class ConnectionManager:
+    """
+    Hands out one long-lived connection per thread and database file, so repeated queries do not reopen the file.
+    Connections are created lazily by get() and stay open until close() or close_all() is called. Used as a
+    context manager, all connections are closed on exit. Callables in on_connect are called with every new
+    connection, e.g. to install callbacks (see instrumentation).
+
+    With auto_migrate=True the first write connection of the process to a database file applies the pending MIGRATIONS
+    (see migrate), so notebooks and scripts can use a database built by an older version without upgrading it first.
+    Files without the tables of create_schema are left alone.
+
+    With read_only=True (or read_only=True passed to get()) connections are opened with mode=ro and query_only, e.g.
+    set connections.read_only = True in processes that only read, like the capture station or analytics notebooks.
+    """
+
+    def __init__(self, pragmas: dict = None, read_only: bool = False, auto_migrate: bool = True):
+        self.pragmas = PRAGMAS if pragmas is None else pragmas
+        self.read_only = read_only
+        self.auto_migrate = auto_migrate
+        self.on_connect = []
+        self._connections = {}
+        self._migrated = {}  # database file -> True once migrated, False while the migration runs
+        self._lock = threading.Lock()
+        self._migrate_lock = threading.RLock()
+
+    @staticmethod
+    def _key(db_name: str, read_only: bool) -> tuple:
+        return threading.get_ident(), normalize_db_path(db_name), read_only
+
+    def _connect(self, db_name: str, read_only: bool) -> sql.Connection:
+        if read_only:
+            conn = sql.connect(read_only_uri(db_name), check_same_thread=False, uri=True,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+            # a read-only connection cannot change the journal mode of the file
+            apply_pragmas(conn, {**{name: value for name, value in self.pragmas.items() if name != 'journal_mode'},
+                                 'query_only': 'ON'})
+        else:
+            conn = sql.connect(db_name, check_same_thread=False, uri=db_name.startswith('file:'),
+                               cached_statements=STATEMENT_CACHE_SIZE)
+            apply_pragmas(conn, self.pragmas)
+        for callback in self.on_connect:
+            callback(conn)
+        return conn
+
+    def _migrate(self, db_name: str, conn: sql.Connection) -> None:
+        """Apply the pending migrations to db_name once per process, see auto_migrate."""
+        name = normalize_db_path(db_name)
+        if name == ':memory:' or self._migrated.get(name):
+            return
+        # other threads wait here until the migration is done, migrate itself calls get() again in this thread
+        with self._migrate_lock:
+            if name in self._migrated:
+                return
+            self._migrated[name] = False
+            try:
+                tables = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'experiments';")
+                if tables.fetchone() is not None:
+                    migrate(db_name)
+            except BaseException:
+                del self._migrated[name]
+                raise
+            self._migrated[name] = True
+        return None
+
+    def get(self, db_name: str = db, read_only: bool = None) -> sql.Connection:
+        """
+        Return the connection of the calling thread to db_name, opening it if necessary.
+        :param db_name: name of the database file
+        :param read_only: bool (optional), return a read-only connection, default: self.read_only
+        :return: open sqlite connection
+        """
+        key = self._key(db_name, self.read_only if read_only is None else read_only)
+        conn = self._connections.get(key)
+        if conn is None:
+            conn = self._connect(db_name, key[2])
+            with self._lock:
+                self._connections[key] = conn
+            if self.auto_migrate and not key[2]:
+                self._migrate(db_name, conn)
+        return conn
+
+    @contextmanager
+    def snapshot(self, db_name: str = db):
+        """
+        Pin a consistent view of db_name for the calling thread, e.g. for long exports. A new read-only connection
+        starts a read transaction and replaces the connections of the thread until the end of the with block, so all
+        functions of db_queries called inside it see the database as it was at the start, no matter what other
+        connections commit in the meantime. Writes inside the block fail. In WAL mode the log cannot be checkpointed
+        past the snapshot while it is open, keep snapshots as short as the job allows.
+
+            with db_builder.connections.snapshot() as con:
+                sessions = db_queries.run_query('SELECT * FROM sessions')
+                experiments = db_queries.get_complete_sessions(sessions['session_id'].tolist())
+
+        :param db_name: name of the database file
+        :return: context manager yielding the read-only connection of the snapshot
+        """
+        conn = self._connect(db_name, read_only=True)
+        conn.execute('BEGIN;')
+        conn.execute('SELECT COUNT(*) FROM sqlite_master;').fetchone()  # the snapshot starts with the first read
+        keys = [self._key(db_name, False), self._key(db_name, True)]
+        with self._lock:
+            previous = [self._connections.get(key) for key in keys]
+            for key in keys:
+                self._connections[key] = conn
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                for key, previous_conn in zip(keys, previous):
+                    if previous_conn is None:
+                        self._connections.pop(key, None)
+                    else:
+                        self._connections[key] = previous_conn
+            conn.rollback()
+            conn.close()
+
+    def open_connections(self) -> List[sql.Connection]:
+        """
+        Return the open connections of all threads.
+        :return: List[sql.Connection]
+        """
+        with self._lock:
+            return list(self._connections.values())
+
+    def close(self, db_name: str = db) -> None:
+        """
+        Close the connections of the calling thread to db_name, if any are open.
+        :param db_name: name of the database file
+        :return: None
+        """
+        with self._lock:
+            conns = [self._connections.pop(self._key(db_name, read_only), None) for read_only in (False, True)]
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+        return None
+
+    def close_thread(self, thread_id: int) -> None:
+        """
+        Close all connections opened by the thread with the given ident, e.g. after a worker thread has finished.
+        :param thread_id: int, threading.get_ident() of the thread
+        :return: None
+        """
+        with self._lock:
+            keys = [key for key in self._connections if key[0] == thread_id]
+            conns = [self._connections.pop(key) for key in keys]
+        for conn in conns:
+            conn.close()
+        return None
+
+    def close_all(self) -> None:
+        """
+        Close all connections of all threads.
+        :return: None
+        """
+        with self._lock:
+            conns, self._connections = list(self._connections.values()), {}
+        for conn in conns:
+            conn.close()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_all()
+        return False
+
+
+# shared by all query functions in db_builder and db_queries
+connections = ConnectionManager()
+
+
 def create_table(conn, create_table_sql):
     try:
         c = conn.cursor()
@@ -36,7 +283,7 @@ def create_table(conn, create_table_sql):
 
 
 def create_schema(db_path: str = db) -> None:
-    con = get_db_connection(db_path)
+    con = connections.get(db_path)
 
     sessions_table = '''
         CREATE TABLE IF NOT EXISTS sessions (
@@ -101,35 +348,511 @@ def create_schema(db_path: str = db) -> None:
             UNIQUE (experiment_id, object_id));
             '''
     create_table(con, experiments_table)
+
+    migrate(db_path)
     return None
 
 
-def get_next_experiment_id(db_path: str = db) -> str:
-    con = get_db_connection(db_path)
-    query = '''
-        SELECT experiment_id FROM experiments ORDER BY experiment_id DESC LIMIT 1;
-        '''
-    result = con.execute(query).fetchone()
-    con.close()
+def _change_trigger(table: str, event: str, session_ids: str) -> str:
+    """
+    Change tracking trigger: set the version of all sessions returned by session_ids to the current change version.
+    Sessions that already have it are skipped, so bulk inserts into one session write session_changes only once.
+    """
+    pending = f'''FROM ({session_ids}) AS changed, id_counters AS counter
+                    WHERE counter.name = 'session_changes' AND changed.session_id IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM session_changes
+                                      WHERE session_id = changed.session_id AND version = counter.next_value)'''
+    return f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_session_changes AFTER {event} ON {table}
+            WHEN EXISTS (SELECT 1 {pending})
+            BEGIN
+                INSERT INTO session_changes (session_id, version)
+                    SELECT changed.session_id, counter.next_value {pending}
+                    ON CONFLICT (session_id) DO UPDATE SET version = excluded.version;
+            END;'''
 
-    if result is None:
-        return 'E0000'
-    else:
-        return f'E{int(result[0][1:]) + 1:04}'
 
+_OBJECT_SESSIONS = '''SELECT experiments.session_id FROM experiment_objects
+                     JOIN experiments ON experiments.experiment_id = experiment_objects.experiment_id
+                     WHERE experiment_objects.object_id = {row}.object_id'''
+_CONTAINER_SESSIONS = 'SELECT session_id FROM experiments WHERE container_id = {row}.container_id'
+_LINK_SESSIONS = 'SELECT session_id FROM experiments WHERE experiment_id = {row}.experiment_id'
+
+# Summary tables of the stats module and the queries that compute them from scratch. The triggers of migration 4 keep
+# them up to date, rows whose count dropped to 0 are kept.
+SUMMARY_TABLES = {
+    'stats_object_usage': (
+        ['object_id'], 'n_experiments',
+        'SELECT object_id, COUNT(*) FROM experiment_objects GROUP BY object_id'),
+    'stats_session_experiments': (
+        ['session_id'], 'n_experiments',
+        'SELECT session_id, COUNT(*) FROM experiments WHERE session_id IS NOT NULL GROUP BY session_id'),
+    'stats_session_polymers': (
+        ['session_id', 'polymer_type'], 'n_objects',
+        '''SELECT experiments.session_id, IFNULL(objects.polymer_type, ''), COUNT(*) FROM experiment_objects
+            JOIN experiments ON experiments.experiment_id = experiment_objects.experiment_id
+            LEFT JOIN objects ON objects.object_id = experiment_objects.object_id
+            WHERE experiments.session_id IS NOT NULL GROUP BY 1, 2'''),
+    'stats_container_polymers': (
+        ['container_id', 'polymer_type'], 'n_objects',
+        '''SELECT experiments.container_id, IFNULL(objects.polymer_type, ''), COUNT(*) FROM experiment_objects
+            JOIN experiments ON experiments.experiment_id = experiment_objects.experiment_id
+            LEFT JOIN objects ON objects.object_id = experiment_objects.object_id
+            WHERE experiments.container_id IS NOT NULL GROUP BY 1, 2'''),
+}
+
+
+def _add_counts(table: str, select: str) -> str:
+    """Statement adding the counts returned by select (keys..., delta) to a summary table."""
+    keys, count, _ = SUMMARY_TABLES[table]
+    return f'''INSERT INTO {table} ({', '.join(keys)}, {count}) {select}
+                    ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {count} = {count} + excluded.{count};'''
+
+
+def _add_polymer_counts(select: str) -> List[str]:
+    """select with a {group} placeholder for session_id or container_id, applied to both polymer histograms."""
+    return [_add_counts(f'stats_{group}_polymers', select.format(group=f'{group}_id'))
+            for group in ('session', 'container')]
+
+
+def _link_counts(row: str, sign: int) -> List[str]:
+    return [_add_counts('stats_object_usage', f'SELECT {row}.object_id, {sign} WHERE true')] + _add_polymer_counts(
+        f'''SELECT experiments.{{group}}, IFNULL(objects.polymer_type, ''), {sign} FROM experiments
+            LEFT JOIN objects ON objects.object_id = {row}.object_id
+            WHERE experiments.experiment_id = {row}.experiment_id AND experiments.{{group}} IS NOT NULL''')
+
+
+def _session_experiment_counts(row: str, sign: int) -> List[str]:
+    return [_add_counts('stats_session_experiments',
+                        f'SELECT {row}.session_id, {sign} WHERE {row}.session_id IS NOT NULL')]
+
+
+def _experiment_polymer_counts(row: str, sign: int) -> List[str]:
+    return _add_polymer_counts(
+        f'''SELECT {row}.{{group}}, IFNULL(objects.polymer_type, ''), {sign} * COUNT(*) FROM experiment_objects
+            LEFT JOIN objects ON objects.object_id = experiment_objects.object_id
+            WHERE experiment_objects.experiment_id = {row}.experiment_id AND {row}.{{group}} IS NOT NULL
+            GROUP BY 2''')
 
-def get_next_session_id(db_path: str = db) -> str:
-    con = get_db_connection(db_path)
-    query = '''
-        SELECT session_id FROM sessions ORDER BY session_id DESC LIMIT 1;
-        '''
-    result = con.execute(query).fetchone()
-    con.close()
 
-    if result is None:
-        return 'S0000'
-    else:
-        return f'S{int(result[0][1:]) + 1:04}'
+def _experiment_counts(row: str, sign: int) -> List[str]:
+    return _session_experiment_counts(row, sign) + _experiment_polymer_counts(row, sign)
+
+
+def _object_counts(row: str, polymer_type: str, sign: int) -> List[str]:
+    return _add_polymer_counts(
+        f'''SELECT experiments.{{group}}, IFNULL({polymer_type}, ''), {sign} * COUNT(*) FROM experiment_objects
+            JOIN experiments ON experiments.experiment_id = experiment_objects.experiment_id
+            WHERE experiment_objects.object_id = {row}.object_id AND experiments.{{group}} IS NOT NULL
+            GROUP BY 1''')
+
+
+def _stats_trigger(table: str, event: str, statements: List[str], when: str = None, timing: str = 'AFTER') -> str:
+    prefix = '' if timing == 'AFTER' else f'{timing.lower()}_'
+    name = f'trg_{table}_{prefix}{event.split()[0].lower()}_stats'
+    condition = f' WHEN {when}' if when else ''
+    body = '\n                '.join(statements)
+    return f'''CREATE TRIGGER IF NOT EXISTS {name} {timing} {event} ON {table}{condition}
+            BEGIN
+                {body}
+            END;'''
+
+
+def _search_index(table: str) -> List[str]:
+    """
+    Full text index {table}_fts on the note column of table, an external content FTS5 table that refers to the rows
+    by rowid and is kept in sync by triggers. Rebuilding table (_rebuild_table) changes the rowids, rebuild the index
+    afterwards with INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild').
+    """
+    delete = f"INSERT INTO {table}_fts ({table}_fts, rowid, note) VALUES ('delete', OLD.rowid, OLD.note);"
+    insert = f'INSERT INTO {table}_fts (rowid, note) VALUES (NEW.rowid, NEW.note);'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5 (note, content='{table}', content_rowid='rowid');",
+        f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild');",
+        f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_insert_fts AFTER INSERT ON {table}
+            BEGIN
+                {insert}
+            END;''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_delete_fts AFTER DELETE ON {table}
+            BEGIN
+                {delete}
+            END;''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_update_fts AFTER UPDATE OF note ON {table}
+            WHEN OLD.note IS NOT NEW.note
+            BEGIN
+                {delete}
+                {insert}
+            END;''',
+    ]
+
+
+def _rebuild_table(table: str, create_table_sql: str):
+    """
+    Migration step that changes the definition of a table, which ALTER TABLE cannot do for constraints: create the
+    new table, copy the rows of all columns both tables have, drop the old table, rename the new one and recreate
+    the indexes and triggers of the old table. Must run with foreign keys off, see migrate.
+    :param table: str, name of the table
+    :param create_table_sql: str, CREATE TABLE statement of the new definition with {table} as name placeholder
+    :return: callable, run by migrate with the connection
+    """
+    def rebuild(con: sql.Connection) -> None:
+        dependents = [row[0] for row in con.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL;",
+            (table,))]
+        old_columns = [row[1] for row in con.execute(f'PRAGMA table_info({table});')]
+        con.execute(create_table_sql.format(table=f'{table}_new'))
+        columns = ', '.join(row[1] for row in con.execute(f'PRAGMA table_info({table}_new);')
+                            if row[1] in old_columns)
+        con.execute(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table};')
+        con.execute(f'DROP TABLE {table};')
+        # triggers of other tables refer to the dropped table, the legacy rename does not try to rewrite them
+        con.execute('PRAGMA legacy_alter_table = ON;')
+        try:
+            con.execute(f'ALTER TABLE {table}_new RENAME TO {table};')
+        finally:
+            con.execute('PRAGMA legacy_alter_table = OFF;')
+        for statement in dependents:
+            con.execute(statement)
+        return None
+
+    return rebuild
+
+
+# Schema migrations. Entry i upgrades the schema from version i to version i + 1. Statements of one migration are
+# applied in a single transaction, a statement can also be a callable that gets the connection. Never edit a released
+# migration, append a new one instead.
+MIGRATIONS = [
+    # 1: secondary indexes for the session, object history, polymer type and container lookups
+    [
+        'CREATE INDEX IF NOT EXISTS idx_experiments_session_id ON experiments (session_id);',
+        'CREATE INDEX IF NOT EXISTS idx_experiments_container_id ON experiments (container_id);',
+        'CREATE INDEX IF NOT EXISTS idx_experiment_objects_object_id ON experiment_objects (object_id);',
+        'CREATE INDEX IF NOT EXISTS idx_objects_polymer_type ON objects (polymer_type);',
+    ],
+    # 2: id counters for race-free id allocation, seeded from the existing ids and kept ahead of explicit inserts
+    [
+        '''CREATE TABLE IF NOT EXISTS id_counters (
+            name TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL);''',
+        '''INSERT OR IGNORE INTO id_counters (name, next_value)
+            SELECT 'experiment', COALESCE(MAX(CAST(SUBSTR(experiment_id, 2) AS INTEGER)) + 1, 0) FROM experiments
+            WHERE experiment_id GLOB 'E[0-9]*';''',
+        '''INSERT OR IGNORE INTO id_counters (name, next_value)
+            SELECT 'session', COALESCE(MAX(CAST(SUBSTR(session_id, 2) AS INTEGER)) + 1, 0) FROM sessions
+            WHERE session_id GLOB 'S[0-9]*';''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_experiments_id_counter AFTER INSERT ON experiments
+            WHEN NEW.experiment_id GLOB 'E[0-9]*'
+            BEGIN
+                UPDATE id_counters SET next_value = MAX(next_value, CAST(SUBSTR(NEW.experiment_id, 2) AS INTEGER) + 1)
+                WHERE name = 'experiment';
+            END;''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_sessions_id_counter AFTER INSERT ON sessions
+            WHEN NEW.session_id GLOB 'S[0-9]*'
+            BEGIN
+                UPDATE id_counters SET next_value = MAX(next_value, CAST(SUBSTR(NEW.session_id, 2) AS INTEGER) + 1)
+                WHERE name = 'session';
+            END;''',
+    ],
+    # 3: change tracking for incremental exports, every change of a session, its experiments, their objects or
+    # containers sets the version of the session to the current change version, see start_change_version
+    [
+        '''CREATE TABLE IF NOT EXISTS session_changes (
+            session_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL);''',
+        'CREATE INDEX IF NOT EXISTS idx_session_changes_version ON session_changes (version);',
+        "INSERT OR IGNORE INTO id_counters (name, next_value) VALUES ('session_changes', 1);",
+        '''INSERT OR IGNORE INTO session_changes (session_id, version)
+            SELECT session_id, 0 FROM sessions
+            UNION SELECT session_id, 0 FROM experiments WHERE session_id IS NOT NULL;''',
+        _change_trigger('sessions', 'INSERT', 'SELECT NEW.session_id AS session_id'),
+        _change_trigger('sessions', 'UPDATE', 'SELECT OLD.session_id AS session_id UNION SELECT NEW.session_id'),
+        _change_trigger('sessions', 'DELETE', 'SELECT OLD.session_id AS session_id'),
+        _change_trigger('experiments', 'INSERT', 'SELECT NEW.session_id AS session_id'),
+        _change_trigger('experiments', 'UPDATE', 'SELECT OLD.session_id AS session_id UNION SELECT NEW.session_id'),
+        _change_trigger('experiments', 'DELETE', 'SELECT OLD.session_id AS session_id'),
+        _change_trigger('experiment_objects', 'INSERT', _LINK_SESSIONS.format(row='NEW')),
+        _change_trigger('experiment_objects', 'UPDATE',
+                        f"{_LINK_SESSIONS.format(row='OLD')} UNION {_LINK_SESSIONS.format(row='NEW')}"),
+        _change_trigger('experiment_objects', 'DELETE', _LINK_SESSIONS.format(row='OLD')),
+        _change_trigger('objects', 'INSERT', _OBJECT_SESSIONS.format(row='NEW')),
+        _change_trigger('objects', 'UPDATE',
+                        f"{_OBJECT_SESSIONS.format(row='OLD')} UNION {_OBJECT_SESSIONS.format(row='NEW')}"),
+        _change_trigger('objects', 'DELETE', _OBJECT_SESSIONS.format(row='OLD')),
+        _change_trigger('containers', 'INSERT', _CONTAINER_SESSIONS.format(row='NEW')),
+        _change_trigger('containers', 'UPDATE',
+                        f"{_CONTAINER_SESSIONS.format(row='OLD')} UNION {_CONTAINER_SESSIONS.format(row='NEW')}"),
+        _change_trigger('containers', 'DELETE', _CONTAINER_SESSIONS.format(row='OLD')),
+    ],
+    # 4: summary tables of the stats module, seeded from the existing data and maintained by triggers
+    [
+        *(f'''CREATE TABLE IF NOT EXISTS {table} (
+            {', '.join(f'{key} TEXT NOT NULL' for key in keys)},
+            {count} INTEGER NOT NULL,
+            PRIMARY KEY ({', '.join(keys)}));''' for table, (keys, count, _) in SUMMARY_TABLES.items()),
+        *(f'INSERT OR REPLACE INTO {table} {select};' for table, (_, _, select) in SUMMARY_TABLES.items()),
+        _stats_trigger('experiment_objects', 'INSERT', _link_counts('NEW', 1)),
+        _stats_trigger('experiment_objects', 'DELETE', _link_counts('OLD', -1)),
+        _stats_trigger('experiment_objects', 'UPDATE', _link_counts('OLD', -1) + _link_counts('NEW', 1)),
+        _stats_trigger('experiments', 'INSERT', _experiment_counts('NEW', 1)),
+        _stats_trigger('experiments', 'DELETE', _experiment_counts('OLD', -1)),
+        _stats_trigger('experiments', 'UPDATE OF experiment_id, session_id, container_id',
+                       _experiment_counts('OLD', -1) + _experiment_counts('NEW', 1)),
+        # links added before their object count as polymer_type '', an object moves them between polymer types
+        _stats_trigger('objects', 'INSERT',
+                       _object_counts('NEW', 'NULL', -1) + _object_counts('NEW', 'NEW.polymer_type', 1),
+                       when="IFNULL(NEW.polymer_type, '') != ''"),
+        _stats_trigger('objects', 'DELETE',
+                       _object_counts('OLD', 'OLD.polymer_type', -1) + _object_counts('OLD', 'NULL', 1),
+                       when="IFNULL(OLD.polymer_type, '') != ''"),
+        _stats_trigger('objects', 'UPDATE OF object_id, polymer_type',
+                       _object_counts('OLD', 'OLD.polymer_type', -1) + _object_counts('NEW', 'NEW.polymer_type', 1),
+                       when="IFNULL(OLD.polymer_type, '') != IFNULL(NEW.polymer_type, '') "
+                            "OR OLD.object_id != NEW.object_id"),
+    ],
+    # 5: foreign keys with ON DELETE CASCADE from sessions to experiments to experiment_objects, so deletes are done
+    # by the database in one statement. Links left behind by interrupted deletes are removed, sessions that are only
+    # referenced by experiments are created. objects and containers are catalogs that are filled independently of the
+    # experiments, references to them are not enforced.
+    [
+        'DELETE FROM experiment_objects WHERE experiment_id NOT IN (SELECT experiment_id FROM experiments);',
+        '''INSERT INTO sessions (session_id)
+            SELECT DISTINCT session_id FROM experiments
+            WHERE session_id IS NOT NULL AND session_id NOT IN (SELECT session_id FROM sessions);''',
+        _rebuild_table('experiments', '''
+            CREATE TABLE {table} (
+                experiment_id TEXT PRIMARY KEY,
+                container_id TEXT,
+                n_objects INTEGER,
+                session_id TEXT,
+                file_path TEXT,
+                FOREIGN KEY(session_id) REFERENCES sessions(session_id) ON DELETE CASCADE);'''),
+        _rebuild_table('experiment_objects', '''
+            CREATE TABLE {table} (
+                experiment_id TEXT,
+                object_id TEXT,
+                PRIMARY KEY (experiment_id, object_id),
+                FOREIGN KEY(experiment_id) REFERENCES experiments(experiment_id) ON DELETE CASCADE);'''),
+    ],
+    # 6: status and alignment the capture software writes into the exported data.json files, synced back by
+    # capture_sync together with the modification time and size of every file, so unchanged files are not parsed
+    # again. Calibration and empty tray folders are included, so experiment_id does not reference experiments.
+    [
+        '''CREATE TABLE IF NOT EXISTS capture_status (
+            session_id TEXT NOT NULL,
+            experiment_id TEXT NOT NULL,
+            status TEXT,
+            aligned INTEGER,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (session_id, experiment_id));''',
+        'CREATE INDEX IF NOT EXISTS idx_capture_status_status ON capture_status (status);',
+    ],
+    # 7: attribute search over the catalogs, see db_queries.find_objects: compound indexes for the usual sample filters
+    # (polymer type with a length range, reference image, visual attributes) and full text indexes on the notes of
+    # objects and containers. The reference image index ends with object_id, so the pages of find_objects for the
+    # usual sample query are read in order without sorting. idx_objects_polymer_type is a prefix of
+    # idx_objects_polymer_type_length.
+    [
+        'CREATE INDEX IF NOT EXISTS idx_objects_polymer_type_length ON objects (polymer_type, length);',
+        '''CREATE INDEX IF NOT EXISTS idx_objects_reference_image_polymer_type
+            ON objects (reference_image, polymer_type, object_id);''',
+        'CREATE INDEX IF NOT EXISTS idx_objects_color_contamination_form ON objects (color, contamination, form);',
+        'DROP INDEX IF EXISTS idx_objects_polymer_type;',
+        *_search_index('objects'),
+        *_search_index('containers'),
+    ],
+    # 8: polymer counts of deleted experiments. Since migration 5 the links of a deleted experiment are removed by the
+    # cascade after the experiment row and before its AFTER DELETE trigger, so neither the link triggers (which join
+    # the experiment) nor the experiment trigger (which counts the links) saw them. The experiment trigger now
+    # subtracts the links BEFORE DELETE, while they still exist. The summary tables are recomputed.
+    [
+        'DROP TRIGGER IF EXISTS trg_experiments_delete_stats;',
+        _stats_trigger('experiments', 'DELETE', _experiment_polymer_counts('OLD', -1), timing='BEFORE'),
+        _stats_trigger('experiments', 'DELETE', _session_experiment_counts('OLD', -1)),
+        *(f'DELETE FROM {table};' for table in SUMMARY_TABLES),
+        *(f'INSERT INTO {table} {select};' for table, (_, _, select) in SUMMARY_TABLES.items()),
+    ],
+    # 9: polymer counts of renamed objects. The links of the old object_id lose their object and count as polymer_type
+    # '', the links of the new object_id (added before their object) leave ''. The update trigger of migration 4 only
+    # moved the links between the polymer types of the old and the new row. The summary tables are recomputed.
+    [
+        'DROP TRIGGER IF EXISTS trg_objects_update_stats;',
+        _stats_trigger('objects', 'UPDATE OF object_id, polymer_type',
+                       _object_counts('OLD', 'OLD.polymer_type', -1) + _object_counts('OLD', 'NULL', 1)
+                       + _object_counts('NEW', 'NULL', -1) + _object_counts('NEW', 'NEW.polymer_type', 1),
+                       when="IFNULL(OLD.polymer_type, '') != IFNULL(NEW.polymer_type, '') "
+                            "OR OLD.object_id != NEW.object_id"),
+        *(f'DELETE FROM {table};' for table in SUMMARY_TABLES),
+        *(f'INSERT INTO {table} {select};' for table, (_, _, select) in SUMMARY_TABLES.items()),
+    ],
+]
+
+
+def get_schema_version(db_path: str = db) -> int:
+    """
+    Return the schema version of the database, 0 if it has never been migrated.
+    :param db_path: path to the database
+    :return: int, schema version
+    """
+    con = connections.get(db_path)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        ''')
+    version = con.execute('SELECT MAX(version) FROM schema_version;').fetchone()[0]
+    return 0 if version is None else version
+
+
+def migrate(db_path: str = db) -> int:
+    """
+    Upgrade an existing database in place by applying all pending MIGRATIONS. Safe to run repeatedly and from several
+    processes at once, each migration is applied exactly once.
+    :param db_path: path to the database
+    :return: int, schema version after the migration
+    """
+    con = connections.get(db_path)
+    version = get_schema_version(db_path)
+    if version == len(MIGRATIONS):
+        return version
+
+    # tables are rebuilt by dropping them, which must neither cascade nor fail on references while foreign keys are
+    # on, the references are checked with foreign_key_check before the last migration is committed instead
+    foreign_keys = con.execute('PRAGMA foreign_keys;').fetchone()[0]
+    con.execute('PRAGMA foreign_keys = OFF;')
+    try:
+        while version < len(MIGRATIONS):
+            con.execute('BEGIN IMMEDIATE;')
+            try:
+                # re-read inside the write lock, another process might have migrated in the meantime
+                version = con.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version;').fetchone()[0]
+                if version < len(MIGRATIONS):
+                    for statement in MIGRATIONS[version]:
+                        if callable(statement):
+                            statement(con)
+                        else:
+                            con.execute(statement)
+                    version += 1
+                    violations = con.execute('PRAGMA foreign_key_check;').fetchmany(10)
+                    if version == len(MIGRATIONS) and violations:
+                        raise sql.IntegrityError(f'foreign key violations after migration {version}: {violations}')
+                    con.execute('INSERT INTO schema_version (version) VALUES (?);', (version,))
+                con.commit()
+            except BaseException:
+                con.rollback()
+                raise
+    finally:
+        con.execute(f'PRAGMA foreign_keys = {foreign_keys};')
+    return version
+
+
+# Hot queries that must be served by an index, see check_query_plans
+INDEXED_QUERIES = {
+    'session_experiments': ('SELECT experiment_id, container_id FROM experiments WHERE session_id = ?;', ('S0000',)),
+    'object_history': ('SELECT experiment_id FROM experiment_objects WHERE object_id = ?;', ('1_1',)),
+    'objects_by_polymer_type': ('SELECT object_id FROM objects WHERE polymer_type = ?;', ('pe',)),
+    'container_experiments': ('SELECT experiment_id FROM experiments WHERE container_id = ?;', ('CO-01',)),
+    'objects_by_polymer_type_and_length': ('SELECT object_id FROM objects WHERE polymer_type = ? AND length >= ?;',
+                                           ('pe', 10)),
+    'sample_objects': ('SELECT object_id FROM objects WHERE reference_image = ? AND polymer_type = ? AND object_id > ? '
+                       'ORDER BY object_id LIMIT 100;', ('1', 'pe', '')),
+}
+
+
+def explain_query_plan(query: str, params: tuple = (), db_path: str = db) -> List[str]:
+    """
+    Return the steps of the query plan SQLite chooses for a query.
+    :param query: str, a query in SQLite format
+    :param params: tuple (optional), parameters of the query
+    :param db_path: path to the database
+    :return: List[str], one entry per step, e.g. 'SEARCH experiments USING INDEX idx_experiments_session_id (...)'
+    """
+    con = connections.get(db_path)
+    return [row[3] for row in con.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()]
+
+
+def check_query_plans(db_path: str = db) -> dict:
+    """
+    Check that the INDEXED_QUERIES do not fall back to full table scans.
+    :param db_path: path to the database
+    :return: dict, {query name: [full scan steps]}, only queries with full scans are included
+    """
+    full_scans = {}
+    for name, (query, params) in INDEXED_QUERIES.items():
+        scans = [step for step in explain_query_plan(query, params, db_path) if step.startswith('SCAN ')]
+        if scans:
+            full_scans[name] = scans
+    return full_scans
+
+
+def _reserve_ids(counter: str, n: int, db_path: str = db) -> range:
+    """
+    Atomically advance an id counter by n and return the reserved block of numbers.
+    :param counter: str, name of the counter in the id_counters table, 'experiment', 'session' or 'session_changes'
+    :param n: int, number of ids to reserve
+    :param db_path: path to the database
+    :return: range, reserved numbers
+    """
+    con = connections.get(db_path)
+    con.execute('BEGIN IMMEDIATE;')
+    try:
+        start = con.execute('SELECT next_value FROM id_counters WHERE name = ?;', (counter,)).fetchone()[0]
+        con.execute('UPDATE id_counters SET next_value = ? WHERE name = ?;', (start + n, counter))
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    return range(start, start + n)
+
+
+def reserve_experiment_ids(n: int = 1, db_path: str = db) -> List[str]:
+    """
+    Reserve a block of n experiment ids. Ids handed out once are never returned again, also not to other processes.
+    :param n: int (optional), number of ids to reserve
+    :param db_path: path to the database
+    :return: List[str], ids in the form 'E0000'
+    """
+    return [f'E{i:04}' for i in _reserve_ids('experiment', n, db_path)]
+
+
+def reserve_session_ids(n: int = 1, db_path: str = db) -> List[str]:
+    """
+    Reserve a block of n session ids. Ids handed out once are never returned again, also not to other processes.
+    :param n: int (optional), number of ids to reserve
+    :param db_path: path to the database
+    :return: List[str], ids in the form 'S0000'
+    """
+    return [f'S{i:04}' for i in _reserve_ids('session', n, db_path)]
+
+
+def start_change_version(db_path: str = db) -> int:
+    """
+    Advance the change version of the session_changes table and return the previous one. Sessions changed before
+    the call have a version <= the returned value, sessions changed afterwards get a larger one.
+    :param db_path: path to the database
+    :return: int, last version whose changes are all committed
+    """
+    return _reserve_ids('session_changes', 1, db_path)[0]
+
+
+def get_next_experiment_id(db_path: str = db) -> str:
+    """
+    Return the next free experiment id without reserving it. Use reserve_experiment_ids if the id is used to insert
+    an experiment while other processes might do the same.
+    """
+    con = connections.get(db_path)
+    result = con.execute("SELECT next_value FROM id_counters WHERE name = 'experiment';").fetchone()
+    return f'E{result[0]:04}'
+
+
+def get_next_session_id(db_path: str = db) -> str:
+    """
+    Return the next free session id without reserving it. Use reserve_session_ids if the id is used to insert
+    a session while other processes might do the same.
+    """
+    con = connections.get(db_path)
+    result = con.execute("SELECT next_value FROM id_counters WHERE name = 'session';").fetchone()
+    return f'S{result[0]:04}'
 
 
 if __name__ == '__main__':
@@ -1,10 +1,143 @@
-from typing import List
+from __future__ import annotations
+
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, List, NamedTuple
 
-import pandas as pd
 import db_builder
 
+# pandas takes about half a second to import, it is loaded by the functions that return DataFrames
+if TYPE_CHECKING:
+    import pandas as pd
+
 db = './data/biocycle_tracking.db'
 
+# maximum number of ids per IN (...) list of the batch getters, below SQLite's historic limit of 999 variables
+IN_CHUNK_SIZE = 900
+
+# separator of the object_ids concatenated by get_complete_session, the ASCII unit separator
+OBJECT_SEPARATOR = '\x1f'
+
+
+def _strip(value: str) -> str:
+    return value.strip() if isinstance(value, str) else value
+
+
+class EntityCache:
+    """
+    In-process LRU cache with optional time to live for rows of the reference tables (objects and containers).
+    Writes through the functions in this module invalidate the affected entries. Changes committed by other
+    connections or processes are detected with PRAGMA data_version, any other write on the own connection with
+    total_changes, both drop all entries of the database. data_version is read at most every version_interval
+    seconds (0: on every lookup), changes of other processes become visible after at most that delay.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: float = None, version_interval: float = 0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_interval = version_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _check_version(self, con, db_name: str, own_write: bool = False) -> None:
+        """Drop all entries of db_name if the database changed since the last check of this connection."""
+        key = (threading.get_ident(), db_name)
+        previous = self._versions.get(key)
+        now = time.monotonic()
+        if previous is not None and previous[0] is con and previous[2] == con.total_changes and \
+                now - previous[3] < self.version_interval:
+            return
+
+        data_version = con.execute('PRAGMA data_version;').fetchone()[0]
+        if previous is None or previous[0] is not con or previous[1] != data_version or \
+                (previous[2] != con.total_changes and not own_write):
+            self._clear_db(db_name)
+        self._versions[key] = (con, data_version, con.total_changes, now)
+
+    def _clear_db(self, db_name: str) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == db_name]:
+                del self._entries[key]
+
+    def get(self, con, db_path: str, table: str, entity_id: str, load):
+        """
+        Return the cached value of (table, entity_id) or load it with load() and cache it.
+        :param con: connection of the calling thread to db_path
+        :param db_path: path to the database
+        :param table: str, name of the table
+        :param entity_id: str, primary key of the row
+        :param load: function without arguments returning the value
+        :return: cached or loaded value
+        """
+        db_name = db_builder.normalize_db_path(db_path)
+        self._check_version(con, db_name)
+        key = (db_name, table, entity_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = load()
+        with self._lock:
+            self._entries[key] = (None if self.ttl is None else now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    @contextmanager
+    def write(self, con, db_path: str, table: str = None, entity_ids: List[str] = None):
+        """
+        Context manager around a write on con. Changes made elsewhere before the write are detected on entry, the
+        entries of the written rows are dropped on exit. Without entity_ids, all entries of table are dropped,
+        without table none.
+        :param con: connection of the calling thread to db_path
+        :param db_path: path to the database
+        :param table: str (optional), name of the written table
+        :param entity_ids: List[str] (optional), primary keys of the written rows
+        """
+        db_name = db_builder.normalize_db_path(db_path)
+        self._check_version(con, db_name)
+        try:
+            yield con
+        finally:
+            with self._lock:
+                if entity_ids is None:
+                    stale = [key for key in self._entries if key[0] == db_name and key[1] == table]
+                else:
+                    stale = [(db_name, table, entity_id) for entity_id in entity_ids]
+                for key in stale:
+                    self._entries.pop(key, None)
+            self._check_version(con, db_name, own_write=True)
+
+    def clear(self) -> None:
+        """Drop all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self.hits = self.misses = 0
+        return None
+
+    def stats(self) -> dict:
+        """Return the hit and miss counts, the hit rate and the number of entries."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries)}
+
+
+# shared by get_object and get_container, configure with cache.maxsize and cache.ttl
+cache = EntityCache()
+
 
 # Session queries
 def put_session(session_id: str = None,
@@ -25,17 +158,16 @@ def put_session(session_id: str = None,
     :param db_path: str (optional), name of the database
     :return: None
     """
-    con = db_builder.get_db_connection(db_path)
+    con = db_builder.connections.get(db_path)
     if session_id is None:
-        session_id = db_builder.get_next_session_id(db_path)
+        session_id = db_builder.reserve_session_ids(1, db_path)[0]
 
-    query = f'''
+    query = '''
         INSERT INTO sessions (session_id, note, n_experiments, responsible, start_date, end_date) 
-        VALUES ('{session_id}', '{note}', {n_experiments}, '{responsible}', '{start_date}', '{end_date}');
+        VALUES (?, ?, ?, ?, ?, ?);
         '''
-    con.execute(query)
-    con.commit()
-    con.close()
+    with con:
+        con.execute(query, (session_id, note, n_experiments, responsible, start_date, end_date))
     return None
 
 
@@ -48,15 +180,14 @@ def put_multiple_sessions(sessions: pd.DataFrame, db_path: str = db) -> None:
     """
     assert sessions.columns.tolist() == ['session_id', 'n_experiments', 'note', 'responsible', 'start_date', 'end_date']
 
-    query = f'''
+    query = '''
         INSERT INTO sessions (session_id, note, n_experiments, responsible, start_date, end_date)
         VALUES (?, ?, ?, ?, ?, ?);
         '''
 
-    con = db_builder.get_db_connection(db_path)
-    con.executemany(query, sessions.values.tolist())
-    con.commit()
-    con.close()
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.executemany(query, sessions.values.tolist())
 
     return None
 
@@ -88,18 +219,17 @@ def put_object(object_id: str,
     :param db_path: str (optional), name of the database
     :return: None
     """
-    con = db_builder.get_db_connection(db_path)
+    con = db_builder.connections.get(db_path)
 
-    con.execute(
-        f'''
-        INSERT INTO objects (object_id, polymer_type, length, texture, stiffness, 
-        color, contamination, form, note, reference_image)
-        VALUES ('{object_id}', '{polymer_type}', {length}, '{texture}', '{stiffness}', '{color}', '{contamination}', 
-        '{form}', '{note}', {reference_image});
-        ''')
+    with cache.write(con, db_path, 'objects', [object_id]), con:
+        con.execute(
+            '''
+            INSERT INTO objects (object_id, polymer_type, length, texture, stiffness, 
+            color, contamination, form, note, reference_image)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            ''', (object_id, polymer_type, length, texture, stiffness, color, contamination, form, note,
+                  reference_image))
 
-    con.commit()
-    con.close()
     return None
 
 
@@ -114,16 +244,15 @@ def put_multiple_objects(objects: pd.DataFrame, db_path: str = db) -> None:
     assert objects.columns.tolist() == ['object_id', 'polymer_type', 'length', 'texture', 'stiffness', 'color',
                                         'contamination', 'form', 'note', 'reference_image']
 
-    query = f'''
+    query = '''
         INSERT INTO objects (object_id, polymer_type, length, texture, stiffness,
         color, contamination, form, note, reference_image)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
         '''
 
-    con = db_builder.get_db_connection(db_path)
-    con.executemany(query, objects.values.tolist())
-    con.commit()
-    con.close()
+    con = db_builder.connections.get(db_path)
+    with cache.write(con, db_path, 'objects', objects['object_id'].tolist()), con:
+        con.executemany(query, objects.values.tolist())
 
     return None
 
@@ -142,16 +271,15 @@ def put_container(container_id: str, material_type: str = None, company: str = N
     :param db_path: str (optional), name of the database
     :return: None
     """
-    con = db_builder.get_db_connection(db_path)
+    con = db_builder.connections.get(db_path)
 
-    con.execute(
-        f'''
-        INSERT INTO containers (container_id, material_type, company, location, note, date)
-        VALUES ('{container_id}', '{material_type}', '{company}', '{location}', '{note}', '{date}');
-        ''')
+    with cache.write(con, db_path, 'containers', [container_id]), con:
+        con.execute(
+            '''
+            INSERT INTO containers (container_id, material_type, company, location, note, date)
+            VALUES (?, ?, ?, ?, ?, ?);
+            ''', (container_id, material_type, company, location, note, date))
 
-    con.commit()
-    con.close()
     return None
 
 
@@ -164,15 +292,14 @@ def put_multiple_containers(containers: pd.DataFrame, db_path: str = db) -> None
     """
     assert containers.columns.tolist() == ['container_id', 'material_type', 'company', 'location', 'note', 'date']
 
-    query = f'''
+    query = '''
         INSERT INTO containers (container_id, material_type, company, location, note, date)
         VALUES (?, ?, ?, ?, ?, ?);
         '''
 
-    con = db_builder.get_db_connection(db_path)
-    con.executemany(query, containers.values.tolist())
-    con.commit()
-    con.close()
+    con = db_builder.connections.get(db_path)
+    with cache.write(con, db_path, 'containers', containers['container_id'].tolist()), con:
+        con.executemany(query, containers.values.tolist())
 
     return None
 
@@ -193,18 +320,17 @@ def put_experiment(experiment_id: str = None,
     :param db_path: str (optional), name of the database
     :return: None
     """
-    con = db_builder.get_db_connection(db_path)
+    con = db_builder.connections.get(db_path)
     if experiment_id is None:
-        experiment_id = db_builder.get_next_experiment_id(db_path)
+        experiment_id = db_builder.reserve_experiment_ids(1, db_path)[0]
 
-    con.execute(
-        f'''
-        INSERT INTO experiments (experiment_id, session_id, container_id, n_objects) 
-        VALUES ('{experiment_id.strip()}', '{session_id.strip()}', '{container_id.strip()}', {n_objects});
-        ''')
+    with con:
+        con.execute(
+            '''
+            INSERT INTO experiments (experiment_id, session_id, container_id, n_objects) 
+            VALUES (?, ?, ?, ?);
+            ''', (_strip(experiment_id), _strip(session_id), _strip(container_id), n_objects))
 
-    con.commit()
-    con.close()
     return None
 
 
@@ -217,15 +343,14 @@ def put_multiple_experiments(experiments: pd.DataFrame, db_path: str = db) -> No
     """
     assert experiments.columns.tolist() == ['session_id', 'experiment_id', 'container_id', 'n_objects']
 
-    query = f'''
+    query = '''
         INSERT INTO experiments (session_id, experiment_id, container_id, n_objects)
         VALUES (?, ?, ?, ?);
         '''
 
-    con = db_builder.get_db_connection(db_path)
-    con.executemany(query, experiments.values.tolist())
-    con.commit()
-    con.close()
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.executemany(query, experiments.values.tolist())
 
     return None
 
@@ -239,192 +364,551 @@ def link_experiment_objects(experiment_id: str, objects: List[str], db_path: str
     :return: None
     """
 
-    query = f'''
+    query = '''
             INSERT INTO experiment_objects (experiment_id, object_id)
             VALUES (?, ?);            
             '''
 
-    con = db_builder.get_db_connection(db_path)
-    con.executemany(query, [(experiment_id, object_id) for object_id in objects])
-    con.commit()
-    con.close()
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.executemany(query, [(experiment_id, object_id) for object_id in objects])
+
+    return None
+
+
+def ingest_session_plan(plan,
+                        note: str = None,
+                        responsible: str = None,
+                        start_date: str = None,
+                        end_date: str = None,
+                        db_path: str = db) -> None:
+    """
+    Write a complete session plan, i.e. the session, its experiments and the links to the objects, in a single
+    transaction. If any insert fails, nothing is written.
+    :param plan: pd.DataFrame, columns: session_id, experiment_id, container_id, objects (list of object_ids),
+    additional columns are ignored, or a create_experiments_helpers.SessionPlan
+    :param note: str (optional), note about the session(s)
+    :param responsible: str (optional), name of the person responsible for the session(s)
+    :param start_date: str (optional), start date of the session(s)
+    :param end_date: str (optional), end date of the session(s)
+    :param db_path: str (optional), name of the database
+    :return: None
+    """
+    if hasattr(plan, 'link_rows'):
+        # SessionPlan, the rows are built from its arrays, this module does not import create_experiments_helpers
+        session_counts, experiments, links = plan.session_counts(), plan.experiment_rows(), plan.link_rows()
+    else:
+        assert {'session_id', 'experiment_id', 'container_id', 'objects'} <= set(plan.columns)
+
+        session_ids = plan['session_id'].str.strip()
+        experiment_ids = plan['experiment_id'].str.strip()
+        container_ids = plan['container_id'].str.strip()
+        objects = plan['objects'].tolist()
+
+        session_counts = session_ids.value_counts(sort=False).items()
+        experiments = [(session_id, experiment_id, container_id, len(object_ids))
+                       for session_id, experiment_id, container_id, object_ids
+                       in zip(session_ids, experiment_ids, container_ids, objects)]
+        links = [(experiment_id, str(object_id).strip())
+                 for experiment_id, object_ids in zip(experiment_ids, objects) for object_id in object_ids]
+
+    sessions = [(session_id, note, int(n_experiments), responsible, start_date, end_date)
+                for session_id, n_experiments in session_counts]
+
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.executemany('''
+            INSERT INTO sessions (session_id, note, n_experiments, responsible, start_date, end_date)
+            VALUES (?, ?, ?, ?, ?, ?);
+            ''', sessions)
+        con.executemany('''
+            INSERT INTO experiments (session_id, experiment_id, container_id, n_objects)
+            VALUES (?, ?, ?, ?);
+            ''', experiments)
+        con.executemany('''
+            INSERT INTO experiment_objects (experiment_id, object_id)
+            VALUES (?, ?);
+            ''', links)
 
     return None
 
 
 # Fetch queries
-def get_complete_session(session_id: str, db_path: str = db) -> List[tuple]:
+def _complete_experiments(condition: str, params: list, include_objects: bool, db_path: str) -> List[tuple]:
+    """
+    Return (session_id, experiment_id, container_id, objects) for all experiments matching condition, sorted by
+    experiment_id. The object_ids of every experiment are concatenated by SQLite from a subquery ordered by object_id,
+    which the primary key index of experiment_objects serves without sorting, with a control character as separator,
+    so ids containing commas survive, and split once in Python. Experiments without objects are left out. objects is a list of object_ids or,
+    with include_objects, a list of dicts with all columns of the objects, loaded in a few chunked queries and shared
+    between experiments.
+    """
+    query = f'''
+        SELECT session_id,
+               experiment_id,
+               container_id,
+               (SELECT GROUP_CONCAT(object_id, char(31))
+                    FROM (SELECT object_id FROM experiment_objects
+                            WHERE experiment_objects.experiment_id = experiments.experiment_id
+                            ORDER BY object_id)) AS object_list
+            FROM experiments
+            WHERE {condition}
+            ORDER BY experiment_id;
+        '''
+    con = db_builder.connections.get(db_path)
+    rows = [(session_id, experiment_id, container_id, object_list.split(OBJECT_SEPARATOR))
+            for session_id, experiment_id, container_id, object_list in con.execute(query, params)
+            if object_list is not None]
+    if not include_objects:
+        return rows
+
+    objects = {}
+    columns = ', '.join(ObjectRow._fields)
+    for chunk in _chunks([object_id for row in rows for object_id in row[3]]):
+        cursor = con.execute(f'SELECT {columns} FROM objects WHERE object_id IN ({", ".join("?" * len(chunk))});',
+                             chunk)
+        objects.update((row[0], dict(zip(ObjectRow._fields, row))) for row in cursor)
+    missing = dict.fromkeys(ObjectRow._fields)
+    return [(session_id, experiment_id, container_id,
+             [objects.get(object_id) or {**missing, 'object_id': object_id} for object_id in object_ids])
+            for session_id, experiment_id, container_id, object_ids in rows]
+
+
+def get_complete_session(session_id: str, db_path: str = db, include_objects: bool = False) -> List[tuple]:
     """
     Return all experiments to a session. Returns a list in the form
         [(session_id, experiment_id, container_id, [object_list]), ...]
+    Experiments are sorted by experiment_id and objects by object_id.
     :param session_id: str, session_id of the session
     :param db_path: str (optional), name of the database
+    :param include_objects: bool (optional), if True, object_list holds dicts with all columns of the objects
+    instead of object_ids
     :return: list, [(session_id, experiment_id, container_id, [object_list]), ...]
     """
-    con = db_builder.get_db_connection(db_path)
-    query = f'''
-        SELECT sessions.session_id, 
-                experiments.experiment_id, 
-                experiments.container_id, 
-                GROUP_CONCAT(experiment_objects.object_id) AS object_list
-            FROM sessions
-        JOIN experiments ON sessions.session_id = experiments.session_id
-        JOIN experiment_objects ON experiments.experiment_id = experiment_objects.experiment_id
-            WHERE sessions.session_id = '{session_id}'
-            GROUP BY experiments.experiment_id;
-        '''
-    full_session = con.execute(query).fetchall()
-    con.close()
-
-    return full_session
+    return _complete_experiments('experiments.session_id = ?', [session_id], include_objects, db_path)
 
 
-def get_complete_experiment(experiment_id: str, db_path: str = db) -> dict:
+def get_complete_experiment(experiment_id: str, db_path: str = db, include_objects: bool = False) -> List[tuple]:
     """
-    Return all objects to an experiment. Returns a dictionary in the form {experiment_id: {object_id: {}}}
+    Return all objects to an experiment. Returns a list in the form [(experiment_id, container_id, [object_list])],
+    objects are sorted by object_id.
     :param experiment_id: str, experiment_id of the experiment
     :param db_path: str (optional), name of the database
-    :return: dict, {experiment_id: {object_id: {}}}
+    :param include_objects: bool (optional), if True, object_list holds dicts with all columns of the objects
+    instead of object_ids
+    :return: list, [(experiment_id, container_id, [object_list])]
     """
-    con = db_builder.get_db_connection(db_path)
-    query = f'''
-        SELECT experiments.experiment_id, experiments.container_id, GROUP_CONCAT(experiment_objects.object_id) AS object_list
-            FROM experiments
-        JOIN experiment_objects ON experiments.experiment_id = experiment_objects.experiment_id
-            WHERE experiments.experiment_id = '{experiment_id}'
-           GROUP BY experiments.experiment_id;
-        '''
-    full_experiment = con.execute(query).fetchall()
-    con.close()
-
-    return full_experiment
+    rows = _complete_experiments('experiments.experiment_id = ?', [experiment_id], include_objects, db_path)
+    return [row[1:] for row in rows]
 
 
 def get_object(object_id: str, db_path: str = db) -> dict:
     """Return all information about an object. Returns a dictionary in the form {object_id: {}}"""
-    con = db_builder.get_db_connection(db_path)
-    query = f'''
+    con = db_builder.connections.get(db_path)
+    query = '''
         SELECT * FROM objects
-            WHERE object_id = '{object_id}';
+            WHERE object_id = ?;
         '''
-    full_object_description = con.execute(query).fetchall()
-    con.close()
+    full_object_description = list(cache.get(con, db_path, 'objects', object_id,
+                                             lambda: con.execute(query, (object_id,)).fetchall()))
 
     return full_object_description
 
 
 def get_container(container_id: str, db_path: str = db) -> dict:
     """Return all information about a container. Returns a dictionary in the form {container_id: {}}"""
-    con = db_builder.get_db_connection(db_path)
-    query = f'''
+    con = db_builder.connections.get(db_path)
+    query = '''
         SELECT * FROM containers
-            WHERE container_id = '{container_id}';
+            WHERE container_id = ?;
         '''
-    container_description = con.execute(query).fetchall()
-    con.close()
+    container_description = list(cache.get(con, db_path, 'containers', container_id,
+                                           lambda: con.execute(query, (container_id,)).fetchall()))
 
     return container_description
 
 
 def get_session(session_id: str, db_name: str = db) -> dict:
     """Return all information about a session. Returns a dictionary in the form {session_id: {}}"""
-    con = db_builder.get_db_connection(db_name)
-    query = f'''
+    con = db_builder.connections.get(db_name)
+    query = '''
         SELECT * FROM sessions
-            WHERE session_id = '{session_id}';
+            WHERE session_id = ?;
         '''
-    session_description = con.execute(query).fetchall()
-    con.close()
+    session_description = con.execute(query, (session_id,)).fetchall()
 
     return session_description
 
 
 def get_experiment(experiment_id: str, db_path: str = db) -> dict:
     """Return all information about an experiment. Returns a dictionary in the form {experiment_id: {}}"""
-    con = db_builder.get_db_connection(db_path)
-    query = f'''
+    con = db_builder.connections.get(db_path)
+    query = '''
         SELECT * FROM experiments
-            WHERE experiment_id = '{experiment_id}';
+            WHERE experiment_id = ?;
         '''
-    experiment_description = con.execute(query).fetchall()
-    con.close()
+    experiment_description = con.execute(query, (experiment_id,)).fetchall()
 
     return experiment_description
 
 
-def delete_experiment(experiment_id: str, db_path: str = db) -> None:
+# Batch fetch queries
+def _chunks(ids: List[str], size: int = IN_CHUNK_SIZE) -> Iterator[List[str]]:
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _get_many(table: str, key: str, ids: List[str], db_path: str) -> dict:
+    con = db_builder.connections.get(db_path)
+    result = {}
+    for chunk in _chunks(ids):
+        cursor = con.execute(f'SELECT * FROM {table} WHERE {key} IN ({", ".join("?" * len(chunk))});', chunk)
+        key_index = [column[0] for column in cursor.description].index(key)
+        result.update((row[key_index], row) for row in cursor)
+    return result
+
+
+def get_objects(object_ids: List[str], db_path: str = db) -> dict:
     """
-    Delete a single experiment from the database
-    :param experiment_id: str, experiment_id of the experiment
+    Return all information about several objects in a few chunked queries.
+    :param object_ids: List[str], object_ids of the objects
     :param db_path: str (optional), name of the database
-    :return: None
+    :return: dict, {object_id: row}, ids that do not exist are missing
     """
-    assert get_experiment(experiment_id, db_path) != [], f'Experiment {experiment_id} does not exist in the database'
+    return _get_many('objects', 'object_id', object_ids, db_path)
 
-    con = db_builder.get_db_connection(db_path)
-    query = f'''
-        DELETE FROM experiment_objects
-            WHERE experiment_id = '{experiment_id}';
-        '''
-    con.execute(query)
-    con.commit()
-    query = f'''
-        DELETE FROM experiments
-            WHERE experiment_id = '{experiment_id}';
-        '''
-    con.execute(query)
-    con.commit()
-    con.close()
 
-    return None
+def get_experiments(experiment_ids: List[str], db_path: str = db) -> dict:
+    """
+    Return all information about several experiments in a few chunked queries.
+    :param experiment_ids: List[str], experiment_ids of the experiments
+    :param db_path: str (optional), name of the database
+    :return: dict, {experiment_id: row}, ids that do not exist are missing
+    """
+    return _get_many('experiments', 'experiment_id', experiment_ids, db_path)
+
+
+def get_complete_sessions(session_ids: List[str], db_path: str = db, include_objects: bool = False) -> dict:
+    """
+    Return all experiments of several sessions in a few chunked queries, see get_complete_session.
+    :param session_ids: List[str], session_ids of the sessions
+    :param db_path: str (optional), name of the database
+    :param include_objects: bool (optional), if True, object_list holds dicts with all columns of the objects
+    instead of object_ids
+    :return: dict, {session_id: [(session_id, experiment_id, container_id, [object_list]), ...]}, sessions without
+    experiments are missing
+    """
+    result = {}
+    for chunk in _chunks(session_ids):
+        condition = f'experiments.session_id IN ({", ".join("?" * len(chunk))})'
+        for row in _complete_experiments(condition, chunk, include_objects, db_path):
+            result.setdefault(row[0], []).append(row)
+    return result
+
+
+def _delete(table: str, key: str, ids: List[str], db_path: str) -> dict:
+    """
+    Delete the rows of table with the given keys in one transaction, the database cascades the delete to the
+    experiments and experiment_objects that belong to them (migration 5 in db_builder).
+    """
+    con = db_builder.connections.get(db_path)
+    counts = dict.fromkeys(['sessions'] if table == 'sessions' else [], 0)
+    counts.update(experiments=0, experiment_objects=0)
+    with cache.write(con, db_path):
+        con.execute('BEGIN IMMEDIATE;')
+        try:
+            for chunk in _chunks(ids):
+                condition = f'{key} IN ({", ".join("?" * len(chunk))})'
+                experiments = f'SELECT experiment_id FROM experiments WHERE {condition}'
+                if table == 'sessions':
+                    counts['sessions'] += con.execute(f'SELECT COUNT(*) FROM sessions WHERE {condition};',
+                                                      chunk).fetchone()[0]
+                counts['experiments'] += con.execute(f'SELECT COUNT(*) FROM ({experiments});', chunk).fetchone()[0]
+                counts['experiment_objects'] += con.execute(
+                    f'SELECT COUNT(*) FROM experiment_objects WHERE experiment_id IN ({experiments});',
+                    chunk).fetchone()[0]
+                con.execute(f'DELETE FROM {table} WHERE {condition};', chunk)
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+    return counts
+
+
+def delete_experiments(experiment_ids: List[str], db_path: str = db) -> dict:
+    """
+    Delete experiments and their links to objects in one transaction. Ids that do not exist are ignored.
+    :param experiment_ids: List[str], experiment_ids of the experiments
+    :param db_path: str (optional), name of the database
+    :return: dict, number of deleted rows {'experiments', 'experiment_objects'}
+    """
+    return _delete('experiments', 'experiment_id', experiment_ids, db_path)
+
+
+def delete_sessions(session_ids: List[str], db_path: str = db) -> dict:
+    """
+    Delete sessions with all their experiments and links to objects in one transaction. Ids that do not exist are
+    ignored.
+    :param session_ids: List[str], session_ids of the sessions
+    :param db_path: str (optional), name of the database
+    :return: dict, number of deleted rows {'sessions', 'experiments', 'experiment_objects'}
+    """
+    return _delete('sessions', 'session_id', session_ids, db_path)
 
 
-def delete_session(session_id: str, db_path: str = db) -> None:
+def delete_experiment(experiment_id: str, db_path: str = db) -> dict:
+    """
+    Delete a single experiment from the database
+    :param experiment_id: str, experiment_id of the experiment
+    :param db_path: str (optional), name of the database
+    :return: dict, number of deleted rows, see delete_experiments
+    """
+    counts = delete_experiments([experiment_id], db_path)
+    assert counts['experiments'], f'Experiment {experiment_id} does not exist in the database'
+    return counts
+
+
+def delete_session(session_id: str, db_path: str = db) -> dict:
     """
     Delete a single session from the database. Note that this also removes all experiments
     associated with the session.
     :param session_id: str, session_id of the session
     :param db_path: str (optional), name of the database
-    :return: None
+    :return: dict, number of deleted rows, see delete_sessions
     """
-    assert get_session(session_id, db_path) != [], f'Session {session_id} does not exist in the database.'
+    counts = delete_sessions([session_id], db_path)
+    assert counts['sessions'], f'Session {session_id} does not exist in the database.'
+    return counts
 
-    con = db_builder.get_db_connection(db_path)
-    query = f'''
-        DELETE FROM experiment_objects
-            WHERE experiment_id IN (SELECT experiment_id FROM experiments WHERE session_id = '{session_id}');
-        '''
-    con.execute(query)
-    con.commit()
-    query = f'''
-        DELETE FROM experiments
-            WHERE session_id = '{session_id}';
-        '''
-    con.execute(query)
-    con.commit()
-    query = f'''
-        DELETE FROM sessions
-            WHERE session_id = '{session_id}';
-        '''
-    con.execute(query)
-    con.commit()
-    con.close()
 
-    return None
+def run_query(query: str, db_path: str = db, params: tuple = None, read_only: bool = True):
+    """
+    Run an arbitrary query on the database. By default the query runs on a read-only connection, so it can neither
+    change the database nor take the write lock by accident, pass read_only=False for queries that write.
+    :param query: str, a query in SQLite Format, values should be passed as ? placeholders and params
+    :param db_path: path to the database
+    :param params: tuple (optional), parameters of the query
+    :param read_only: bool (optional), run the query on a read-only connection
+    :return: pd.DataFrame, result of the query, number of changed rows for writes without result
+    """
+    import pandas as pd
 
+    con = db_builder.connections.get(db_path, read_only=read_only or None)
+    if read_only:
+        # no commit, so run_query can be used inside db_builder.connections.snapshot()
+        return pd.read_sql_query(query, con, params=params)
 
-def run_query(query: str, db_path: str = db):
+    with con:
+        cursor = con.execute(query, () if params is None else params)
+        if cursor.description is None:
+            return cursor.rowcount
+        query_result = pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+
+    return query_result
+
+
+# Streaming queries
+def iter_query(query: str, params: tuple = None, chunksize: int = 10000, db_path: str = db) -> Iterator[pd.DataFrame]:
     """
-    Run an arbitrary query on the database
+    Run an arbitrary query on the database and yield the result in DataFrames of at most chunksize rows. Rows are
+    fetched from the cursor chunk by chunk, so memory stays bounded no matter how large the result is. The query runs
+    on a read-only connection.
     :param query: str, a query in SQLite Format
+    :param params: tuple (optional), parameters of the query
+    :param chunksize: int (optional), number of rows per DataFrame
     :param db_path: path to the database
-    :return: result of the query
+    :return: iterator over DataFrames
     """
-    con = db_builder.get_db_connection(db_path)
-    query_result = pd.read_sql_query(query, con)
-    con.close()
+    import pandas as pd
 
-    return query_result
+    con = db_builder.connections.get(db_path, read_only=True)
+    yield from pd.read_sql_query(query, con, params=params, chunksize=chunksize)
+
+
+class SessionRow(NamedTuple):
+    session_id: str
+    n_experiments: int
+    note: str
+    responsible: str
+    start_date: str
+    end_date: str
+
+
+class ExperimentRow(NamedTuple):
+    experiment_id: str
+    session_id: str
+    container_id: str
+    n_objects: int
+    file_path: str
+
+
+class ObjectRow(NamedTuple):
+    object_id: str
+    polymer_type: str
+    length: float
+    texture: str
+    stiffness: str
+    color: str
+    contamination: str
+    form: str
+    note: str
+    reference_image: str
+
+
+class ContainerRow(NamedTuple):
+    container_id: str
+    material_type: str
+    company: str
+    location: str
+    date: str
+    note: str
+
+
+class ExperimentObjectRow(NamedTuple):
+    experiment_id: str
+    object_id: str
+
+
+def _iter_rows(table: str, row_type: type, chunksize: int, db_path: str) -> Iterator[list]:
+    con = db_builder.connections.get(db_path, read_only=True)
+    cursor = con.execute(f'SELECT {", ".join(row_type._fields)} FROM {table};')
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            return
+        yield [row_type._make(row) for row in rows]
+
+
+def iter_sessions(chunksize: int = 10000, db_path: str = db) -> Iterator[List[SessionRow]]:
+    """Yield all sessions in lists of at most chunksize SessionRows."""
+    return _iter_rows('sessions', SessionRow, chunksize, db_path)
+
+
+def iter_experiments(chunksize: int = 10000, db_path: str = db) -> Iterator[List[ExperimentRow]]:
+    """Yield all experiments in lists of at most chunksize ExperimentRows."""
+    return _iter_rows('experiments', ExperimentRow, chunksize, db_path)
+
+
+def iter_objects(chunksize: int = 10000, db_path: str = db) -> Iterator[List[ObjectRow]]:
+    """Yield all objects in lists of at most chunksize ObjectRows."""
+    return _iter_rows('objects', ObjectRow, chunksize, db_path)
+
+
+def iter_containers(chunksize: int = 10000, db_path: str = db) -> Iterator[List[ContainerRow]]:
+    """Yield all containers in lists of at most chunksize ContainerRows."""
+    return _iter_rows('containers', ContainerRow, chunksize, db_path)
+
+
+def iter_experiment_objects(chunksize: int = 10000, db_path: str = db) -> Iterator[List[ExperimentObjectRow]]:
+    """Yield all links between experiments and objects in lists of at most chunksize ExperimentObjectRows."""
+    return _iter_rows('experiment_objects', ExperimentObjectRow, chunksize, db_path)
+
+
+# Search queries
+def _fts_query(text: str) -> str:
+    """Quote every word of text as an FTS5 phrase, so punctuation is not read as query syntax. 'word*' is a prefix."""
+    phrases = []
+    for word in text.split():
+        prefix = word.endswith('*') and len(word) > 1
+        word = word.rstrip('*') if prefix else word
+        phrases.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(phrases)
+
+
+def _find(table: str, row_type: type, filters: dict, ranges: dict, text: str, after: str, limit: int,
+          db_path: str) -> tuple:
+    """
+    Page through the rows of table that match all filters (column: value or list of values), ranges (column: (min,
+    max), None for open ends) and the full text query on note, ordered by the key, i.e. the first field of row_type.
+    """
+    key = row_type._fields[0]
+    conditions, params = [], []
+    for column, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = list(value)
+            conditions.append(f'{column} IN ({", ".join("?" * len(value))})')
+            params.extend(value)
+        else:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    for column, (low, high) in ranges.items():
+        if low is not None:
+            conditions.append(f'{column} >= ?')
+            params.append(low)
+        if high is not None:
+            conditions.append(f'{column} <= ?')
+            params.append(high)
+    if text:
+        conditions.append(f'rowid IN (SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH ?)')
+        params.append(_fts_query(text))
+    if after is not None:
+        conditions.append(f'{key} > ?')
+        params.append(after)
+
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    query = f'''
+        SELECT {", ".join(row_type._fields)} FROM {table}
+            {where}
+        ORDER BY {key}
+        LIMIT ?;
+        '''
+    con = db_builder.connections.get(db_path)
+    rows = [row_type._make(row) for row in con.execute(query, params + [limit])]
+    return rows, rows[-1][0] if len(rows) == limit else None
+
+
+def find_objects(polymer_type=None, min_length: float = None, max_length: float = None, color=None,
+                 contamination=None, form=None, texture=None, reference_image=None, text: str = None,
+                 after: str = None, limit: int = 100, db_path: str = db) -> tuple:
+    """
+    Search the object catalog, all given filters must match. Filters take a value or a list of allowed values. The
+    query is served by the compound indexes and the full text index of migration 7 in db_builder. Results are paged
+    by object_id (keyset pagination), pass the returned next_after as after to get the next page:
+
+        after = None
+        while True:
+            objects, after = find_objects(polymer_type=['pe', 'pp'], min_length=10, text='label*', after=after)
+            ...
+            if after is None:
+                break
+
+    :param polymer_type: str or List[str] (optional)
+    :param min_length: float (optional), smallest length
+    :param max_length: float (optional), largest length
+    :param color: str or List[str] (optional)
+    :param contamination: str or List[str] (optional)
+    :param form: str or List[str] (optional)
+    :param texture: str or List[str] (optional)
+    :param reference_image: str or List[str] (optional), e.g. True for objects with a reference image
+    :param text: str (optional), words that must all occur in the note, 'word*' matches words starting with word
+    :param after: str (optional), object_id after which the page starts, None for the first page
+    :param limit: int (optional), maximum number of objects per page
+    :param db_path: str (optional), name of the database
+    :return: tuple, (List[ObjectRow], next_after), next_after is None on the last page
+    """
+    filters = {'polymer_type': polymer_type, 'color': color, 'contamination': contamination, 'form': form,
+               'texture': texture, 'reference_image': reference_image}
+    return _find('objects', ObjectRow, filters, {'length': (min_length, max_length)}, text, after, limit, db_path)
+
+
+def find_containers(material_type=None, company=None, location=None, text: str = None, after: str = None,
+                    limit: int = 100, db_path: str = db) -> tuple:
+    """
+    Search the containers, all given filters must match. Works like find_objects, paged by container_id.
+    :param material_type: str or List[str] (optional)
+    :param company: str or List[str] (optional)
+    :param location: str or List[str] (optional)
+    :param text: str (optional), words that must all occur in the note, 'word*' matches words starting with word
+    :param after: str (optional), container_id after which the page starts, None for the first page
+    :param limit: int (optional), maximum number of containers per page
+    :param db_path: str (optional), name of the database
+    :return: tuple, (List[ContainerRow], next_after), next_after is None on the last page
+    """
+    filters = {'material_type': material_type, 'company': company, 'location': location}
+    return _find('containers', ContainerRow, filters, {}, text, after, limit, db_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,358 @@
+"""
+Opt-in instrumentation of the query functions of db_queries. enable() wraps every public function of the module and
+installs sqlite3 trace and progress callbacks on the connections of db_builder.connections. Every call records its
+wall time, the rows it returned and changed, the SQL statements it ran and the virtual machine steps SQLite needed in
+a Histogram per function of the registry. Calls slower than a threshold are kept in the slow-query log together with
+the EXPLAIN QUERY PLAN of their statements. disable() restores the original functions and removes the callbacks, so
+nothing is added to the queries while the instrumentation is off.
+"""
+import bisect
+import datetime
+import functools
+import inspect
+import json
+import sqlite3
+import threading
+import time
+
+from collections import deque
+from typing import List
+
+import pandas as pd
+
+import db_builder
+import db_queries
+
+# upper bounds of the latency buckets in seconds, 10 µs to 84 s in steps of factor 2
+BUCKETS = [1e-5 * 2 ** i for i in range(24)]
+
+# number of virtual machine instructions between two calls of the progress handler
+PROGRESS_STEPS = 1000
+
+# maximum number of distinct statements kept per call for the slow-query log
+MAX_STATEMENTS = 20
+
+EXPLAINED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+class Histogram:
+    """
+    Latencies of the calls of one function in exponential buckets (BUCKETS), with the totals of the rows returned and
+    changed, the statements and the virtual machine steps of the calls.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows_returned = 0
+        self.rows_changed = 0
+        self.statements = 0
+        self.vm_steps = 0
+
+    def add(self, seconds: float, rows_returned: int, rows_changed: int, statements: int, vm_steps: int,
+            error: bool) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.calls += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.rows_returned += rows_returned
+        self.rows_changed += rows_changed
+        self.statements += statements
+        self.vm_steps += vm_steps
+        return None
+
+    def quantile(self, q: float) -> float:
+        """
+        Return an upper bound of the q-quantile of the latencies: the upper bound of its bucket, at most the maximum.
+        :param q: float, between 0 and 1
+        :return: float, seconds
+        """
+        seen = 0
+        for bound, count in zip(BUCKETS + [self.max], self.counts):
+            seen += count
+            if count and seen >= q * self.calls:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        :return: dict, {'calls', 'errors', 'total_s', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms',
+        'rows_returned', 'rows_changed', 'statements', 'vm_steps'}
+        """
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'total_s': self.total,
+                'mean_ms': self.total / self.calls * 1e3 if self.calls else 0.0,
+                'p50_ms': self.quantile(0.5) * 1e3,
+                'p95_ms': self.quantile(0.95) * 1e3,
+                'p99_ms': self.quantile(0.99) * 1e3,
+                'max_ms': self.max * 1e3,
+                'rows_returned': self.rows_returned,
+                'rows_changed': self.rows_changed,
+                'statements': self.statements,
+                'vm_steps': self.vm_steps}
+
+
+class MetricsRegistry:
+    """
+    Histograms per instrumented function and the most recent slow calls, shared by all threads.
+    """
+
+    def __init__(self, max_slow_calls: int = 100):
+        self.histograms = {}
+        self.slow_calls = deque(maxlen=max_slow_calls)
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, rows_returned: int = 0, rows_changed: int = 0, statements: int = 0,
+               vm_steps: int = 0, error: bool = False) -> None:
+        """
+        Add a call of the function name.
+        :param name: str, name of the function
+        :param seconds: float, wall time of the call
+        :param rows_returned: int (optional), rows in the result
+        :param rows_changed: int (optional), rows inserted, updated or deleted, including changes made by triggers
+        :param statements: int (optional), SQL statements executed
+        :param vm_steps: int (optional), virtual machine steps, in multiples of PROGRESS_STEPS
+        :param error: bool (optional), True if the call raised an exception
+        :return: None
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds, rows_returned, rows_changed, statements, vm_steps, error)
+        return None
+
+    def snapshot(self) -> dict:
+        """
+        :return: dict, {function name: Histogram.summary()}
+        """
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in self.histograms.items()}
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: pd.DataFrame, one row per function with the columns of Histogram.summary(), slowest total first
+        """
+        frame = pd.DataFrame.from_dict(self.snapshot(), orient='index')
+        return frame.sort_values('total_s', ascending=False) if len(frame) else frame
+
+    def reset(self) -> None:
+        """Drop all histograms and slow calls."""
+        with self._lock:
+            self.histograms.clear()
+            self.slow_calls.clear()
+        return None
+
+
+# shared by all instrumented functions
+registry = MetricsRegistry()
+
+
+class _Call:
+    """Statements, changes and steps of one running call, filled by the callbacks of the connections it uses."""
+
+    def __init__(self):
+        self.statements = 0
+        self.vm_steps = 0
+        self.sql = []
+        self.changes = {}
+        self._last = None
+
+    def trace(self, con, statement: str) -> None:
+        # statements of triggers are reported with the text of the statement that fired them
+        if statement == self._last:
+            return None
+        self._last = statement
+        self.statements += 1
+        if con not in self.changes:
+            self.changes[con] = con.total_changes
+        if len(self.sql) < MAX_STATEMENTS and (con, statement) not in self.sql:
+            self.sql.append((con, statement))
+        return None
+
+    def rows_changed(self) -> int:
+        return sum(con.total_changes - start for con, start in self.changes.items())
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_settings = {'enabled': False, 'slow_seconds': 0.1, 'slow_log_path': None, 'patched': []}
+
+
+def _calls() -> list:
+    calls = getattr(_local, 'calls', None)
+    if calls is None:
+        calls = _local.calls = []
+    return calls
+
+
+def _install_callbacks(con) -> None:
+    def trace(statement):
+        if not getattr(_local, 'explaining', False):
+            for call in getattr(_local, 'calls', ()):
+                call.trace(con, statement)
+
+    def progress():
+        for call in getattr(_local, 'calls', ()):
+            call.vm_steps += PROGRESS_STEPS
+        return 0
+
+    con.set_trace_callback(trace)
+    con.set_progress_handler(progress, PROGRESS_STEPS)
+    return None
+
+
+def _remove_callbacks(con) -> None:
+    con.set_trace_callback(None)
+    con.set_progress_handler(None, PROGRESS_STEPS)
+    return None
+
+
+def _count_rows(result) -> int:
+    if isinstance(result, (list, pd.DataFrame)):
+        return len(result)
+    if isinstance(result, dict):
+        # batch getters return {id: row} or {id: [rows]}
+        return sum(len(value) if isinstance(value, list) else isinstance(value, tuple) for value in result.values())
+    return 0
+
+
+def _explain(con, statement: str):
+    if not statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+        return None
+    _local.explaining = True
+    try:
+        return [row[3] for row in con.execute(f'EXPLAIN QUERY PLAN {statement}').fetchall()]
+    except sqlite3.Error as e:
+        return [f'not explained: {e}']
+    finally:
+        _local.explaining = False
+
+
+def _finish(name: str, call: _Call, seconds: float, rows_returned: int, error: bool) -> None:
+    rows_changed = call.rows_changed()
+    registry.record(name, seconds, rows_returned, rows_changed, call.statements, call.vm_steps, error)
+    if seconds < _settings['slow_seconds']:
+        return None
+
+    entry = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+             'function': name,
+             'ms': seconds * 1e3,
+             'error': error,
+             'rows_returned': rows_returned,
+             'rows_changed': rows_changed,
+             'statements': call.statements,
+             'vm_steps': call.vm_steps,
+             'sql': [{'statement': statement, 'plan': _explain(con, statement)} for con, statement in call.sql]}
+    registry.slow_calls.append(entry)
+    path = _settings['slow_log_path']
+    if path is not None:
+        with _lock, open(path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    return None
+
+
+def _iterate(name: str, call: _Call, start: float, generator):
+    rows, error = 0, False
+    try:
+        while True:
+            calls = _calls()
+            calls.append(call)
+            try:
+                chunk = next(generator)
+            except StopIteration:
+                return
+            finally:
+                calls.remove(call)
+            rows += _count_rows(chunk)
+            yield chunk
+    except BaseException:
+        error = True
+        raise
+    finally:
+        generator.close()
+        _finish(name, call, time.perf_counter() - start, rows, error)
+
+
+def instrument(func, name: str = None):
+    """
+    Return a wrapper of func that records every call in the registry. Calls that return a generator (e.g.
+    db_queries.iter_query) are timed until the generator is exhausted or closed, their rows are counted per chunk.
+    :param func: function to instrument
+    :param name: str (optional), name in the registry, func.__name__ if not given
+    :return: wrapped function
+    """
+    name = func.__name__ if name is None else name
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        call, result, error = _Call(), None, False
+        calls = _calls()
+        calls.append(call)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            calls.remove(call)
+            if error or not inspect.isgenerator(result):
+                _finish(name, call, time.perf_counter() - start, _count_rows(result), error)
+        return result if not inspect.isgenerator(result) else _iterate(name, call, start, result)
+
+    return wrapper
+
+
+def enable(slow_ms: float = 100.0, slow_log_path: str = None, modules: tuple = (db_queries,)) -> List[str]:
+    """
+    Instrument all public functions of modules (default: db_queries) and install the trace and progress callbacks on
+    all connections of db_builder.connections, open ones and new ones. Calling enable again changes the settings.
+    :param slow_ms: float (optional), calls that take at least this many milliseconds go to the slow-query log
+    :param slow_log_path: str (optional), file the slow calls are appended to as JSON lines, only kept in
+    registry.slow_calls if not given
+    :param modules: tuple (optional), modules whose functions are instrumented
+    :return: List[str], names of the instrumented functions
+    """
+    disable()
+    with _lock:
+        _settings.update(enabled=True, slow_seconds=slow_ms / 1e3, slow_log_path=slow_log_path)
+        for module in modules:
+            for name, func in list(vars(module).items()):
+                if inspect.isfunction(func) and func.__module__ == module.__name__ and not name.startswith('_'):
+                    setattr(module, name, instrument(func, name))
+                    _settings['patched'].append((module, name, func))
+        db_builder.connections.on_connect.append(_install_callbacks)
+        for con in db_builder.connections.open_connections():
+            _install_callbacks(con)
+        return [name for _, name, _ in _settings['patched']]
+
+
+def disable() -> None:
+    """
+    Restore the original functions and remove the callbacks from all connections. The registry is kept.
+    :return: None
+    """
+    with _lock:
+        if not _settings['enabled']:
+            return None
+        for module, name, func in _settings['patched']:
+            setattr(module, name, func)
+        _settings['patched'].clear()
+        db_builder.connections.on_connect.remove(_install_callbacks)
+        for con in db_builder.connections.open_connections():
+            _remove_callbacks(con)
+        _settings['enabled'] = False
+    return None
+
+
+def is_enabled() -> bool:
+    """
+    :return: bool, True between enable() and disable()
+    """
+    return _settings['enabled']
@@ -0,0 +1,145 @@
+"""
+Statistics for dashboards, read from the summary tables in db_builder.SUMMARY_TABLES. The tables are kept up to date by
+triggers on every write (migration 4 in db_builder), so each function reads a few rows instead of joining over
+experiment_objects. Objects without polymer type are reported with polymer_type None.
+"""
+from typing import List
+
+import pandas as pd
+
+import db_builder
+
+db = './data/biocycle_tracking.db'
+
+
+def object_usage(object_id: str, db_path: str = db) -> int:
+    """
+    Return in how many experiments an object has been used.
+    :param object_id: str, object_id of the object
+    :param db_path: str (optional), name of the database
+    :return: int
+    """
+    con = db_builder.connections.get(db_path)
+    row = con.execute('SELECT n_experiments FROM stats_object_usage WHERE object_id = ?;', (object_id,)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def usage_counts(db_path: str = db) -> dict:
+    """
+    Return the number of experiments of every object that has been used at least once.
+    :param db_path: str (optional), name of the database
+    :return: dict, {object_id: n_experiments}
+    """
+    con = db_builder.connections.get(db_path)
+    return dict(con.execute('SELECT object_id, n_experiments FROM stats_object_usage WHERE n_experiments > 0;'))
+
+
+def most_used_objects(n: int = 10, db_path: str = db) -> List[tuple]:
+    """
+    Return the n objects used in the most experiments.
+    :param n: int (optional), number of objects
+    :param db_path: str (optional), name of the database
+    :return: List[tuple], [(object_id, n_experiments), ...]
+    """
+    con = db_builder.connections.get(db_path)
+    return con.execute('SELECT object_id, n_experiments FROM stats_object_usage '
+                       'ORDER BY n_experiments DESC, object_id LIMIT ?;', (n,)).fetchall()
+
+
+def _histogram(table: str, key: str, value: str, db_path: str) -> dict:
+    con = db_builder.connections.get(db_path)
+    rows = con.execute(f"SELECT NULLIF(polymer_type, ''), n_objects FROM {table} "
+                       f"WHERE {key} = ? AND n_objects != 0 ORDER BY polymer_type;", (value,))
+    return dict(rows.fetchall())
+
+
+def session_polymer_histogram(session_id: str, db_path: str = db) -> dict:
+    """
+    Return the number of objects of each polymer type in the experiments of a session.
+    :param session_id: str, session_id of the session
+    :param db_path: str (optional), name of the database
+    :return: dict, {polymer_type: n_objects}
+    """
+    return _histogram('stats_session_polymers', 'session_id', session_id, db_path)
+
+
+def container_polymer_histogram(container_id: str, db_path: str = db) -> dict:
+    """
+    Return the number of objects of each polymer type in the experiments of a container.
+    :param container_id: str, container_id of the container
+    :param db_path: str (optional), name of the database
+    :return: dict, {polymer_type: n_objects}
+    """
+    return _histogram('stats_container_polymers', 'container_id', container_id, db_path)
+
+
+def polymer_mix_by_material_type(db_path: str = db) -> pd.DataFrame:
+    """
+    Return the number of objects of each polymer type per material type of the containers.
+    :param db_path: str (optional), name of the database
+    :return: pd.DataFrame, columns: material_type, polymer_type, n_objects
+    """
+    query = '''
+        SELECT containers.material_type, NULLIF(stats_container_polymers.polymer_type, '') AS polymer_type,
+               SUM(stats_container_polymers.n_objects) AS n_objects
+        FROM stats_container_polymers
+        LEFT JOIN containers ON containers.container_id = stats_container_polymers.container_id
+            WHERE stats_container_polymers.n_objects != 0
+        GROUP BY 1, 2
+        ORDER BY 1, 2;
+        '''
+    return pd.read_sql_query(query, db_builder.connections.get(db_path))
+
+
+def experiments_by_responsible(db_path: str = db) -> pd.DataFrame:
+    """
+    Return the number of sessions and experiments per responsible person.
+    :param db_path: str (optional), name of the database
+    :return: pd.DataFrame, columns: responsible, n_sessions, n_experiments
+    """
+    query = '''
+        SELECT sessions.responsible, COUNT(*) AS n_sessions,
+               SUM(IFNULL(stats_session_experiments.n_experiments, 0)) AS n_experiments
+        FROM sessions
+        LEFT JOIN stats_session_experiments ON stats_session_experiments.session_id = sessions.session_id
+        GROUP BY 1
+        ORDER BY 1;
+        '''
+    return pd.read_sql_query(query, db_builder.connections.get(db_path))
+
+
+def check_summaries(db_path: str = db) -> dict:
+    """
+    Compare the summary tables with the counts computed from scratch.
+    :param db_path: str (optional), name of the database
+    :return: dict, {table: number of rows that differ}, empty if all tables are correct
+    """
+    con = db_builder.connections.get(db_path)
+    result = {}
+    for table, (keys, count, select) in db_builder.SUMMARY_TABLES.items():
+        stored = {row[:-1]: row[-1] for row in con.execute(f'SELECT {", ".join(keys)}, {count} FROM {table} '
+                                                           f'WHERE {count} != 0;')}
+        expected = {row[:-1]: row[-1] for row in con.execute(select)}
+        differences = sum(stored.get(key) != expected.get(key) for key in stored.keys() | expected.keys())
+        if differences:
+            result[table] = differences
+    return result
+
+
+def rebuild_summaries(db_path: str = db) -> None:
+    """
+    Recompute all summary tables from scratch in one transaction, e.g. after restoring an old backup.
+    :param db_path: str (optional), name of the database
+    :return: None
+    """
+    con = db_builder.connections.get(db_path)
+    con.execute('BEGIN IMMEDIATE;')
+    try:
+        for table, (_, _, select) in db_builder.SUMMARY_TABLES.items():
+            con.execute(f'DELETE FROM {table};')
+            con.execute(f'INSERT INTO {table} {select};')
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    return None
@@ -0,0 +1,159 @@
+"""
+Seeded generator of synthetic tracker databases at a given scale, for benchmarks beyond the small database in ./data.
+Objects, containers, sessions, experiments and links are written through the public functions of db_queries into a
+database with the schema of db_builder.create_schema, so triggers and summary tables are filled like in production.
+The same scale and seed always give the same database.
+
+    python synthetic_data.py 100k ./data/synthetic_100k.db
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import create_experiments_helpers as helpers
+import db_builder
+import db_queries
+
+# number of experiments of the predefined scale factors
+SCALES = {
+    '1k': 1000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+
+# polymer types and their share of the objects, similar to the sample catalog
+POLYMER_TYPES = {
+    'pe-hd': 0.37, 'pp': 0.18, 'pe-ld': 0.09, 'pet': 0.07, 'epdm': 0.04, 'glas': 0.03, 'alu': 0.03, 'pe': 0.03,
+    'ps': 0.02, 'pbt': 0.02, 'cellophan': 0.02, 'unclear': 0.03, 'no sample': 0.02, None: 0.05,
+}
+MATERIAL_TYPES = ['compost', 'digestive']
+TEXTURES = ['rough', 'smooth', None]
+COLORS = ['gray', 'white', 'black', 'blue', 'green', 'transparent', None]
+
+
+def scale_size(scale) -> int:
+    """
+    Return the number of experiments of a scale factor, e.g. '100k', or of an int.
+    :param scale: str (key of SCALES) or int
+    :return: int
+    """
+    if isinstance(scale, str):
+        if scale.lower() not in SCALES:
+            raise ValueError(f'unknown scale {scale}, use one of {list(SCALES)} or a number of experiments')
+        return SCALES[scale.lower()]
+    return int(scale)
+
+
+def generate_objects(n_objects: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Draw n_objects objects with the columns of put_multiple_objects. object_ids look like the locators of the sample
+    catalog, e.g. '14_1'.
+    :param n_objects: int, number of objects
+    :param rng: numpy Generator
+    :return: pd.DataFrame
+    """
+    types = np.array(list(POLYMER_TYPES), dtype=object)
+    weights = np.array(list(POLYMER_TYPES.values()))
+    return pd.DataFrame({
+        'object_id': [f'{i // 100}_{i % 100}' for i in range(n_objects)],
+        'polymer_type': types[rng.choice(len(types), size=n_objects, p=weights / weights.sum())],
+        'length': rng.gamma(2.0, 15.0, size=n_objects).round(1),
+        'texture': rng.choice(np.array(TEXTURES, dtype=object), size=n_objects),
+        'stiffness': rng.choice(np.array(['soft', 'stiff', None], dtype=object), size=n_objects),
+        'color': rng.choice(np.array(COLORS, dtype=object), size=n_objects),
+        'contamination': rng.choice(np.array(['clean', 'dirty', None], dtype=object), size=n_objects),
+        'form': rng.choice(np.array(['foil', 'fragment', 'fibre', None], dtype=object), size=n_objects),
+        'note': None,
+        'reference_image': '1',
+    })
+
+
+def generate_containers(n_containers: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Draw n_containers containers with the columns of put_multiple_containers.
+    :param n_containers: int, number of containers
+    :param rng: numpy Generator
+    :return: pd.DataFrame
+    """
+    material_types = rng.choice(np.array(MATERIAL_TYPES, dtype=object), size=n_containers)
+    return pd.DataFrame({
+        'container_id': [f'{material_type[:2].upper()}-{i:04}' for i, material_type in enumerate(material_types)],
+        'material_type': material_types,
+        'company': None,
+        'location': None,
+        'note': None,
+        'date': '2023-05-01 00:00:00',
+    })
+
+
+def generate_database(db_path: str,
+                      n_experiments: int = 1000,
+                      n_objects: int = None,
+                      n_containers: int = None,
+                      experiments_per_session: int = 100,
+                      min_length: int = 2,
+                      max_length: int = 5,
+                      seed: int = 42,
+                      sessions_per_transaction: int = 50) -> dict:
+    """
+    Build a synthetic database at db_path. Every session gets experiments_per_session experiments with min_length to
+    max_length objects each, drawn with create_experiments_helpers.generate_session_plan. Sessions are written with
+    ingest_session_plan, sessions_per_transaction at a time.
+    :param db_path: str, path of the database file, must not exist yet
+    :param n_experiments: int (optional), number of experiments
+    :param n_objects: int (optional), number of objects, default: n_experiments / 2, at least 200
+    :param n_containers: int (optional), number of containers, default: n_experiments / 1000, at least 10
+    :param experiments_per_session: int (optional), number of experiments per session
+    :param min_length: int (optional), minimal number of objects per experiment
+    :param max_length: int (optional), maximal number of objects per experiment
+    :param seed: int (optional), seed of the random numbers
+    :param sessions_per_transaction: int (optional), number of sessions written per transaction
+    :return: dict, {'sessions', 'experiments', 'objects', 'containers', 'links', 'seconds'}
+    """
+    if os.path.exists(db_path):
+        raise FileExistsError(f'{db_path} already exists')
+    n_objects = max(200, n_experiments // 2) if n_objects is None else n_objects
+    n_containers = max(10, n_experiments // 1000) if n_containers is None else n_containers
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+
+    db_builder.create_database_file(db_path)
+    db_builder.create_schema(db_path)
+    objects = generate_objects(n_objects, rng)
+    for first in range(0, n_objects, 100000):
+        db_queries.put_multiple_objects(objects[first:first + 100000], db_path)
+    containers = generate_containers(n_containers, rng)
+    db_queries.put_multiple_containers(containers, db_path)
+
+    container_ids = containers['container_id'].tolist()
+    object_ids = objects['object_id'].to_numpy(dtype=str)  # converted once, shared by the plans of all sessions
+    n_sessions = -(-n_experiments // experiments_per_session)
+    n_links = 0
+    plans = []
+    for s in range(n_sessions):
+        first = s * experiments_per_session
+        experiment_ids = [f'E{i:07}' for i in range(first, min(first + experiments_per_session, n_experiments))]
+        plans.append(helpers.generate_session_plan(f'S{s:05}', experiment_ids, objects, container_ids, min_length,
+                                                   max_length, random_state=seed + s, object_ids=object_ids,
+                                                   as_plan=True))
+        if len(plans) == sessions_per_transaction or s == n_sessions - 1:
+            plan = helpers.SessionPlan.concat(plans)
+            db_queries.ingest_session_plan(plan, responsible='synthetic', db_path=db_path)
+            n_links += plan.n_links
+            plans = []
+
+    db_builder.connections.close(db_path)
+    return {'sessions': n_sessions,
+            'experiments': n_experiments,
+            'objects': n_objects,
+            'containers': n_containers,
+            'links': n_links,
+            'seconds': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    scale, path = (sys.argv[1:] + ['1k'])[0], (sys.argv[2:] or [None])[0]
+    print(generate_database(path or f'./data/synthetic_{scale}.db', scale_size(scale)))
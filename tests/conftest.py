@@ -0,0 +1,29 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db_builder  # noqa: E402
+import synthetic_data  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Small synthetic database with the current schema: 200 experiments in 4 sessions."""
+    path = str(tmp_path / 'tracker.db')
+    synthetic_data.generate_database(path, 200, experiments_per_session=50)
+    yield path
+    db_builder.connections.close(path)
+
+
+@pytest.fixture
+def legacy_db_path(tmp_path):
+    """Copy of the database shipped in ./data, which has never been migrated."""
+    path = str(tmp_path / 'biocycle_tracking.db')
+    shutil.copy(os.path.join(ROOT, 'data', 'biocycle_tracking.db'), path)
+    yield path
+    db_builder.connections.close(path)
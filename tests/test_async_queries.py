@@ -0,0 +1,21 @@
+import asyncio
+import gc
+
+import async_queries
+import db_queries
+
+
+def test_batched_reads_survive_garbage_collection(db_path):
+    experiment_ids = [f'E{i:07}' for i in range(20)] + ['E9999999']
+
+    async def run():
+        async with async_queries.AsyncQueries(db_path, max_workers=1) as queries:
+            requests = [asyncio.ensure_future(queries.get_experiment(experiment_id))
+                        for experiment_id in experiment_ids]
+            await asyncio.sleep(0)
+            gc.collect()
+            return await asyncio.gather(*requests), queries._flushes
+
+    results, flushes = asyncio.run(run())
+    assert results == [db_queries.get_experiment(experiment_id, db_path) for experiment_id in experiment_ids]
+    assert results[-1] == [] and not flushes
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import threading
+import time
+
+import backup
+import db_builder
+import db_queries
+
+COUNTS = ('SELECT (SELECT COUNT(*) FROM experiments), (SELECT COUNT(*) FROM experiment_objects), '
+          '(SELECT COUNT(*) FROM objects);')
+
+
+def _counts(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute(COUNTS).fetchone()
+    finally:
+        con.close()
+
+
+def test_backup_while_writing(db_path, tmp_path):
+    experiments, links, objects = _counts(db_path)
+    stop = threading.Event()
+    written = []
+
+    def write():
+        while not stop.is_set():
+            db_queries.put_object(f'backup_{len(written)}', 'pe', db_path=db_path)
+            written.append(1)
+        db_builder.connections.close(db_path)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        while not written:
+            time.sleep(0.001)
+        result = backup.backup(db_path, target=str(tmp_path / 'copy.db'), pages=1, sleep=0.001)
+    finally:
+        stop.set()
+        writer.join()
+
+    assert result['integrity'] == 'ok' and result['steps'] > 1
+    con = sqlite3.connect(result['path'])
+    assert con.execute('PRAGMA integrity_check;').fetchall() == [('ok',)]
+    con.close()
+    copied = _counts(result['path'])
+    assert copied[:2] == (experiments, links)
+    assert objects < copied[2] <= objects + len(written)
+    assert not os.path.exists(f'{result["path"]}.tmp')
+
+
+def test_rotate_backups(db_path, tmp_path):
+    backup_dir = str(tmp_path / 'backups')
+    paths = [backup.backup(db_path, backup_dir, pages=-1)['path'] for _ in range(5)]
+    assert backup.list_backups(backup_dir, db_path) == paths
+
+    removed = backup.rotate_backups(2, backup_dir, db_path)
+    assert removed == paths[:3]
+    assert backup.list_backups(backup_dir, db_path) == paths[3:]
+    assert backup.rotate_backups(2, backup_dir, db_path) == []
+
+
+def test_refresh_replica(db_path, tmp_path):
+    replica = str(tmp_path / 'replica' / 'replica.db')
+    backup.refresh_replica(db_path, replica)
+    assert _counts(replica) == _counts(db_path)
+
+    db_queries.put_object('replica_1', 'pe', db_path=db_path)
+    assert _counts(replica) != _counts(db_path)
+    backup.refresh_replica(db_path, replica)
+    assert _counts(replica) == _counts(db_path)
+    con = sqlite3.connect(replica)
+    assert con.execute('PRAGMA journal_mode;').fetchone()[0] == 'delete'
+    con.close()
+
+
+def test_backup_scheduler(db_path, tmp_path):
+    backup_dir = str(tmp_path / 'backups')
+    replica = str(tmp_path / 'replica.db')
+    with backup.BackupScheduler(interval=0.01, keep=2, replica_interval=0.01, db_path=db_path, backup_dir=backup_dir,
+                                replica_path=replica, pages=-1) as scheduler:
+        deadline = time.monotonic() + 10
+        while sum(name == 'run_backup' for name, _ in scheduler.results) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert not scheduler.errors
+    names = [name for name, _ in scheduler.results]
+    assert names.count('run_backup') >= 4 and 'run_replica' in names
+    assert len(backup.list_backups(backup_dir, db_path)) == 2
+    assert _counts(replica) == _counts(db_path)
@@ -0,0 +1,45 @@
+import json
+import os
+import stat
+
+import capture_jsons
+import capture_sync
+
+
+def _read(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_reexport_keeps_capture_status(db_path, tmp_path):
+    out_dir = str(tmp_path / 'export')
+    capture_jsons.export_session_jsons('S00000', out_dir, db_path=db_path)
+    path = os.path.join(out_dir, 'S00000', 'E0000000', 'data.json')
+    data = _read(path)
+    assert (data['status'], data['aligned']) == ('pending', False)
+    reference = str(tmp_path / 'reference')
+    open(reference, 'wb').close()
+    assert stat.S_IMODE(os.stat(path).st_mode) == stat.S_IMODE(os.stat(reference).st_mode)
+
+    with open(path, 'w') as f:
+        json.dump({**data, 'status': 'done', 'aligned': True}, f, indent=4)
+    capture_sync.sync_status(out_dir, db_path=db_path)
+    result = capture_jsons.export_session_jsons('S00000', out_dir, db_path=db_path)
+    assert (_read(path)['status'], _read(path)['aligned']) == ('done', True)
+    assert result['written'] == 0
+    assert capture_sync.sync_status(out_dir, db_path=db_path)['changed'] == 0
+
+    # a folder exported again from scratch gets the synced status from the database
+    os.remove(path)
+    capture_jsons.export_session_jsons('S00000', out_dir, db_path=db_path)
+    assert (_read(path)['status'], _read(path)['aligned']) == ('done', True)
+    assert capture_sync.sync_status(out_dir, db_path=db_path)['changed'] == 0
+
+
+def test_rewrite_keeps_file_mode(tmp_path):
+    path = str(tmp_path / 'data.json')
+    capture_jsons.write_if_changed(path, b'{}')
+    os.chmod(path, 0o640)
+    assert capture_jsons.write_if_changed(path, b'{"status": "pending"}')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    assert os.listdir(tmp_path) == ['data.json']
@@ -0,0 +1,49 @@
+import openpyxl
+
+import catalog_import
+import db_queries
+
+
+def _write_catalog(path, rows):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(['Locator', 'Type', 'Length', 'Reference Image'])
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def test_excel_booleans_are_stored_as_flags(db_path, tmp_path):
+    path = str(tmp_path / 'catalog.xlsx')
+    _write_catalog(path, [['x_1', 'pvc', 12.5, True], ['x_2', 'pvc', 3, False], ['x_3', 'pvc', 4, 1],
+                          ['x_4', 'pvc', 5, 'maybe']])
+    counts = catalog_import.import_objects(path, db_path=db_path)
+    assert (counts['inserted'], counts['rejected']) == (3, 1)
+
+    objects, _ = db_queries.find_objects(polymer_type='pvc', reference_image=True, db_path=db_path)
+    assert [row.object_id for row in objects] == ['x_1', 'x_3']
+    assert db_queries.get_object('x_2', db_path)[0][-1] == '0'
+
+
+def test_import_counts(db_path, tmp_path):
+    path = str(tmp_path / 'catalog.csv')
+    with open(path, 'w') as f:
+        f.write('Locator,Type,Length,Note\ny_1,pvc,1,first note\ny_2,pvc,2,\n')
+    counts = catalog_import.import_objects(path, db_path=db_path)
+    assert (counts['inserted'], counts['updated'], counts['unchanged']) == (2, 0, 0)
+
+    with open(path, 'w') as f:
+        f.write('Locator,Type,Length,Note\ny_1,pvc,1,changed note\ny_2,pvc,2,\n0_1,,,\n')
+    counts = catalog_import.import_objects(path, db_path=db_path)
+    assert (counts['inserted'], counts['updated'], counts['unchanged']) == (0, 1, 2)
+    assert counts['rows'] == 3
+    assert db_queries.get_objects(['0_1'], db_path)['0_1'][1:3] != (None, None)
+
+
+def test_import_overwrite_blank(db_path, tmp_path):
+    path = str(tmp_path / 'catalog.csv')
+    with open(path, 'w') as f:
+        f.write('Locator,Type,Length\n0_1,,\n')
+    counts = catalog_import.import_objects(path, overwrite_blank=True, db_path=db_path)
+    assert (counts['inserted'], counts['updated'], counts['unchanged']) == (0, 1, 0)
+    assert db_queries.get_objects(['0_1'], db_path)['0_1'][1:3] == (None, None)
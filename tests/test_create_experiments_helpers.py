@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+
+import create_experiments_helpers as helpers
+
+
+@pytest.fixture
+def objects():
+    polymer_types = ['pe'] * 60 + ['pp'] * 30 + ['pet'] * 10
+    return pd.DataFrame({'object_id': [f'{i // 10}_{i % 10}' for i in range(len(polymer_types))],
+                         'polymer_type': polymer_types})
+
+
+def _usage(plan):
+    return pd.Series([object_id for object_ids in plan['objects'] for object_id in object_ids]).value_counts()
+
+
+def test_balanced_usage_spread(objects):
+    plan = helpers.generate_session_plan('S0000', [f'E{i:04}' for i in range(500)], objects, ['CO-01'], 2, 5,
+                                         balance_usage=True, usage={})
+    usage = _usage(plan).reindex(objects['object_id'], fill_value=0)
+    assert usage.max() - usage.min() <= 1
+    assert all(len(set(object_ids)) == len(object_ids) for object_ids in plan['objects'])
+
+    # objects used in earlier sessions are used later, until the usage is even again
+    previous = {object_id: 10 for object_id in objects['object_id'][:50]}
+    plan = helpers.generate_session_plan('S0001', [f'E{i:04}' for i in range(200)], objects, ['CO-01'], 2, 5,
+                                         balance_usage=True, usage=previous)
+    usage = _usage(plan).reindex(objects['object_id'], fill_value=0) + pd.Series(previous).reindex(
+        objects['object_id'], fill_value=0)
+    assert usage.max() - usage.min() <= 1
+
+
+def test_balanced_quotas(objects):
+    plan = helpers.generate_session_plan('S0000', [f'E{i:04}' for i in range(300)], objects, ['CO-01'], 2, 5,
+                                         balance_usage=True, usage={}, quotas={'pe': 2, 'pp': 1, 'pet': 1})
+    types = objects.set_index('object_id')['polymer_type']
+    counts = types[[object_id for object_ids in plan['objects'] for object_id in object_ids]].value_counts()
+    total = plan['n_objects'].sum()
+    assert abs(counts['pe'] - total / 2) <= 1
+    assert abs(counts['pp'] - total / 4) <= 1
+    assert abs(counts['pet'] - total / 4) <= 1
+
+    plan = helpers.generate_session_plan('S0000', [f'E{i:04}' for i in range(50)], objects, ['CO-01'], 2, 5,
+                                         balance_usage=True, usage={}, quotas={'pp': 1})
+    assert set(types[[object_id for object_ids in plan['objects'] for object_id in object_ids]]) == {'pp'}
+
+
+def test_balanced_quota_classes_too_small(objects):
+    few = objects.tail(13)  # 3 pp and 10 pet objects
+    with pytest.raises(ValueError, match='at least as many objects'):
+        helpers.generate_session_plan('S0000', ['E0000', 'E0001'], few, ['CO-01'], 5, 5, balance_usage=True, usage={},
+                                      quotas={'pp': 1})
+    with pytest.raises(ValueError, match='no objects'):
+        helpers.generate_session_plan('S0000', ['E0000'], few, ['CO-01'], 2, 2, balance_usage=True, usage={},
+                                      quotas={'pe': 1})
+
+
+@pytest.mark.parametrize('options', [{}, {'stratify_column': 'polymer_type'}, {'balance_usage': True, 'usage': {}}])
+def test_empty_session_plan(objects, tmp_path, options):
+    frame = helpers.generate_session_plan('S0000', [], objects, ['CO-01'], 2, 5, **options)
+    assert len(frame) == 0
+    assert frame.columns.tolist() == ['session_id', 'experiment_id', 'container_id', 'objects', 'n_objects']
+
+    plan = helpers.generate_session_plan('S0000', [], objects, ['CO-01'], 2, 5, as_plan=True, **options)
+    path = str(tmp_path / 'plan.bin')
+    plan.save(path)
+    loaded = helpers.SessionPlan.load(path)
+    assert (len(loaded), loaded.n_links, list(loaded.rows())) == (0, 0, [])
+    assert len(helpers.SessionPlan.from_frame(frame).to_frame()) == 0
+
+
+@pytest.mark.parametrize('options', [{}, {'stratify_column': 'polymer_type'}, {'balance_usage': True, 'usage': {}}])
+def test_prebuilt_object_ids(objects, options):
+    shuffled = objects.sample(frac=1, random_state=0)
+    object_ids = shuffled['object_id'].to_numpy(dtype=str)
+    experiment_ids = [f'E{i:04}' for i in range(50)]
+    plan = helpers.generate_session_plan('S0000', experiment_ids, shuffled, ['CO-01'], 2, 5, object_ids=object_ids,
+                                         as_plan=True, **options)
+    assert plan.object_ids is object_ids
+    expected = helpers.generate_session_plan('S0000', experiment_ids, shuffled, ['CO-01'], 2, 5, **options)
+    assert plan.to_frame().equals(expected)
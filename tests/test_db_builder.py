@@ -0,0 +1,24 @@
+import db_builder
+
+
+def test_migrate_is_idempotent(db_path):
+    assert db_builder.migrate(db_path) == len(db_builder.MIGRATIONS)
+    assert db_builder.migrate(db_path) == len(db_builder.MIGRATIONS)
+
+
+def test_hot_queries_use_indexes(db_path):
+    db_builder.migrate(db_path)
+    assert db_builder.check_query_plans(db_path) == {}
+
+
+def test_hot_queries_use_indexes_after_upgrade(legacy_db_path, monkeypatch):
+    monkeypatch.setattr(db_builder.connections, 'auto_migrate', False)
+    assert db_builder.get_schema_version(legacy_db_path) == 0
+    assert db_builder.migrate(legacy_db_path) == len(db_builder.MIGRATIONS)
+    assert db_builder.check_query_plans(legacy_db_path) == {}
+
+
+def test_first_connection_migrates(legacy_db_path):
+    session_id = db_builder.get_next_session_id(legacy_db_path)
+    assert db_builder.get_schema_version(legacy_db_path) == len(db_builder.MIGRATIONS)
+    assert db_builder.reserve_session_ids(1, legacy_db_path) == [session_id]
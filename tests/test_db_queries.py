@@ -0,0 +1,176 @@
+import sqlite3
+import threading
+
+import pandas as pd
+import pytest
+
+import catalog_import
+import db_builder
+import db_queries
+
+
+def test_complete_session_lists_sorted_objects(db_path):
+    con = db_builder.connections.get(db_path)
+    expected = {}
+    for experiment_id, object_id in con.execute("SELECT experiment_objects.experiment_id, object_id "
+                                                "FROM experiment_objects JOIN experiments USING (experiment_id) "
+                                                "WHERE session_id = 'S00001';"):
+        expected.setdefault(experiment_id, []).append(object_id)
+
+    rows = db_queries.get_complete_session('S00001', db_path)
+    assert [row[1] for row in rows] == sorted(expected)
+    assert {row[1]: row[3] for row in rows} == {key: sorted(value) for key, value in expected.items()}
+    assert db_queries.get_complete_sessions(['S00001', 'S00002'], db_path)['S00001'] == rows
+
+    detailed = db_queries.get_complete_session('S00001', db_path, include_objects=True)
+    assert [[item['object_id'] for item in row[3]] for row in detailed] == [row[3] for row in rows]
+    first = detailed[0][3][0]
+    assert tuple(first.values()) == tuple(db_queries.get_object(first['object_id'], db_path)[0])
+
+
+def test_complete_experiment_keeps_commas(db_path):
+    db_queries.put_object('1,2', 'pe', db_path=db_path)
+    db_queries.put_experiment('E9999999', 'S00000', 'CO-0000', 2, db_path=db_path)
+    db_queries.link_experiment_objects('E9999999', ['1,2', '0_1'], db_path=db_path)
+    assert db_queries.get_complete_experiment('E9999999', db_path) == [('E9999999', 'CO-0000', ['0_1', '1,2'])]
+
+
+def _table_contents(db_path, tables):
+    con = db_builder.connections.get(db_path)
+    return {table: sorted(con.execute(f'SELECT * FROM {table};').fetchall()) for table in tables}
+
+
+@pytest.mark.parametrize('session_id, experiment_ids', [
+    ('S00000', ['E9000000', 'E9000001']),  # session exists already
+    ('S09999', ['E9000000', 'E0000001']),  # second experiment exists already
+    ('S09999', ['E9000000', 'E9000000']),  # duplicate experiment id in the plan
+])
+def test_ingest_session_plan_is_atomic(db_path, session_id, experiment_ids):
+    tables = ['sessions', 'experiments', 'experiment_objects', *db_builder.SUMMARY_TABLES]
+    before = _table_contents(db_path, tables)
+    plan = pd.DataFrame({'session_id': session_id, 'experiment_id': experiment_ids, 'container_id': 'CO-0000',
+                         'objects': [['0_1', '0_2'], ['0_3']]})
+    with pytest.raises(sqlite3.IntegrityError):
+        db_queries.ingest_session_plan(plan, db_path=db_path)
+    assert _table_contents(db_path, tables) == before
+
+
+def _color(object_id, db_path):
+    return dict(zip(db_queries.ObjectRow._fields, db_queries.get_object(object_id, db_path)[0]))['color']
+
+
+def _cached_color(object_id, db_path):
+    color = _color(object_id, db_path)
+    hits = db_queries.cache.hits
+    assert _color(object_id, db_path) == color and db_queries.cache.hits == hits + 1
+    return color
+
+
+def test_cache_sees_write_of_other_connection(db_path):
+    _cached_color('0_1', db_path)
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("UPDATE objects SET color = 'other connection' WHERE object_id = '0_1';")
+    con.close()
+    assert _color('0_1', db_path) == 'other connection'
+
+
+def test_cache_sees_write_of_other_thread(db_path):
+    _cached_color('0_1', db_path)
+    def write():
+        db_queries.run_query("UPDATE objects SET color = 'other thread' WHERE object_id = '0_1';", db_path,
+                             read_only=False)
+        db_builder.connections.close(db_path)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    thread.join()
+    assert _color('0_1', db_path) == 'other thread'
+
+
+def test_cache_sees_catalog_import(db_path, tmp_path):
+    _cached_color('0_1', db_path)
+    path = str(tmp_path / 'catalog.csv')
+    with open(path, 'w') as f:
+        f.write('Locator,Color\n0_1,imported\n')
+    catalog_import.import_objects(path, db_path=db_path)
+    assert _color('0_1', db_path) == 'imported'
+
+
+def test_run_query_is_read_only_by_default(db_path):
+    with pytest.raises((sqlite3.Error, pd.errors.DatabaseError), match='readonly'):
+        db_queries.run_query("UPDATE objects SET color = 'read only' WHERE object_id = '0_1';", db_path)
+    assert db_queries.run_query("UPDATE objects SET color = 'written' WHERE object_id = '0_1';", db_path,
+                                read_only=False) == 1
+
+
+def test_snapshot_ignores_later_writes(db_path):
+    query = 'SELECT COUNT(*) AS n FROM objects;'
+    before = db_queries.run_query(query, db_path)['n'][0]
+
+    def write():
+        db_queries.put_object('snapshot_1', 'pe', db_path=db_path)
+        db_builder.connections.close(db_path)
+
+    with db_builder.connections.snapshot(db_path):
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+        assert db_queries.run_query(query, db_path)['n'][0] == before
+        assert 'snapshot_1' not in db_queries.get_objects(['snapshot_1'], db_path)
+    assert db_queries.run_query(query, db_path)['n'][0] == before + 1
+
+
+def _all_pages(find, limit, **filters):
+    rows, after, pages = [], None, 0
+    while True:
+        page, after = find(after=after, limit=limit, **filters)
+        rows.extend(page)
+        pages += 1
+        if after is None:
+            return rows, pages
+
+
+def test_find_objects_pages(db_path):
+    con = db_builder.connections.get(db_path)
+    expected = [object_id for object_id, in con.execute("SELECT object_id FROM objects WHERE polymer_type = 'pe' "
+                                                        "ORDER BY object_id;")]
+    assert len(expected) % 7
+    rows, pages = _all_pages(db_queries.find_objects, 7, polymer_type='pe', db_path=db_path)
+    assert [row.object_id for row in rows] == expected
+    assert pages == len(expected) // 7 + 1
+
+    page, after = db_queries.find_objects(polymer_type='pe', after=expected[-2], db_path=db_path)
+    assert [row.object_id for row in page] == expected[-1:] and after is None
+
+
+def test_find_containers_pages(db_path):
+    con = db_builder.connections.get(db_path)
+    expected = [container_id for container_id, in con.execute('SELECT container_id FROM containers '
+                                                              'ORDER BY container_id;')]
+    rows, pages = _all_pages(db_queries.find_containers, 3, db_path=db_path)
+    assert [row.container_id for row in rows] == expected
+    assert pages == -(-len(expected) // 3) + (len(expected) % 3 == 0)
+
+
+def test_search_index_follows_note_changes(db_path):
+    con = db_builder.connections.get(db_path)
+    with con:
+        con.execute("UPDATE objects SET note = 'zebra stripes' WHERE object_id = '0_1';")
+        con.execute("UPDATE containers SET note = 'zebra crate' WHERE container_id = "
+                    "(SELECT MIN(container_id) FROM containers);")
+    assert [row.object_id for row in db_queries.find_objects(text='zebra', db_path=db_path)[0]] == ['0_1']
+    assert len(db_queries.find_containers(text='zebra', db_path=db_path)[0]) == 1
+
+    with con:
+        con.execute("UPDATE objects SET note = 'plain' WHERE object_id = '0_1';")
+        con.execute("UPDATE objects SET note = 'zebra' WHERE object_id = '0_2';")
+        con.execute("DELETE FROM containers WHERE note = 'zebra crate';")
+    assert [row.object_id for row in db_queries.find_objects(text='zebra', db_path=db_path)[0]] == ['0_2']
+    assert [row.object_id for row in db_queries.find_objects(text='plain', db_path=db_path)[0]] == ['0_1']
+    assert db_queries.find_containers(text='zebra', db_path=db_path)[0] == []
+
+    with con:
+        con.execute("DELETE FROM experiment_objects WHERE object_id = '0_2';")
+        con.execute("DELETE FROM objects WHERE object_id = '0_2';")
+    assert db_queries.find_objects(text='zebra', db_path=db_path)[0] == []
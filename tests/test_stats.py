@@ -0,0 +1,43 @@
+import db_builder
+import db_queries
+import stats
+
+
+def test_summaries_after_deletes(db_path):
+    assert stats.check_summaries(db_path) == {}
+    before = sum(stats.session_polymer_histogram('S00000', db_path).values())
+    n_objects = len(db_queries.get_complete_experiment('E0000003', db_path)[0][2])
+
+    counts = db_queries.delete_experiments(['E0000003', 'E0000004'], db_path)
+    assert counts['experiments'] == 2
+    assert stats.check_summaries(db_path) == {}
+    assert sum(stats.session_polymer_histogram('S00000', db_path).values()) < before - n_objects
+
+    counts = db_queries.delete_sessions(['S00001', 'S00002'], db_path)
+    assert counts['experiments'] == 100
+    assert stats.check_summaries(db_path) == {}
+    assert stats.session_polymer_histogram('S00001', db_path) == {}
+
+
+def test_summaries_after_object_updates(db_path):
+    con = db_builder.connections.get(db_path)
+    linked = con.execute('''SELECT COUNT(DISTINCT object_id) FROM experiment_objects
+                                WHERE object_id IN ('0_1', '0_2', '0_3', '0_4');''').fetchone()[0]
+    assert linked == 4
+    with con:
+        # the links of 0_1 count as '' while it is renamed and move back to its polymer type afterwards
+        con.execute("UPDATE objects SET object_id = 'x_1' WHERE object_id = '0_1';")
+    assert stats.check_summaries(db_path) == {}
+    with con:
+        con.execute("UPDATE objects SET object_id = '0_1' WHERE object_id = 'x_1';")
+    assert stats.check_summaries(db_path) == {}
+
+    with con:
+        con.execute("UPDATE objects SET polymer_type = 'pvc' WHERE object_id = '0_2';")
+    assert stats.check_summaries(db_path) == {}
+
+    with con:
+        con.execute("INSERT OR REPLACE INTO objects (object_id, polymer_type) VALUES ('0_3', 'pvc');")
+        con.execute('''INSERT INTO objects (object_id, polymer_type) VALUES ('0_4', 'pvc')
+                        ON CONFLICT (object_id) DO UPDATE SET polymer_type = excluded.polymer_type;''')
+    assert stats.check_summaries(db_path) == {}